@@ -0,0 +1,166 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Many open requests at once: one thread per request versus
+`async_scoring.AsyncScorer`.
+
+Opens `--connections` requests at the same time, each scoring one image
+from a Watson V3 payload, and waits for all of them. The threaded version
+gives every request its own thread that calls pre-processing, the model,
+and post-processing in turn, as a threaded HTTP server would. The asyncio
+version runs every request as a coroutine on one event loop, with at most
+`--max_concurrency` of them running the model at once. Reports throughput,
+median and tail latency, and the peak number of threads in the process.
+
+Requires the SavedModel from build_graph.py. To run this script from the
+root of the project, type:
+   env/bin/python -m benchmarks.async_scoring --connections=100,1000
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+# Local imports
+from benchmarks import bench_util
+from common import async_scoring
+import common.inference_request as inference_request
+import handlers
+
+# System imports
+import asyncio
+import base64
+import threading
+import time
+import tensorflow as tf
+
+tf.flags.DEFINE_string("saved_model_dir", "./saved_model",
+                       "Location of the SavedModel to benchmark")
+tf.flags.DEFINE_list("connections", ["10", "100", "1000"],
+                     "Numbers of simultaneously open requests to try")
+tf.flags.DEFINE_integer("max_concurrency", 4,
+                        "Number of requests that AsyncScorer lets run the "
+                        "model at once")
+FLAGS = tf.flags.FLAGS
+
+
+class _ThreadCounter(object):
+  """
+  Samples the number of live threads in the background and remembers the
+  largest value.
+  """
+
+  def __init__(self, interval_secs=0.01):
+    self.peak = threading.active_count()
+    self._interval_secs = interval_secs
+    self._done = threading.Event()
+    self._thread = threading.Thread(target=self._sample, daemon=True)
+
+  def _sample(self):
+    while not self._done.wait(self._interval_secs):
+      self.peak = max(self.peak, threading.active_count())
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, *_):
+    self._done.set()
+    self._thread.join()
+
+
+def _score_blocking(odh, run_fn, payload):
+  # type: (Any, Callable[[Any], None], Dict[str, Any]) -> Any
+  request = inference_request.InferenceRequest()
+  request.set_raw_inputs_from_watson_v3(payload)
+  odh.pre_process(request)
+  run_fn(request)
+  odh.post_process(request)
+  return request.processed_outputs
+
+
+def _run_threaded(odh, run_fn, payload, connections):
+  # type: (Any, Callable[[Any], None], Dict[str, Any], int) -> List[float]
+  latencies = []
+  latencies_lock = threading.Lock()
+  start_barrier = threading.Barrier(connections)
+
+  def connection():
+    start_barrier.wait()
+    start = time.perf_counter()
+    _score_blocking(odh, run_fn, payload)
+    with latencies_lock:
+      latencies.append(time.perf_counter() - start)
+
+  threads = [threading.Thread(target=connection) for _ in range(connections)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return latencies
+
+
+def _run_async(scorer, payload, connections):
+  # type: (async_scoring.AsyncScorer, Dict[str, Any], int) -> List[float]
+  async def connection():
+    start = time.perf_counter()
+    await scorer.score(payload)
+    return time.perf_counter() - start
+
+  async def all_connections():
+    return await asyncio.gather(*[connection() for _ in range(connections)])
+
+  return asyncio.get_event_loop().run_until_complete(all_connections())
+
+
+def main(_):
+  runner = inference_request.LocalTFRunner.from_saved_model(
+    FLAGS.saved_model_dir)
+  odh = handlers.ObjectDetectorHandlers()
+  scorer = async_scoring.AsyncScorer(odh, runner.run, FLAGS.max_concurrency)
+  payload = {
+    "fields": ["image", "threshold"],
+    "values": [[base64.urlsafe_b64encode(bench_util.encode_image(
+      bench_util.synthetic_image(480, 640), "JPEG")).decode("utf-8"), 0.5]]
+  }
+
+  # Warm up, including the creation of the session callable
+  for _ in range(3):
+    _score_blocking(odh, runner.run, payload)
+
+  print("{:>12} {:>8} {:>12} {:>10} {:>10} {:>13}".format(
+    "connections", "mode", "images/sec", "p50 (ms)", "p99 (ms)",
+    "peak threads"))
+  for connections in [int(c) for c in FLAGS.connections]:
+    for mode in ["threads", "asyncio"]:
+      with _ThreadCounter() as thread_counter:
+        start = time.perf_counter()
+        if mode == "threads":
+          latencies = _run_threaded(odh, runner.run, payload, connections)
+        else:
+          latencies = _run_async(scorer, payload, connections)
+        elapsed = time.perf_counter() - start
+      summary = bench_util.latency_summary(latencies)
+      print("{:>12} {:>8} {:>12.1f} {:>10.1f} {:>10.1f} {:>13}".format(
+        connections, mode, connections / elapsed, summary["p50_ms"],
+        summary["p99_ms"], thread_counter.peak))
+  scorer.close()
+
+
+if __name__ == "__main__":
+  tf.app.run()
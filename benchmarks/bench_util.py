@@ -0,0 +1,228 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Helper functions shared by the scripts in the benchmarks directory."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List, Tuple
+
+import io
+import time
+import numpy as np
+from PIL import Image
+
+# Local imports
+from common.inference_request import InferenceRequest
+
+# Number of detections that the model returns per image
+_NUM_DETECTIONS = 100
+
+# Distributions of detection scores: name -> function from (random state,
+# shape) to unsorted scores.
+SCORE_DISTRIBUTIONS = [
+  # Scores from SSD decay quickly; about 5 of 100 pass a threshold of 0.5.
+  ("typical", lambda rng, shape: rng.beta(0.1, 2.0, size=shape)),
+  # Nearly every detection passes a threshold of 0.5.
+  ("worst case", lambda rng, shape: rng.uniform(0.5, 1.0, size=shape)),
+]
+_LABELS = [b"person", b"bicycle", b"car", b"bear", b"dog", b"kite"]
+
+
+def latency_summary(latencies_secs):
+  # type: (List[float]) -> Dict[str, float]
+  """
+  Summarize a list of latencies in seconds.
+
+  Returns a JSON-friendly dict of mean and percentile latencies in
+  milliseconds.
+  """
+  ms = np.array(latencies_secs, dtype=np.float64) * 1000.0
+  return {
+    "count": len(latencies_secs),
+    "mean_ms": float(ms.mean()),
+    "p50_ms": float(np.percentile(ms, 50)),
+    "p95_ms": float(np.percentile(ms, 95)),
+    "p99_ms": float(np.percentile(ms, 99)),
+    "max_ms": float(ms.max()),
+  }
+
+
+def time_fn(fn, num_iterations, num_warmup=3):
+  # type: (Callable[[], Any], int, int) -> Dict[str, float]
+  """
+  Call a function repeatedly and summarize how long each call took.
+
+  Args:
+    fn: Function to call with no arguments
+    num_iterations: Number of calls to time
+    num_warmup: Number of untimed calls to make first
+
+  Returns the result of `latency_summary()` for the timed calls.
+  """
+  for _ in range(num_warmup):
+    fn()
+  latencies = []
+  for _ in range(num_iterations):
+    start = time.perf_counter()
+    fn()
+    latencies.append(time.perf_counter() - start)
+  return latency_summary(latencies)
+
+
+def synthetic_image(height, width, seed=0):
+  # type: (int, int, int) -> np.ndarray
+  """
+  Generate a deterministic RGB image with smooth gradients plus some noise,
+  which compresses roughly as well as a photo does.
+
+  Returns the image as a uint8 array of shape [height, width, 3].
+  """
+  rng = np.random.RandomState(seed)
+  coarse = rng.randint(0, 256, size=(max(height // 64, 2),
+                                     max(width // 64, 2), 3),
+                       dtype=np.uint8)
+  smooth = np.asarray(Image.fromarray(coarse).resize((width, height),
+                                                     Image.BILINEAR))
+  noise = rng.randint(-8, 9, size=smooth.shape)
+  return np.clip(smooth.astype(np.int32) + noise, 0, 255).astype(np.uint8)
+
+
+def encode_image(pixels, image_format):
+  # type: (np.ndarray, str) -> bytes
+  """
+  Encode an RGB image as an image file.
+
+  Args:
+    pixels: uint8 array of shape [height, width, 3]
+    image_format: Name of a file format that PIL can write, such as "JPEG",
+      "PNG", or "GIF"
+
+  Returns the contents of the image file.
+  """
+  buf = io.BytesIO()
+  image = Image.fromarray(pixels)
+  if image_format == "GIF":
+    image = image.quantize(colors=256)
+  image.save(buf, format=image_format)
+  return buf.getvalue()
+
+
+def synthetic_detector_request(batch_size, score_fn, threshold):
+  # type: (int, Callable[[np.random.RandomState, Tuple[int, int]], np.ndarray], float) -> InferenceRequest
+  """
+  Build a request with synthetic raw outputs shaped like those of the model,
+  ready for `ObjectDetectorHandlers.post_process`.
+
+  Args:
+    batch_size: Number of tuples in the request
+    score_fn: Function that generates scores, such as the ones in
+      `SCORE_DISTRIBUTIONS`
+    threshold: Detection threshold of every tuple
+  """
+  rng = np.random.RandomState(42)
+  request = InferenceRequest()
+  request.raw_input_batch = [{"threshold": threshold}] * batch_size
+  request.raw_outputs["detection_boxes"] = rng.uniform(
+    size=(batch_size, _NUM_DETECTIONS, 4)).astype(np.float32)
+  # The model returns scores sorted in descending order
+  scores = score_fn(rng, (batch_size, _NUM_DETECTIONS)).astype(np.float32)
+  request.raw_outputs["detection_scores"] = -np.sort(-scores, axis=1)
+  labels = np.empty((batch_size, _NUM_DETECTIONS), dtype=np.object_)
+  labels[:] = [[_LABELS[i % len(_LABELS)] for i in range(_NUM_DETECTIONS)]]
+  request.raw_outputs["detection_classes"] = labels
+  request.raw_outputs["num_detections"] = np.full(
+    [batch_size], _NUM_DETECTIONS, dtype=np.float32)
+  return request
+
+
+def box_iou(a, b):
+  # type: (List[float], List[float]) -> float
+  """
+  Intersection over union of two boxes in the model's
+  [ymin, xmin, ymax, xmax] format.
+  """
+  height = min(a[2], b[2]) - max(a[0], b[0])
+  width = min(a[3], b[3]) - max(a[1], b[1])
+  if height <= 0 or width <= 0:
+    return 0.0
+  intersection = height * width
+  union = ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1])
+           - intersection)
+  return intersection / union if union > 0 else 0.0
+
+
+def detection_agreement(reference, candidate, iou_threshold=0.5):
+  # type: (List[List[Dict[str, Any]]], List[List[Dict[str, Any]]], float) -> Dict[str, Any]
+  """
+  Measure how closely the detections of one model match those of another
+  on the same images.
+
+  Each detection of the reference model, in order of decreasing
+  probability, is matched to the unmatched candidate detection with the
+  highest IoU, if that IoU is at least `iou_threshold`. Labels don't have to
+  agree for a match; the fraction of matches that do is reported separately.
+
+  Args:
+    reference: For each image, the "predictions" that
+      `ObjectDetectorHandlers.post_process` produced with the reference
+      model
+    candidate: The same, for the model under test
+    iou_threshold: Smallest IoU that counts as a match
+
+  Returns a JSON-friendly dict with the number of detections of each model,
+  the number of matches, recall and precision of the candidate with respect
+  to the reference, the fraction of matches whose labels agree, the mean IoU
+  of the matches, and the fraction of images for which both models found
+  the same labels the same number of times.
+  """
+  num_reference = num_candidate = num_matched = num_same_label = 0
+  total_iou = 0.0
+  num_same_labels_per_image = 0
+  for ref_dets, cand_dets in zip(reference, candidate):
+    num_reference += len(ref_dets)
+    num_candidate += len(cand_dets)
+    unmatched = list(range(len(cand_dets)))
+    for ref in sorted(ref_dets, key=lambda d: -d["probability"]):
+      ious = [(box_iou(ref["detection_box"], cand_dets[i]["detection_box"]),
+               i) for i in unmatched]
+      if len(ious) == 0:
+        break
+      iou, best = max(ious)
+      if iou < iou_threshold:
+        continue
+      unmatched.remove(best)
+      num_matched += 1
+      total_iou += iou
+      if ref["label"] == cand_dets[best]["label"]:
+        num_same_label += 1
+    if (sorted(d["label"] for d in ref_dets)
+            == sorted(d["label"] for d in cand_dets)):
+      num_same_labels_per_image += 1
+  num_images = len(reference)
+  return {
+    "num_images": num_images,
+    "reference_detections": num_reference,
+    "candidate_detections": num_candidate,
+    "matched": num_matched,
+    "recall": num_matched / num_reference if num_reference > 0 else 1.0,
+    "precision": num_matched / num_candidate if num_candidate > 0 else 1.0,
+    "label_agreement": (num_same_label / num_matched if num_matched > 0
+                        else 1.0),
+    "mean_iou": total_iou / num_matched if num_matched > 0 else 1.0,
+    "same_labels_fraction": (num_same_labels_per_image / num_images
+                             if num_images > 0 else 1.0),
+  }
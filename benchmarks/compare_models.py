@@ -0,0 +1,246 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Compares alternative builds of the model, such as the python_quantized,
+python_eightbit, and tflite targets of build_graph.py, with the reference
+build in ./saved_model.
+
+For each model, reports:
+* Artifact size: total size of the model's directory
+* Load time: time to load the model into a fresh session or interpreter,
+  and time of the first request, which includes TensorFlow's one-time
+  setup work
+* Latency: per-image time of pre-processing, inference, and post-processing
+* Peak resident set size of the process
+* Agreement with the reference model: recall and precision of its
+  detections with respect to the reference detections, the fraction of
+  matched detections with the same label, and the mean IoU of matched
+  boxes; see `bench_util.detection_agreement()`
+
+TensorFlow Lite models run through `inference_request.TFLiteRunner` and
+`handlers.TFLiteObjectDetectorHandlers`, which decode images and detections
+in Python, so their latency includes that work, as it does in production.
+
+Each model runs in a fresh process, so that load times and memory use
+don't depend on the models measured before it.
+
+The images come from --image_dir, which should hold JPEG, PNG, or GIF photos
+of the sort that the model will see in production, and which weren't used to
+calibrate the python_eightbit target. Without it, the script falls back to
+synthetic images, on which the detector finds few objects, so agreement
+numbers then mean little.
+
+Requires the models from build_graph.py. To run this script from the
+root of the project, type:
+   env/bin/python build_graph.py --targets=python,python_quantized,\
+       python_eightbit,tflite --calibration_image_dir=<other images>
+   env/bin/python -m benchmarks.compare_models --image_dir=<your images>
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, List, Tuple
+
+# Local imports
+from benchmarks import bench_util
+import common.inference_request as inference_request
+import common.util as util
+import handlers
+
+# System imports
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+import tensorflow as tf
+
+tf.flags.DEFINE_string("reference_dir", "./saved_model",
+                       "Location of the SavedModel to compare against")
+tf.flags.DEFINE_list("candidate_dirs",
+                     ["./saved_model_quantized", "./saved_model_eightbit",
+                      "./tflite_model"],
+                     "Locations of the SavedModels and TensorFlow Lite "
+                     "models to compare with the reference. Locations that "
+                     "don't exist are skipped")
+tf.flags.DEFINE_string("image_dir", "",
+                       "Directory of JPEG, PNG, and GIF images to run "
+                       "through each model. If empty, use synthetic images")
+tf.flags.DEFINE_integer("max_images", 100,
+                        "Maximum number of images to use from --image_dir")
+tf.flags.DEFINE_integer("num_iterations", 3,
+                        "Number of timed passes over the images")
+tf.flags.DEFINE_float("threshold", 0.5, "Detection threshold of every image")
+tf.flags.DEFINE_float("iou_threshold", 0.5,
+                      "Smallest IoU at which a detection matches a reference "
+                      "detection")
+tf.flags.DEFINE_string("output", "./temp/compare_models.json",
+                       "Path of the JSON file to write results to")
+FLAGS = tf.flags.FLAGS
+
+_NUM_SYNTHETIC_IMAGES = 8
+
+
+def _load_images(image_dir, max_images):
+  # type: (str, int) -> List[Tuple[str, bytes]]
+  """
+  Returns (name, file contents) of up to `max_images` images from
+  `image_dir`, in name order, or synthetic images if `image_dir` is empty.
+  """
+  if len(image_dir) == 0:
+    return [
+      ("synthetic_{}.jpg".format(seed),
+       bench_util.encode_image(bench_util.synthetic_image(480, 640, seed),
+                               "JPEG"))
+      for seed in range(_NUM_SYNTHETIC_IMAGES)
+    ]
+  return util.read_image_dir(image_dir, max_images)
+
+
+def _dir_size(path):
+  # type: (str) -> int
+  total = 0
+  for dir_path, _, file_names in os.walk(path):
+    total += sum(os.path.getsize(os.path.join(dir_path, n))
+                 for n in file_names)
+  return total
+
+
+def _measure(model_dir, images, threshold, num_iterations):
+  # type: (str, List[bytes], float, int) -> Dict[str, Any]
+  """
+  Body of the child process that measures one model.
+  """
+  is_tflite = os.path.exists(os.path.join(
+    model_dir, inference_request.TFLITE_MODEL_FILE_NAME))
+  start = time.perf_counter()
+  if is_tflite:
+    tflite_runner = inference_request.TFLiteRunner(model_dir)
+    run = tflite_runner.run
+  else:
+    sess, graph, meta_graph = inference_request.load_saved_model(model_dir)
+    runners = {
+      name: inference_request.LocalTFRunner(sess, graph, signature)
+      for name, signature in meta_graph.signature_def.items()
+    }
+
+    def run(request):
+      runners[request.signature_name].run(request)
+  load_secs = time.perf_counter() - start
+  odh = (handlers.TFLiteObjectDetectorHandlers(tflite_runner.constants)
+         if is_tflite else handlers.ObjectDetectorHandlers())
+
+  def score(image):
+    request = inference_request.InferenceRequest()
+    request.raw_inputs = {"image": image, "threshold": threshold}
+    odh.pre_process(request)
+    run(request)
+    odh.post_process(request)
+    return request.processed_outputs["predictions"]
+
+  start = time.perf_counter()
+  predictions = [score(images[0])]
+  first_request_secs = time.perf_counter() - start
+  predictions.extend(score(i) for i in images[1:])
+
+  latencies = []
+  for _ in range(num_iterations):
+    for image in images:
+      start = time.perf_counter()
+      score(image)
+      latencies.append(time.perf_counter() - start)
+  if not is_tflite:
+    sess.close()
+
+  # ru_maxrss is in kilobytes on Linux
+  peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return {
+    "load_secs": load_secs,
+    "first_request_secs": first_request_secs,
+    "latency": bench_util.latency_summary(latencies),
+    "peak_rss_bytes": peak_rss_kb * 1024,
+    "predictions": predictions,
+  }
+
+
+def main(_):
+  images = _load_images(FLAGS.image_dir, FLAGS.max_images)
+  if len(FLAGS.image_dir) == 0:
+    print("WARNING: No --image_dir given; using synthetic images. Agreement "
+          "numbers will not be meaningful.")
+  print("Comparing models on {} images".format(len(images)))
+
+  # TensorFlow doesn't survive fork(), and we want a fresh process per
+  # model anyway.
+  ctx = multiprocessing.get_context("spawn")
+  results = []
+  print("{:<28} {:>8} {:>8} {:>9} {:>8} {:>8} {:>7} {:>7} {:>7} {:>7}"
+        "".format("model", "size MB", "load s", "first s", "p50 ms",
+                  "p99 ms", "recall", "prec.", "labels", "IoU"))
+  reference_predictions = None
+  for model_dir in [FLAGS.reference_dir] + FLAGS.candidate_dirs:
+    if not os.path.isdir(model_dir):
+      if model_dir == FLAGS.reference_dir:
+        raise ValueError("Reference SavedModel {} not found"
+                         "".format(model_dir))
+      print("Skipping {}, which doesn't exist".format(model_dir))
+      continue
+    with ctx.Pool(1) as pool:
+      r = pool.apply(_measure, (model_dir, [i for _, i in images],
+                                FLAGS.threshold, FLAGS.num_iterations))
+    r["model_dir"] = model_dir
+    r["size_bytes"] = _dir_size(model_dir)
+    if reference_predictions is None:
+      reference_predictions = r["predictions"]
+    r["agreement"] = bench_util.detection_agreement(
+      reference_predictions, r["predictions"], FLAGS.iou_threshold)
+    results.append(r)
+    a = r["agreement"]
+    print("{:<28} {:>8.1f} {:>8.2f} {:>9.2f} {:>8.1f} {:>8.1f} {:>7.3f} "
+          "{:>7.3f} {:>7.3f} {:>7.3f}".format(
+            model_dir[-28:], r["size_bytes"] / 1e6, r["load_secs"],
+            r["first_request_secs"], r["latency"]["p50_ms"],
+            r["latency"]["p99_ms"], a["recall"], a["precision"],
+            a["label_agreement"], a["mean_iou"]))
+  print("Agreement columns compare each model with the first one.")
+
+  output_dir = os.path.dirname(FLAGS.output)
+  if len(output_dir) > 0 and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  with open(FLAGS.output, "w") as f:
+    json.dump({
+      "environment": {
+        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+        "tensorflow_version": tf.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "image_dir": FLAGS.image_dir,
+        "image_names": [n for n, _ in images],
+        "threshold": FLAGS.threshold,
+        "iou_threshold": FLAGS.iou_threshold,
+      },
+      "results": results
+    }, f, indent=2)
+  print("Results written to {}".format(FLAGS.output))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,283 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Offline end-to-end benchmark of the built SavedModel.
+
+Generates a deterministic corpus of synthetic JPEG, PNG, and GIF images at
+several resolutions, so it needs no network access, and scores every image
+one at a time, in two ways:
+* End to end, exactly as `test_local.py` does: `pre_process()`, one run of
+  the whole graph, `post_process()`, and JSON encoding of the result.
+* Stage by stage, by feeding and fetching the tensors at the boundaries
+  between the parts of the graph that build_graph.py grafts together:
+    base64_decode: base64 text to image file (`image_bytes`)
+    image_decode:  image file to resized pixels (`image_tensor_preprocessed`)
+    detector:      pixels to the SSD's raw outputs (`__original__*`)
+    label_lookup:  thresholding and hash table lookup of class names
+  followed by the Python `post_process()` and JSON encoding. The stages
+  add up to somewhat more than the end-to-end time, since each boundary
+  copies tensors in and out of TensorFlow.
+
+Each combination of format and resolution runs in a fresh process, so that
+peak resident set size is measured per combination. Reports latency
+percentiles for every stage and for the whole request, throughput, and
+peak RSS, and writes everything, along with a description of the build and
+the host, to a JSON file that can be compared across builds.
+
+Requires the SavedModel from build_graph.py. To run this script from the
+root of the project, type:
+   env/bin/python -m benchmarks.end_to_end --output=./temp/end_to_end.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+# Local imports
+from benchmarks import bench_util
+import common.inference_request as inference_request
+import handlers
+
+# System imports
+import base64
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+import tensorflow as tf
+
+tf.flags.DEFINE_string("saved_model_dir", "./saved_model",
+                       "Location of the SavedModel to benchmark")
+tf.flags.DEFINE_list("formats", ["JPEG", "PNG", "GIF"],
+                     "Image file formats to include in the corpus")
+tf.flags.DEFINE_list("resolutions", ["240x320", "480x640", "1080x1920",
+                                     "3024x4032"],
+                     "Image resolutions, as <height>x<width>, to include in "
+                     "the corpus")
+tf.flags.DEFINE_integer("images_per_config", 4,
+                        "Number of distinct images of each format and "
+                        "resolution")
+tf.flags.DEFINE_integer("num_iterations", 5,
+                        "Number of timed passes over the images of each "
+                        "format and resolution")
+tf.flags.DEFINE_float("threshold", 0.5, "Detection threshold of every request")
+tf.flags.DEFINE_string("output", "./temp/end_to_end.json",
+                       "Path of the JSON file to write results to")
+FLAGS = tf.flags.FLAGS
+
+# Tensors at the boundaries between stages of the graph. build_graph.py
+# grafts the pre- and post-processing graphs from `GraphGenerators` onto the
+# detector, and `graph_util.add_postprocessing()` renames each of the
+# detector's original output ops to "__original__<name>".
+_BASE64_TENSOR = "image_tensor:0"
+_IMAGE_FILE_TENSOR = "image_bytes:0"
+_PIXELS_TENSOR = "image_tensor_preprocessed:0"
+_THRESHOLD_TENSOR = "threshold:0"
+_OUTPUT_NAMES = ["detection_boxes", "detection_classes", "detection_scores",
+                 "num_detections"]
+_DETECTOR_OUTPUT_PREFIX = "__original__"
+
+_STAGES = ["base64_decode", "image_decode", "detector", "label_lookup",
+           "post_process", "json_encode"]
+
+_WARMUP_PASSES = 1
+
+
+def _corpus(image_format, height, width, num_images):
+  # type: (str, int, int, int) -> List[bytes]
+  """
+  Deterministic synthetic image files; the same arguments always produce
+  the same files.
+  """
+  return [
+    bench_util.encode_image(bench_util.synthetic_image(height, width, seed),
+                            image_format)
+    for seed in range(num_images)
+  ]
+
+
+def _saved_model_fingerprint(saved_model_dir):
+  # type: (str) -> str
+  """
+  SHA-256 of the SavedModel's graph, to tell builds apart in results.
+  """
+  h = hashlib.sha256()
+  for name in ["saved_model.pb", "saved_model.pbtxt"]:
+    path = os.path.join(saved_model_dir, name)
+    if os.path.exists(path):
+      with open(path, "rb") as f:
+        h.update(f.read())
+  return h.hexdigest()
+
+
+def _measure(saved_model_dir, image_format, height, width, num_images,
+             num_iterations, threshold):
+  # type: (str, str, int, int, int, int, float) -> Dict[str, Any]
+  """
+  Body of the child process that measures one format and resolution.
+  """
+  images = _corpus(image_format, height, width, num_images)
+  b64_images = [base64.urlsafe_b64encode(i).decode("utf-8") for i in images]
+
+  # ru_maxrss is in kilobytes on Linux
+  start_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  sess, graph, meta_graph = inference_request.load_saved_model(
+    saved_model_dir)
+  loaded_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  runner = inference_request.LocalTFRunner(
+    sess, graph, meta_graph.signature_def["serving_default"])
+  odh = handlers.ObjectDetectorHandlers()
+
+  def tensors(names):
+    return [graph.get_tensor_by_name(n) for n in names]
+
+  detector_outputs = [_DETECTOR_OUTPUT_PREFIX + n + ":0"
+                      for n in _OUTPUT_NAMES]
+  base64_decode = sess.make_callable(
+    tensors([_IMAGE_FILE_TENSOR]), feed_list=tensors([_BASE64_TENSOR]))
+  image_decode = sess.make_callable(
+    tensors([_PIXELS_TENSOR]), feed_list=tensors([_IMAGE_FILE_TENSOR]))
+  detector = sess.make_callable(
+    tensors(detector_outputs), feed_list=tensors([_PIXELS_TENSOR]))
+  label_lookup = sess.make_callable(
+    tensors([n + ":0" for n in _OUTPUT_NAMES]),
+    feed_list=tensors(detector_outputs + [_THRESHOLD_TENSOR]))
+
+  def make_request(b64_image):
+    request = inference_request.InferenceRequest()
+    request.raw_inputs = {"image": b64_image, "threshold": threshold}
+    return request
+
+  def end_to_end(b64_image):
+    request = make_request(b64_image)
+    odh.pre_process(request)
+    runner.run(request)
+    odh.post_process(request)
+    return request.json_result(compact=True)
+
+  def staged(b64_image, stage_latencies):
+    def timed(stage, fn, *args):
+      start = time.perf_counter()
+      result = fn(*args)
+      stage_latencies[stage].append(time.perf_counter() - start)
+      return result
+
+    request = make_request(b64_image)
+    odh.pre_process(request)
+    image_files, = timed("base64_decode", base64_decode,
+                         request.processed_inputs["image_tensor"])
+    pixels, = timed("image_decode", image_decode, image_files)
+    raw = timed("detector", detector, pixels)
+    outputs = timed("label_lookup", label_lookup, *(raw + [threshold]))
+    request.raw_outputs = dict(zip(_OUTPUT_NAMES, outputs))
+    timed("post_process", odh.post_process, request)
+    timed("json_encode", request.json_result, True)
+
+  stage_latencies = {s: [] for s in _STAGES}  # type: Dict[str, List[float]]
+  end_to_end_latencies = []
+  for i in range(_WARMUP_PASSES + num_iterations):
+    if i == _WARMUP_PASSES:
+      stage_latencies = {s: [] for s in _STAGES}
+      end_to_end_latencies = []
+    for b64_image in b64_images:
+      staged(b64_image, stage_latencies)
+    for b64_image in b64_images:
+      start = time.perf_counter()
+      end_to_end(b64_image)
+      end_to_end_latencies.append(time.perf_counter() - start)
+  sess.close()
+  peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  return {
+    "format": image_format,
+    "height": height,
+    "width": width,
+    "num_images": num_images,
+    "mean_file_bytes": sum(len(i) for i in images) / len(images),
+    "stages": {s: bench_util.latency_summary(stage_latencies[s])
+               for s in _STAGES},
+    "end_to_end": bench_util.latency_summary(end_to_end_latencies),
+    "images_per_sec": len(end_to_end_latencies) / sum(end_to_end_latencies),
+    "peak_rss_bytes": peak_rss_kb * 1024,
+    "model_load_rss_growth_bytes": (loaded_rss_kb - start_rss_kb) * 1024,
+    "inference_rss_growth_bytes": (peak_rss_kb - loaded_rss_kb) * 1024,
+  }
+
+
+def _environment():
+  # type: () -> Dict[str, Any]
+  return {
+    "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+    "saved_model_dir": os.path.abspath(FLAGS.saved_model_dir),
+    "saved_model_sha256": _saved_model_fingerprint(FLAGS.saved_model_dir),
+    "tensorflow_version": tf.__version__,
+    "python_version": platform.python_version(),
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "cpu_count": os.cpu_count(),
+    "flags": {
+      "formats": FLAGS.formats,
+      "resolutions": FLAGS.resolutions,
+      "images_per_config": FLAGS.images_per_config,
+      "num_iterations": FLAGS.num_iterations,
+      "threshold": FLAGS.threshold,
+    },
+  }
+
+
+def main(_):
+  # TensorFlow doesn't survive fork(), and we want a fresh process per
+  # measurement anyway.
+  ctx = multiprocessing.get_context("spawn")
+  results = []
+  print(("{:>5} {:>10} {:>9}" + " {:>9}" * len(_STAGES)
+         + " {:>9} {:>9} {:>9} {:>9} {:>9}").format(
+    "fmt", "size", "file KB", *[s[:9] for s in _STAGES],
+    "e2e p50", "e2e p95", "e2e p99", "images/s", "RSS MB"))
+  for resolution in FLAGS.resolutions:
+    height, width = [int(d) for d in resolution.split("x")]
+    for image_format in FLAGS.formats:
+      with ctx.Pool(1) as pool:
+        r = pool.apply(_measure, (
+          FLAGS.saved_model_dir, image_format.upper(), height, width,
+          FLAGS.images_per_config, FLAGS.num_iterations, FLAGS.threshold))
+      results.append(r)
+      print(("{:>5} {:>10} {:>9.1f}" + " {:>9.2f}" * len(_STAGES)
+             + " {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>9.0f}").format(
+        r["format"], resolution, r["mean_file_bytes"] / 1e3,
+        *[r["stages"][s]["p50_ms"] for s in _STAGES],
+        r["end_to_end"]["p50_ms"], r["end_to_end"]["p95_ms"],
+        r["end_to_end"]["p99_ms"], r["images_per_sec"],
+        r["peak_rss_bytes"] / 1e6))
+  print("Stage columns are median milliseconds per image.")
+
+  output_dir = os.path.dirname(FLAGS.output)
+  if len(output_dir) > 0 and not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  with open(FLAGS.output, "w") as f:
+    json.dump({"environment": _environment(), "results": results}, f,
+              indent=2)
+  print("Results written to {}".format(FLAGS.output))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,153 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Microbenchmark for the JSON tensor codec in `InferenceRequest`.
+
+Measures the three JSON conversions on the Watson V3 scoring path, at
+several batch sizes, with synthetic model outputs of 100 detections per
+image:
+* Encoding raw outputs as a Watson V3 "keyed_values" response: nested lists
+  from `value_to_json()` through `json.dumps()`, versus `to_json_text()`.
+* Decoding that response: `np.array()` on the parsed lists, versus
+  `json_to_value()` with the dtypes and shapes from
+  `ObjectDetectorHandlers.output_specs()`.
+* Writing the processed outputs: `json_result()` versus
+  `json_result(compact=True)`.
+Doesn't need a built model.
+
+To run this script from the root of the project, type:
+   env/bin/python -m benchmarks.json_codec
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict
+
+# Local imports
+from benchmarks import bench_util
+from common.inference_request import InferenceRequest
+import handlers
+
+# System imports
+import json
+import numpy as np
+
+_NUM_DETECTIONS = 100
+_BATCH_SIZES = [1, 8, 32]
+_NUM_ITERATIONS = 100
+_THRESHOLD = 0.5
+_LABELS = ["person", "bicycle", "car", "bear", "dog", "kite"]
+
+
+def _make_raw_outputs(batch_size):
+  # type: (int) -> Dict[str, np.ndarray]
+  """
+  Synthetic outputs shaped like those of the model. Labels are str rather
+  than bytes, as they are after a round trip through JSON.
+  """
+  rng = np.random.RandomState(42)
+  scores = rng.beta(0.1, 2.0, size=(batch_size, _NUM_DETECTIONS))
+  labels = np.empty((batch_size, _NUM_DETECTIONS), dtype=np.object_)
+  labels[:] = [[_LABELS[i % len(_LABELS)] for i in range(_NUM_DETECTIONS)]]
+  return {
+    "detection_boxes": rng.uniform(
+      size=(batch_size, _NUM_DETECTIONS, 4)).astype(np.float32),
+    "detection_scores": -np.sort(-scores, axis=1).astype(np.float32),
+    "detection_classes": labels,
+    "num_detections": np.full([batch_size], _NUM_DETECTIONS,
+                              dtype=np.float32),
+  }
+
+
+def _legacy_encode(raw_outputs):
+  # type: (Dict[str, np.ndarray]) -> str
+  return json.dumps({
+    "keyed_values": [
+      {"key": k, "values": InferenceRequest.value_to_json(v)}
+      for k, v in raw_outputs.items()
+    ]
+  })
+
+
+def _codec_encode(raw_outputs):
+  # type: (Dict[str, np.ndarray]) -> str
+  return InferenceRequest.to_json_text({
+    "keyed_values": [
+      {"key": k, "values": v} for k, v in raw_outputs.items()
+    ]
+  })
+
+
+def _decode(text, output_specs, batch_size):
+  # type: (str, Dict[str, Dict[str, Any]], int) -> InferenceRequest
+  request = InferenceRequest()
+  request.raw_input_batch = [{"threshold": _THRESHOLD}] * batch_size
+  request.set_raw_outputs_from_watson_v3(json.loads(text), output_specs)
+  return request
+
+
+def main():
+  odh = handlers.ObjectDetectorHandlers()
+  output_specs = odh.output_specs()
+  print("{:>6} {:>16} {:>12} {:>12} {:>12} {:>9}".format(
+    "batch", "step", "old (ms)", "new (ms)", "speedup", "size"))
+  for batch_size in _BATCH_SIZES:
+    raw_outputs = _make_raw_outputs(batch_size)
+
+    legacy_text = _legacy_encode(raw_outputs)
+    codec_text = _codec_encode(raw_outputs)
+    legacy_request = _decode(legacy_text, None, batch_size)
+    codec_request = _decode(codec_text, output_specs, batch_size)
+
+    # The codec must preserve every value exactly, and must give
+    # post-processing the same results.
+    for k, v in raw_outputs.items():
+      if not np.array_equal(codec_request.raw_outputs[k], v):
+        raise ValueError("Output '{}' changed in round trip".format(k))
+      if codec_request.raw_outputs[k].dtype != v.dtype:
+        raise ValueError("Output '{}' decoded as {} instead of {}".format(
+          k, codec_request.raw_outputs[k].dtype, v.dtype))
+    odh.post_process(legacy_request)
+    odh.post_process(codec_request)
+    if (json.loads(codec_request.json_result(compact=True))
+            != json.loads(legacy_request.json_result())):
+      raise ValueError("Post-processing results differ at batch size {}"
+                       "".format(batch_size))
+
+    rows = [
+      ("encode", lambda: _legacy_encode(raw_outputs),
+       lambda: _codec_encode(raw_outputs),
+       "{:.0f}%".format(100.0 * len(codec_text) / len(legacy_text))),
+      ("decode", lambda: _decode(legacy_text, None, batch_size),
+       lambda: _decode(codec_text, output_specs, batch_size), ""),
+      ("json_result", legacy_request.json_result,
+       lambda: codec_request.json_result(compact=True),
+       "{:.0f}%".format(
+         100.0 * len(codec_request.json_result(compact=True))
+         / len(legacy_request.json_result()))),
+    ]
+    for step, legacy_fn, codec_fn, size in rows:
+      legacy = bench_util.time_fn(legacy_fn, _NUM_ITERATIONS)
+      codec = bench_util.time_fn(codec_fn, _NUM_ITERATIONS)
+      print("{:>6} {:>16} {:>12.3f} {:>12.3f} {:>11.1f}x {:>9}".format(
+        batch_size, step, legacy["p50_ms"], codec["p50_ms"],
+        legacy["p50_ms"] / codec["p50_ms"], size))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,162 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Benchmark of the preprocessing graph on small and large images.
+
+Compares the preprocessing graph from `GraphGenerators.pre_processing_graph`,
+which shrinks each image before handing it to the detector, against a
+full-size decode of the image like the one the graph originally performed.
+For each combination of graph and image, reports latency, the largest
+single tensor that the graph allocates, and how much the process's peak
+resident set size grows while running the graph. Each combination runs in
+a fresh process so that peak memory measurements don't interfere with each
+other. Doesn't need a built model.
+
+To run this script from the root of the project, type:
+   env/bin/python -m benchmarks.preprocessing
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, Tuple
+
+# Local imports
+from benchmarks import bench_util
+import handlers
+
+# System imports
+import base64
+import json
+import multiprocessing
+import resource
+import tensorflow as tf
+
+tf.flags.DEFINE_integer("num_iterations", 20,
+                        "Number of timed runs of each graph on each image")
+tf.flags.DEFINE_string("output", None,
+                       "Optional path of a JSON file to write results to")
+FLAGS = tf.flags.FLAGS
+
+# (name, height, width, file format)
+_IMAGES = [
+  ("small JPEG", 480, 640, "JPEG"),
+  ("large JPEG", 4000, 6000, "JPEG"),
+  ("small PNG", 480, 640, "PNG"),
+  ("large PNG", 4000, 6000, "PNG"),
+]
+_GRAPHS = ["full-size decode", "downscaling"]
+
+
+def _full_size_decode_graph():
+  # type: () -> tf.Graph
+  """
+  The original preprocessing graph, which decodes a single image at full
+  resolution and hands it to the detector as is.
+  """
+  g = tf.Graph()
+  with g.as_default():
+    raw_image = tf.placeholder(tf.string, name="image_tensor")
+    binary_image = tf.io.decode_base64(raw_image)
+    _ = tf.image.decode_gif(binary_image, name="image_tensor_preprocessed")
+  return g
+
+
+def _largest_tensor_bytes(run_metadata):
+  # type: (tf.RunMetadata) -> int
+  """
+  Size of the largest output tensor that any op allocated during a traced
+  run.
+  """
+  result = 0
+  for dev_stats in run_metadata.step_stats.dev_stats:
+    for node_stats in dev_stats.node_stats:
+      for output in node_stats.output:
+        result = max(result, output.tensor_description.allocation_description
+                     .requested_bytes)
+  return result
+
+
+def _measure(graph_name, image_spec, num_iterations):
+  # type: (str, Tuple[str, int, int, str], int) -> Dict[str, Any]
+  """
+  Body of the child process that measures one graph on one image.
+  """
+  _, height, width, image_format = image_spec
+  image_file = bench_util.encode_image(
+    bench_util.synthetic_image(height, width), image_format)
+  b64_image = base64.urlsafe_b64encode(image_file).decode("utf-8")
+
+  if graph_name == "full-size decode":
+    graph = _full_size_decode_graph()
+    feed_value = b64_image
+  else:
+    graph = handlers.GraphGenerators().pre_processing_graph()
+    feed_value = [b64_image]
+  input_tensor = graph.get_tensor_by_name("image_tensor:0")
+  output_tensor = graph.get_tensor_by_name("image_tensor_preprocessed:0")
+
+  with tf.Session(graph=graph) as sess:
+    # ru_maxrss is in kilobytes on Linux
+    baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    run_metadata = tf.RunMetadata()
+    output_shape = sess.run(
+      output_tensor, feed_dict={input_tensor: feed_value},
+      options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+      run_metadata=run_metadata).shape
+    latency = bench_util.time_fn(
+      lambda: sess.run(output_tensor, feed_dict={input_tensor: feed_value}),
+      num_iterations, num_warmup=1)
+
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return {
+    "file_bytes": len(image_file),
+    "output_shape": list(output_shape),
+    "latency": latency,
+    "largest_tensor_bytes": _largest_tensor_bytes(run_metadata),
+    "peak_rss_growth_bytes": (peak_rss_kb - baseline_rss_kb) * 1024,
+  }
+
+
+def main(_):
+  # TensorFlow doesn't survive fork(), and we want a fresh process per
+  # measurement anyway.
+  ctx = multiprocessing.get_context("spawn")
+  results = []
+  print("{:>12} {:>18} {:>12} {:>16} {:>16}".format(
+    "image", "graph", "p50 (ms)", "largest tensor", "peak RSS growth"))
+  for image_spec in _IMAGES:
+    for graph_name in _GRAPHS:
+      with ctx.Pool(1) as pool:
+        result = pool.apply(_measure, (graph_name, image_spec,
+                                       FLAGS.num_iterations))
+      result["image"] = image_spec[0]
+      result["graph"] = graph_name
+      results.append(result)
+      print("{:>12} {:>18} {:>12.1f} {:>13.1f} MB {:>13.1f} MB".format(
+        image_spec[0], graph_name, result["latency"]["p50_ms"],
+        result["largest_tensor_bytes"] / 1e6,
+        result["peak_rss_growth_bytes"] / 1e6))
+  if FLAGS.output is not None:
+    with open(FLAGS.output, "w") as f:
+      json.dump(results, f, indent=2)
+    print("Results written to {}".format(FLAGS.output))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,164 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Throughput of `serve_local.ReplicatedModelServer` as a function of the
+number of replicas, with and without pinning replicas to disjoint groups of
+cores.
+
+For each number of replicas, starts that many worker processes, each with
+its own copy of the model and a session that uses an equal share of the
+cores. Pinned replicas get their share from `replica_pool.core_groups()`,
+which keeps each group within one NUMA node where possible; unpinned
+replicas only get smaller thread pools and leave placement to the OS. The
+script then sends binary JPEG uploads to `/model/predict` from a closed
+loop of client threads in this process (two per replica by default, so
+that every replica has a request queued behind the one it's working on).
+The requests bypass HTTP but otherwise take the same path as they do in
+the server, including the trip through shared memory. Reports throughput
+in images per second, its ratio to the throughput of the first
+configuration (by default a single unpinned replica, i.e. one session on
+every core), and median and tail latency.
+
+Requires the SavedModel from build_graph.py; takes the location of the
+model from serve_local.py's `--saved_model_dir` flag. To run this script
+from the root of the project, type:
+   env/bin/python -m benchmarks.replica_scaling --num_replicas=1,2,4,8 \\
+       --pin=false,true
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict
+
+# Local imports
+from benchmarks import bench_util
+from common import replica_pool
+import common.inference_request as inference_request
+import serve_local
+
+# System imports
+import json
+import os
+import threading
+import time
+import tensorflow as tf
+
+tf.flags.DEFINE_list("num_replicas", ["1", "2", "4"],
+                     "Numbers of replicas to try")
+tf.flags.DEFINE_list("pin", ["false"],
+                     "Whether to pin replicas to groups of cores; give "
+                     "\"false,true\" to try both")
+tf.flags.DEFINE_integer("clients_per_replica", 2,
+                        "Number of concurrent client threads per replica")
+tf.flags.DEFINE_integer("requests_per_client", 20,
+                        "Number of timed requests that each client thread "
+                        "sends")
+tf.flags.DEFINE_string("output", None,
+                       "Optional path of a JSON file to write results to")
+FLAGS = tf.flags.FLAGS
+
+
+def _measure(num_replicas, pin, image, num_clients, requests_per_client):
+  # type: (int, bool, bytes, int, int) -> Dict[str, Any]
+  if pin:
+    # Thread pools default to the size of each replica's group.
+    cpu_sets = replica_pool.core_groups(num_replicas)
+    config = inference_request.session_config()
+  else:
+    cpu_sets = None
+    config = inference_request.session_config(
+      max(1, os.cpu_count() // num_replicas), 0)
+  server = serve_local.ReplicatedModelServer(
+    num_replicas, cpu_sets,
+    saved_model_dir=FLAGS.saved_model_dir,
+    model_name=FLAGS.model_name,
+    config=config)
+
+  def predict():
+    status, _, payload = server.max_predict_http(
+      image, "application/octet-stream", "threshold=0.5", None)
+    if status != 200:
+      raise ValueError("Request failed with status {}: {}".format(
+        status, payload))
+
+  try:
+    # Warm up every replica
+    for _ in range(3 * num_replicas):
+      predict()
+
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def client():
+      my_latencies = []
+      for _ in range(requests_per_client):
+        start = time.perf_counter()
+        predict()
+        my_latencies.append(time.perf_counter() - start)
+      with latencies_lock:
+        latencies.extend(my_latencies)
+
+    clients = [threading.Thread(target=client) for _ in range(num_clients)]
+    start = time.perf_counter()
+    for c in clients:
+      c.start()
+    for c in clients:
+      c.join()
+    elapsed = time.perf_counter() - start
+  finally:
+    server.close()
+
+  result = {
+    "num_replicas": num_replicas,
+    "pinned": pin,
+    "num_clients": num_clients,
+    "images_per_sec": len(latencies) / elapsed,
+  }
+  result.update(bench_util.latency_summary(latencies))
+  return result
+
+
+def main(_):
+  image = bench_util.encode_image(bench_util.synthetic_image(480, 640),
+                                  "JPEG")
+  print("{} cores".format(os.cpu_count()))
+  print("{:>9} {:>7} {:>8} {:>12} {:>8} {:>10} {:>10}".format(
+    "replicas", "pinned", "clients", "images/sec", "speedup", "p50 (ms)",
+    "p99 (ms)"))
+  results = []
+  for num_replicas in [int(n) for n in FLAGS.num_replicas]:
+    for pin in [p.lower() in ("true", "1", "yes") for p in FLAGS.pin]:
+      r = _measure(num_replicas, pin, image,
+                   num_replicas * FLAGS.clients_per_replica,
+                   FLAGS.requests_per_client)
+      r["speedup"] = r["images_per_sec"] / (
+        results[0]["images_per_sec"] if len(results) > 0
+        else r["images_per_sec"])
+      print("{:>9} {:>7} {:>8} {:>12.1f} {:>7.2f}x {:>10.1f} {:>10.1f}"
+            "".format(r["num_replicas"], str(r["pinned"]), r["num_clients"],
+                      r["images_per_sec"], r["speedup"], r["p50_ms"],
+                      r["p99_ms"]))
+      results.append(r)
+  if FLAGS.output is not None:
+    with open(FLAGS.output, "w") as f:
+      json.dump(results, f, indent=2)
+    print("Results written to {}".format(FLAGS.output))
+
+
+if __name__ == "__main__":
+  tf.app.run()
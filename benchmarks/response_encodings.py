@@ -0,0 +1,95 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Microbenchmark for the response encodings in
+`InferenceRequest.RESPONSE_ENCODINGS`.
+
+For each encoding, measures payload size and the time to post-process
+synthetic model outputs and encode the result, since the "arrays" encoding
+also changes what `ObjectDetectorHandlers.post_process` produces. The
+baseline is the pretty-printed JSON of `json_result()`. Skips msgpack if the
+msgpack package isn't installed. Doesn't need a built model.
+
+To run this script from the root of the project, type:
+   env/bin/python -m benchmarks.response_encodings
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Local imports
+from benchmarks import bench_util
+from common.inference_request import InferenceRequest
+import handlers
+
+_BATCH_SIZES = [1, 8, 32]
+_NUM_ITERATIONS = 200
+_THRESHOLD = 0.5
+
+
+def _encodings():
+  """
+  Names of the encodings to benchmark, with the baseline first.
+  """
+  result = ["pretty json", "json"]
+  try:
+    import msgpack
+    result.append("msgpack")
+  except ImportError:
+    print("msgpack package not installed; skipping msgpack encoding")
+  result.append("arrays")
+  return result
+
+
+def main():
+  odh = handlers.ObjectDetectorHandlers()
+  encodings = _encodings()
+  for distribution_name, score_fn in bench_util.SCORE_DISTRIBUTIONS:
+    print("Scores: {}".format(distribution_name))
+    print("{:>6} {:>12} {:>10} {:>18} {:>9}".format(
+      "batch", "encoding", "bytes", "post+encode (ms)", "speedup"))
+    for batch_size in _BATCH_SIZES:
+      request = bench_util.synthetic_detector_request(batch_size, score_fn,
+                                                      _THRESHOLD)
+      baseline_ms = None
+      for encoding in encodings:
+        if encoding == "pretty json":
+          def post_process_and_encode():
+            request.processed_outputs.clear()
+            odh.post_process(request)
+            return request.json_result().encode("utf-8")
+        else:
+          def post_process_and_encode():
+            request.processed_outputs.clear()
+            odh.post_process(request)
+            return request.encode_result()[0]
+          request.response_encoding = encoding
+
+        payload = post_process_and_encode()
+        if encoding != "pretty json":
+          # Make sure that the payload decodes.
+          InferenceRequest.decode_result(payload, encoding)
+        latency = bench_util.time_fn(post_process_and_encode, _NUM_ITERATIONS)
+        if baseline_ms is None:
+          baseline_ms = latency["p50_ms"]
+        print("{:>6} {:>12} {:>10} {:>18.3f} {:>8.1f}x".format(
+          batch_size, encoding, len(payload), latency["p50_ms"],
+          baseline_ms / latency["p50_ms"]))
+
+
+if __name__ == "__main__":
+  main()
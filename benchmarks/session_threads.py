@@ -0,0 +1,164 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Throughput of concurrent requests on one shared session, as a function of
+the session's thread pool sizes.
+
+For every combination of intra-op and inter-op thread pool size, loads the
+SavedModel into a fresh session (in a fresh process, since TensorFlow
+creates the global thread pools only once per process), then sweeps the
+number of concurrent requests. Each level of concurrency runs that many
+client threads in a closed loop through an
+`inference_request.ConcurrentRunner` with the same number of threads.
+Reports throughput in images per second and median and tail latency.
+
+Requires the SavedModel from build_graph.py. To run this script from the
+root of the project, type:
+   env/bin/python -m benchmarks.session_threads \\
+       --intra_op_threads=1,2,4,0 --inter_op_threads=1,2,0 \\
+       --concurrency=1,2,4,8,16
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+# Local imports
+from benchmarks import bench_util
+import common.inference_request as inference_request
+import handlers
+
+# System imports
+import json
+import multiprocessing
+import os
+import threading
+import time
+import tensorflow as tf
+
+tf.flags.DEFINE_string("saved_model_dir", "./saved_model",
+                       "Location of the SavedModel to benchmark")
+tf.flags.DEFINE_list("intra_op_threads", ["1", "2", "4", "0"],
+                     "Intra-op thread pool sizes to try; 0 means one thread "
+                     "per core")
+tf.flags.DEFINE_list("inter_op_threads", ["1", "2", "0"],
+                     "Inter-op thread pool sizes to try; 0 means one thread "
+                     "per core")
+tf.flags.DEFINE_list("concurrency", ["1", "2", "4", "8", "16"],
+                     "Numbers of concurrent requests to try")
+tf.flags.DEFINE_integer("requests_per_client", 20,
+                        "Number of timed requests that each client thread "
+                        "sends at each level of concurrency")
+tf.flags.DEFINE_string("output", None,
+                       "Optional path of a JSON file to write results to")
+FLAGS = tf.flags.FLAGS
+
+
+def _sweep_concurrency(saved_model_dir, intra_op_threads, inter_op_threads,
+                       concurrency_levels, requests_per_client):
+  # type: (str, int, int, List[int], int) -> List[Dict[str, Any]]
+  """
+  Body of the child process that measures one session configuration.
+  """
+  sess, graph, meta_graph = inference_request.load_saved_model(
+    saved_model_dir,
+    inference_request.session_config(intra_op_threads, inter_op_threads))
+
+  odh = handlers.ObjectDetectorHandlers()
+  template = inference_request.InferenceRequest()
+  template.raw_inputs = {
+    "image": bench_util.encode_image(bench_util.synthetic_image(480, 640),
+                                     "JPEG"),
+    "threshold": 0.5
+  }
+  odh.pre_process(template)
+  runner = inference_request.LocalTFRunner(
+    sess, graph, meta_graph.signature_def[template.signature_name])
+
+  def make_request():
+    request = inference_request.InferenceRequest()
+    request.signature_name = template.signature_name
+    request.processed_inputs.update(template.processed_inputs)
+    return request
+
+  # Warm up, including the creation of the session callable
+  for _ in range(3):
+    runner.run(make_request())
+
+  results = []
+  for concurrency in concurrency_levels:
+    concurrent_runner = inference_request.ConcurrentRunner(runner.run,
+                                                           concurrency)
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def client():
+      my_latencies = []
+      for _ in range(requests_per_client):
+        start = time.perf_counter()
+        concurrent_runner.submit(make_request())
+        my_latencies.append(time.perf_counter() - start)
+      with latencies_lock:
+        latencies.extend(my_latencies)
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for c in clients:
+      c.start()
+    for c in clients:
+      c.join()
+    elapsed = time.perf_counter() - start
+    concurrent_runner.close()
+
+    result = {
+      "intra_op_threads": intra_op_threads,
+      "inter_op_threads": inter_op_threads,
+      "concurrency": concurrency,
+      "images_per_sec": len(latencies) / elapsed,
+    }
+    result.update(bench_util.latency_summary(latencies))
+    results.append(result)
+  sess.close()
+  return results
+
+
+def main(_):
+  print("{} cores".format(os.cpu_count()))
+  print("{:>6} {:>6} {:>12} {:>12} {:>10} {:>10}".format(
+    "intra", "inter", "concurrency", "images/sec", "p50 (ms)", "p99 (ms)"))
+  ctx = multiprocessing.get_context("spawn")
+  all_results = []
+  for intra_op_threads in [int(t) for t in FLAGS.intra_op_threads]:
+    for inter_op_threads in [int(t) for t in FLAGS.inter_op_threads]:
+      with ctx.Pool(1) as pool:
+        results = pool.apply(_sweep_concurrency, (
+          FLAGS.saved_model_dir, intra_op_threads, inter_op_threads,
+          [int(c) for c in FLAGS.concurrency], FLAGS.requests_per_client))
+      for r in results:
+        print("{:>6} {:>6} {:>12} {:>12.1f} {:>10.1f} {:>10.1f}".format(
+          r["intra_op_threads"], r["inter_op_threads"], r["concurrency"],
+          r["images_per_sec"], r["p50_ms"], r["p99_ms"]))
+      all_results.extend(results)
+  if FLAGS.output is not None:
+    with open(FLAGS.output, "w") as f:
+      json.dump(all_results, f, indent=2)
+    print("Results written to {}".format(FLAGS.output))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -28,34 +28,104 @@ as a single dense numpy array of binary pixel data.  The output of the
 original model represents the object type as an integer. This script grafts on
 pre- and post-processing ops to make the input and output format more amenable
 to use in applications. After these ops are added, the resulting graph takes a
-single image file as an input and produces string-valued object labels.
+vector of image files of arbitrary sizes as an input and produces
+string-valued object labels for each image.
 
 To run this script from the root of the project, type:
    env/bin/python build_graph.py
 
-The output SavedModel file will be written to ./saved_model
+The output SavedModel file will be written to ./saved_model, and a version
+of the core model without pre- and post-processing, for TensorFlow.js, to
+./saved_model_js. Use --targets to build only some of these, or to add
+python_quantized, a version of ./saved_model with 8-bit weights, in
+./saved_model_quantized, or python_eightbit, a version whose convolutions
+compute in eight bits, in ./saved_model_eightbit. The latter needs a
+directory of images to calibrate the ranges of its eight-bit values with
+(--calibration_image_dir). The tflite target converts the convolutional
+part of the core model to TensorFlow Lite, in ./tflite_model, for
+inference_request.TFLiteRunner and handlers.TFLiteObjectDetectorHandlers,
+which do the rest of the work in Python. benchmarks/compare_models.py
+compares all of these with the original. The script also writes variants
+of ./saved_model that are specialized for fixed batch sizes
+(--batch_size_variants) and for the image resolution that the
+preprocessing graph produces, to ./saved_model_variants/batch_<size>.
+With the input shapes fixed, the rewrites can fold the parts of the graph
+that only compute shapes.
+serve_local.py --variants_dir picks the variant that matches each request.
 
-The script also creates temporary files in ./temp, including dumps of the 
-graph at various phases of processing.
+The rewrites of the core model are shared by all targets and run once.
+After that, each target is built in its own worker process, in parallel, and
+the script prints how long each stage of the build took.
+
+The outputs of every stage go into a build cache, ./cached_files/build_cache
+by default, keyed by a hash of the stage's inputs. Stages whose inputs
+haven't changed since a previous build are skipped. Pass
+--nouse_build_cache to run every stage.
+
+Pass --dump_graphs=binary or --dump_graphs=text to also write dumps of the
+graph at various phases of processing to ./temp/graph_dumps.
 """
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
+import multiprocessing
+import numpy as np
 import os
 import tensorflow as tf
 import graph_def_editor as gde
 import shutil
-from typing import List
 import tempfile
+import time
+from typing import Any, Dict, List, Tuple
 from tensorflow.tools import graph_transforms
 import textwrap
 
 # Local imports
-from common import graph_util, util, prepost
+from common import build_cache, graph_util, inference_request, util, prepost
 import handlers
 
+tf.flags.DEFINE_list("targets", ["python", "javascript"],
+                     "Deployment targets to build: any of python, "
+                     "javascript, python_quantized, python_eightbit, and "
+                     "tflite")
+tf.flags.DEFINE_integer("build_workers", 0,
+                        "Number of worker processes that build targets in "
+                        "parallel. 0 means one per target; 1 builds every "
+                        "target in the main process.")
+tf.flags.DEFINE_list("batch_size_variants", ["1"],
+                     "Batch sizes for which to build variants of the Python "
+                     "target that are specialized for that batch size and "
+                     "for the input shapes in the model's "
+                     "GraphGen.input_signatures(). Empty for none.")
+tf.flags.DEFINE_string("variants_dir", "./saved_model_variants",
+                       "Directory to write the specialized variants of the "
+                       "Python target to, one subdirectory per batch size")
+tf.flags.DEFINE_enum("dump_graphs", "off", util.DUMP_POLICIES,
+                     "Whether and how to dump the graph after each stage of "
+                     "the build, for debugging: not at all, as binary "
+                     "GraphDefs, or as text GraphDefs without the values of "
+                     "large constants")
+tf.flags.DEFINE_string("dump_dir", "./temp/graph_dumps",
+                       "Directory to write graph dumps to. Dumps of each "
+                       "target go to a subdirectory named after the target.")
+tf.flags.DEFINE_string("build_cache_dir", "./cached_files/build_cache",
+                       "Directory of the cache of intermediate graphs and "
+                       "finished SavedModels from previous builds")
+tf.flags.DEFINE_bool("use_build_cache", True,
+                     "Reuse the outputs of build stages whose inputs haven't "
+                     "changed since a previous build")
+tf.flags.DEFINE_string("calibration_image_dir", "",
+                       "Directory of JPEG, PNG, and GIF images to calibrate "
+                       "the eight-bit ops of the python_eightbit target "
+                       "with. Should look like the images that the model "
+                       "will see in production.")
+tf.flags.DEFINE_integer("num_calibration_images", 100,
+                        "Maximum number of images from "
+                        "--calibration_image_dir to calibrate with")
 FLAGS = tf.flags.FLAGS
 
 
@@ -68,11 +138,151 @@ def _indent(s):
 _HASH_TABLE_INIT_OP_NAME = "hash_table_init"
 _PYTHON_SAVED_MODEL_DIR = "./saved_model"
 _JS_SAVED_MODEL_DIR = "./saved_model_js"
+_QUANTIZED_SAVED_MODEL_DIR = "./saved_model_quantized"
+_EIGHTBIT_SAVED_MODEL_DIR = "./saved_model_eightbit"
+_TFLITE_MODEL_DIR = "./tflite_model"
+
+# Part of every build cache key. Increment when changing this script in a way
+# that changes its outputs, so that builds don't reuse stale cache entries.
+_BUILD_CACHE_VERSION = 1
+
+# Graph Transform Tool rewrites that we apply to the core model after
+# strip_unused_nodes; see `_graph_transforms()`. Together they are the set of
+# transforms recommended in the tool's README under "Optimizing for
+# Deployment".
+_GRAPH_TRANSFORMS = [
+  'remove_nodes(op=Identity, op=CheckNumerics)',
+  'fold_constants(ignore_errors=true)',
+  'fold_batch_norms',
+  'fold_old_batch_norms',
+]
+
+# GraphDef editor rewrites that we apply after the Graph Transform Tool's, in
+# order.
+_GDE_REWRITES = [
+  gde.rewrite.fold_batch_norms,
+  gde.rewrite.fold_old_batch_norms,
+  gde.rewrite.fold_batch_norms_up,
+]
+
+
+def _graph_transforms(input_signatures, batch_size=None):
+  # type: (Dict[str, Dict[str, Any]], int) -> List[str]
+  """
+  Graph Transform Tool rewrites for the core model, starting with a
+  strip_unused_nodes transform that describes each input of the model.
+
+  Args:
+    input_signatures: Output of `GraphGen.input_signatures()`
+    batch_size: Batch size that the graph is specialized for, or None for a
+      graph that takes batches of any size, and images of any size.
+  """
+  names = sorted(input_signatures.keys())
+  args = (["name={}".format(n) for n in names]
+          + ["type_for_name={}".format(input_signatures[n]["dtype"])
+             for n in names])
+  shapes = [[batch_size] + input_signatures[n]["shape"][1:] for n in names]
+  # The tool only takes fully-defined shapes, and wants one for every input
+  # if it gets any.
+  if batch_size is not None and all(d >= 0 for s in shapes for d in s):
+    args.extend('shape_for_name="{}"'.format(",".join(str(d) for d in s))
+                for s in shapes)
+  strip_unused_nodes = ("strip_unused_nodes({})".format(", ".join(args))
+                        if len(args) > 0 else "strip_unused_nodes")
+  return [strip_unused_nodes] + _GRAPH_TRANSFORMS
+
+
+def _specialize_inputs(graph_def, input_shapes, batch_size):
+  # type: (tf.GraphDef, Dict[str, List[int]], int) -> tf.GraphDef
+  """
+  Returns a copy of a graph in which some input placeholders have a more
+  specific shape, so that shape inference and constant folding can work
+  with known dimensions.
+
+  Args:
+    graph_def: Graph whose inputs to specialize
+    input_shapes: New shape of each placeholder to specialize, with -1 for
+      dimensions of unknown size, or None to keep the placeholder's current
+      shape. Either way, the first dimension becomes `batch_size`.
+    batch_size: Batch size that the graph is specialized for
+  """
+  result = tf.GraphDef()
+  result.CopyFrom(graph_def)
+  for node in result.node:
+    if node.name not in input_shapes:
+      continue
+    if node.op != "Placeholder":
+      raise ValueError("Input '{}' is a {} op, not a Placeholder"
+                       "".format(node.name, node.op))
+    shape = input_shapes[node.name]
+    if shape is None:
+      shape = tf.TensorShape(node.attr["shape"].shape).as_list()
+    shape = [batch_size] + [d if d is not None and d >= 0 else None
+                            for d in shape[1:]]
+    node.attr["shape"].shape.CopyFrom(tf.TensorShape(shape).as_proto())
+    # Stale shape annotations would override the new shape downstream.
+    if "_output_shapes" in node.attr:
+      del node.attr["_output_shapes"]
+  return result
 
 
-def _apply_graph_transform_tool_rewrites(g: gde.Graph,
+# Graph Transform Tool rewrites that turn the weights of the core model into
+# 8-bit constants. Each weight tensor of 1024 or more elements becomes a
+# uint8 constant, its range, and a Dequantize op, so the model still
+# computes in float32, but the weights take a quarter of the space.
+_QUANTIZE_WEIGHTS_TRANSFORMS = ["quantize_weights(minimum_size=1024)"]
+
+# Graph Transform Tool rewrites that replace the convolutions of the core
+# model, and the bias adds and activations that follow them, with ops that
+# compute in eight bits. These ops only occur in the feature extractor and
+# the box predictor, so the box decoding and non-maximum suppression stay in
+# float. Every eight-bit op is followed by a RequantizationRange op, which
+# computes the range of its outputs on each run until calibration replaces
+# it with a constant range.
+_QUANTIZE_NODES_TRANSFORMS = _QUANTIZE_WEIGHTS_TRANSFORMS + [
+  "quantize_nodes(op=Conv2D, op=BiasAdd, op=Relu, op=Relu6)",
+]
+
+# Format of the lines that the freeze_requantization_ranges transform reads
+# the ranges of RequantizationRange ops from. The Graph Transform Tool's
+# insert_logging transform prints lines in this format to stderr; we fetch
+# the ranges directly instead.
+_REQUANT_RANGE_LOG_LINE = ";{}__print__;__requant_min_max:[{}][{}]\n"
+
+# Graph Transform Tool rewrite that replaces each RequantizationRange op with
+# the range of its outputs over the calibration images, as recorded in a log
+# file, ignoring the 5% most extreme images at either end.
+_FREEZE_RANGES_TRANSFORM = ('freeze_requantization_ranges(min_max_log_file='
+                            '"{}", min_percentile=5, max_percentile=95)')
+
+# Input of the grafted graph that calibration feeds raw image files into, as
+# the "serving_bytes" signature does.
+_CALIBRATION_INPUT_TENSOR = "image_bytes:0"
+
+
+class _StageTimer(object):
+  """
+  Wall-clock time of each named stage of a build, in the order that the
+  stages ran.
+  """
+
+  def __init__(self):
+    self.stages = []  # type: List[Tuple[str, float]]
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    # type: (str) -> None
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.stages.append((name, time.perf_counter() - start))
+
+
+def _apply_graph_transform_tool_rewrites(graph_def: tf.GraphDef,
                                          input_node_names: List[str],
-                                         output_node_names: List[str]) \
+                                         output_node_names: List[str],
+                                         transforms: List[str]) \
         -> tf.GraphDef:
   """
   Use the [Graph Transform Tool](
@@ -81,232 +291,807 @@ def _apply_graph_transform_tool_rewrites(g: gde.Graph,
   to perform a series of pre-deployment rewrites.
 
   Args:
-     g: GDE representation of the core graph.
+     graph_def: GraphDef representation of the core graph.
      input_node_names: Names of placeholder nodes that are used as inputs to
        the graph for inference. Placeholders NOT on this list will be
        considered dead code.
      output_node_names: Names of nodes that produce tensors that are outputs
        of the graph for inference purposes. Nodes not necessary to produce
        these tensors will be considered dead code.
+     transforms: Transforms to apply, from `_graph_transforms()`
 
   Returns: GraphDef representation of rewritten graph.
   """
   # Invoke the Graph Transform Tool using the undocumented Python APIs under
   # tensorflow.tools.graph_transforms
   after_tf_rewrites_graph_def = graph_transforms.TransformGraph(
-    g.to_graph_def(),
+    graph_def,
     inputs=input_node_names,
     outputs=output_node_names,
-    # Use the set of transforms recommended in the README under "Optimizing
-    # for Deployment"
-    transforms=['strip_unused_nodes(type=float, shape="1,299,299,3")',
-                'remove_nodes(op=Identity, op=CheckNumerics)',
-                'fold_constants(ignore_errors=true)',
-                'fold_batch_norms',
-                'fold_old_batch_norms']
+    transforms=transforms
   )
   return after_tf_rewrites_graph_def
 
 
-def _apply_generic_deployment_rewrites(graph, graph_gen, temp_dir):
-  # type: (gde.Graph, prepost.GraphGen, str) -> gde.Graph
+def _apply_generic_deployment_rewrites(
+        frozen_graph_def,  # type: tf.GraphDef
+        graph_gen,  # type: prepost.GraphGen
+        dumper,  # type: util.GraphDumper
+        timer,  # type: _StageTimer
+        cache,  # type: build_cache.BuildCache
+        batch_size=None  # type: int
+):
+  # type: (...) -> Tuple[tf.GraphDef, str]
   """
   Common code to apply general-purpose graph optimization rewrites that
   remove unnecessary portions of the graph in preparation for inference.
 
+  These rewrites only touch the core model, so `main()` runs them once and
+  every target starts from the result. Targets graft on their pre- and
+  post-processing graphs afterwards, which also keeps the Graph Transform
+  Tool away from ops that it would otherwise fold or remove, such as the
+  optional inputs of the postprocessing graph, the hash table initializer,
+  and the "<input>_preprocessed" outputs of the preprocessing graph.
+
   Args:
-    graph: `gde.Graph` object containing the graph after adding any pre/post
-      subgraphs
+    frozen_graph_def: Base starter graph produced by inference, after turning
+      variables to constants but before other rewrites.
     graph_gen: Graph generation callbacks object for the current model
-    temp_dir: Location where this method should write out temp files
+    dumper: Writes intermediate graphs for debugging, if enabled
+    timer: Collects the time that each rewrite takes
+    cache: Cache of the outputs of previous runs of each rewrite stage
+    batch_size: If not None, specialize the graph for this batch size and
+      for the input shapes in `graph_gen.input_signatures()` before
+      rewriting it, so that the rewrites can fold the parts of the graph
+      that only depend on those shapes.
 
-  Returns the modified graph as a `gde.Graph` object
+  Returns a tuple of the rewritten graph as a `tf.GraphDef` protobuf and the
+  build cache key of that graph
   """
-  # Now run through some of TensorFlow's built-in graph rewrites.
-  output_nodes = graph_gen.output_node_names()
+  print("            Number of ops in frozen graph: {}".format(len(
+    frozen_graph_def.node)))
 
-  # Need to treat initializer nodes, if present, as output nodes for the
-  # purposes of the Graph Transform Tool
-  if graph.contains_node(_HASH_TABLE_INIT_OP_NAME):
-    output_nodes.append(_HASH_TABLE_INIT_OP_NAME)
+  input_signatures = graph_gen.input_signatures()
+  if batch_size is not None:
+    with timer.stage("specialize inputs"):
+      frozen_graph_def = _specialize_inputs(
+        frozen_graph_def,
+        {n: s["shape"] for n, s in input_signatures.items()}, batch_size)
 
-  after_tf_rewrites_graph_def = _apply_graph_transform_tool_rewrites(
-    graph, graph_gen.input_node_names(), output_nodes)
-  util.protobuf_to_file(after_tf_rewrites_graph_def,
-                        temp_dir + "/after_tf_rewrites_graph.pbtext",
-                        "Graph after built-in TensorFlow rewrites")
+  # Now run through some of TensorFlow's built-in graph rewrites.
+  transforms = _graph_transforms(input_signatures, batch_size)
+  with timer.stage("hash frozen graph"):
+    tf_rewrites_key = cache.key(
+      frozen_graph_def, transforms, graph_gen.input_node_names(),
+      graph_gen.output_node_names(), tf.__version__, _BUILD_CACHE_VERSION)
+  after_tf_rewrites_graph_def = cache.get_graph_def("after_tf_rewrites",
+                                                    tf_rewrites_key)
+  if after_tf_rewrites_graph_def is not None:
+    print("Reusing cached graph after built-in TensorFlow rewrites")
+  else:
+    with timer.stage("graph transform tool"):
+      after_tf_rewrites_graph_def = _apply_graph_transform_tool_rewrites(
+        frozen_graph_def, graph_gen.input_node_names(),
+        graph_gen.output_node_names(), transforms)
+    cache.put_graph_def("after_tf_rewrites", tf_rewrites_key,
+                        after_tf_rewrites_graph_def)
+    dumper.dump(after_tf_rewrites_graph_def, "after_tf_rewrites_graph",
+                "Graph after built-in TensorFlow rewrites")
 
   print("    Number of ops after built-in rewrites: {}".format(len(
     after_tf_rewrites_graph_def.node)))
 
   # Now run the GraphDef editor's graph prep rewrites
-  g = gde.Graph(after_tf_rewrites_graph_def)
-  gde.rewrite.fold_batch_norms(g)
-  gde.rewrite.fold_old_batch_norms(g)
-  gde.rewrite.fold_batch_norms_up(g)
-  after_gde_graph_def = g.to_graph_def(add_shapes=True)
-  util.protobuf_to_file(after_gde_graph_def,
-                        temp_dir + "/after_gde_rewrites_graph.pbtext",
-                        "Graph after fold_batch_norms_up() rewrite")
+  gde_rewrites_key = cache.key(
+    tf_rewrites_key, [r.__name__ for r in _GDE_REWRITES],
+    getattr(gde, "__version__", ""))
+  after_gde_graph_def = cache.get_graph_def("after_gde_rewrites",
+                                            gde_rewrites_key)
+  if after_gde_graph_def is not None:
+    print("Reusing cached graph after GDE rewrites")
+  else:
+    with timer.stage("gde rewrites"):
+      g = gde.Graph(after_tf_rewrites_graph_def)
+      for rewrite in _GDE_REWRITES:
+        rewrite(g)
+      after_gde_graph_def = g.to_graph_def(add_shapes=True)
+    cache.put_graph_def("after_gde_rewrites", gde_rewrites_key,
+                        after_gde_graph_def)
+    dumper.dump(after_gde_graph_def, "after_gde_rewrites_graph",
+                "Graph after fold_batch_norms_up() rewrite")
 
   print("         Number of ops after GDE rewrites: {}".format(len(
     after_gde_graph_def.node)))
-  return g
+  return after_gde_graph_def, gde_rewrites_key
+
+
+def _graft_pre_and_post(core_graph_def, preproc_graph_def,
+                        postproc_graph_def):
+  # type: (tf.GraphDef, tf.GraphDef, tf.GraphDef) -> tf.GraphDef
+  """
+  Returns a copy of the core model graph with the preprocessing graph
+  grafted onto its beginning and the postprocessing graph onto its end.
+  """
+  g = gde.Graph(core_graph_def)
+  graph_util.add_preprocessing(g, gde.Graph(preproc_graph_def))
+  graph_util.add_postprocessing(g, gde.Graph(postproc_graph_def))
+  return g.to_graph_def()
 
 
-def _make_python_deployable_graph(frozen_graph_def, graph_gen,
-                                  temp_dir, saved_model_location):
-  # type: (tf.GraphDef, prepost.GraphGen, str, str) -> None
+def _make_python_deployable_graph(
+        core_graph_def,  # type: tf.GraphDef
+        core_key,  # type: str
+        graph_gen,  # type: prepost.GraphGen
+        dumper,  # type: util.GraphDumper
+        saved_model_location,  # type: str
+        timer,  # type: _StageTimer
+        cache,  # type: build_cache.BuildCache
+        batch_size=None  # type: int
+):
+  # type: (...) -> None
   """
   Prepare a SavedModel directory with a graph that is deployable via the
   Python or C++ APIs of TensorFlow.
 
   Args:
-    frozen_graph_def: Base starter graph produced by inference, after turning
-      variables to constants but before other rewrites.
+    core_graph_def: Rewritten core model graph, i.e. the output of
+      `_apply_generic_deployment_rewrites()`
+    core_key: Build cache key of `core_graph_def`
     graph_gen: Callback object for current model
-    temp_dir: Temporary directory in which to dump intermediate results in
-      case they are needed for debugging.
+    dumper: Writes intermediate graphs for debugging, if enabled
     saved_model_location: Location where the final output SavedModel should go
+    timer: Collects the time that each stage of the build takes
+    cache: Cache of the outputs of previous builds
+    batch_size: Batch size that `core_graph_def` is specialized for, if any.
+      The inputs of the preprocessing graph get the same batch size.
 
   Returns:
     A graph that has been optimized and augmented with preprocessing and
     postprocessing ops.
   """
-  # Graft the preprocessing and postprocessing graphs onto the beginning and
-  # end of the inference graph.
-  g = gde.Graph(frozen_graph_def)
-
-  preproc_g = gde.Graph(graph_gen.pre_processing_graph())
-  postproc_g = gde.Graph(graph_gen.post_processing_graph())
+  with timer.stage("generate pre/post graphs"):
+    preproc_graph_def = graph_gen.pre_processing_graph().as_graph_def()
+    postproc_graph_def = graph_gen.post_processing_graph().as_graph_def()
+    if batch_size is not None:
+      preproc_graph_def = _specialize_inputs(
+        preproc_graph_def, {n: None for n in graph_gen.input_node_names()},
+        batch_size)
+  graft_key = cache.key(core_key, preproc_graph_def, postproc_graph_def,
+                        _BUILD_CACHE_VERSION)
+  saved_model_key = cache.key(
+    graft_key, graph_gen.input_node_names(),
+    graph_gen.optional_input_node_names(), graph_gen.output_node_names(),
+    graph_gen.alternate_signatures(), tf.__version__, _BUILD_CACHE_VERSION)
+  with timer.stage("copy cached SavedModel"):
+    if cache.get_dir("python_saved_model", saved_model_key,
+                     saved_model_location):
+      print("Cached SavedModel copied to {}".format(saved_model_location))
+      return
 
-  graph_util.add_preprocessing(g, preproc_g)
-  graph_util.add_postprocessing(g, postproc_g)
+  # Graft the preprocessing graph onto the beginning of the inference graph
+  # and the postprocessing graph onto the end.
+  after_add_post_graph_def = cache.get_graph_def("after_pre_and_post",
+                                                 graft_key)
+  if after_add_post_graph_def is not None:
+    print("Reusing cached graph with pre- and post-processing")
+  else:
+    with timer.stage("graft pre/post"):
+      after_add_post_graph_def = _graft_pre_and_post(
+        core_graph_def, preproc_graph_def, postproc_graph_def)
+    cache.put_graph_def("after_pre_and_post", graft_key,
+                        after_add_post_graph_def)
+    dumper.dump(after_add_post_graph_def, "after_pre_and_post",
+                "Graph with pre- and post-processing")
+  print("    Num. ops after adding pre/postprocessing: {}".format(len(
+    after_add_post_graph_def.node)))
 
-  after_add_pre_post_graph_def = g.to_graph_def()
-  util.protobuf_to_file(after_add_pre_post_graph_def,
-                        temp_dir + "/after_pre_and_post.pbtext",
-                        "Graph with pre- and post-processing")
+  # Graph preparation complete. Create a SavedModel "file" (actually a
+  # directory)
+  with timer.stage("write SavedModel"):
+    saved_model_graph = tf.Graph()
+    with saved_model_graph.as_default():
+      with tf.Session() as sess:
+        tf.import_graph_def(after_add_post_graph_def, name="")
 
-  print("            Number of ops in frozen graph: {}".format(len(
-    frozen_graph_def.node)))
-  print(" Num. ops after adding pre- and post-proc: {}".format(len(
-    after_add_pre_post_graph_def.node)))
+        # Recreate the hash table initializers collection, which got wiped
+        # out when we round-tripped the graph through the GraphDef format.
+        hash_table_init_op = saved_model_graph.get_operation_by_name(
+          _HASH_TABLE_INIT_OP_NAME)
+        saved_model_graph.add_to_collection(tf.GraphKeys.TABLE_INITIALIZERS,
+                                            hash_table_init_op)
 
-  g = _apply_generic_deployment_rewrites(g, graph_gen, temp_dir)
+        # Signature builders need pointers to tensors, so pull input and
+        # output tensors out of the graph.
+        optional_inputs_dict = {
+          n: saved_model_graph.get_tensor_by_name(n + ":0")
+          for n in graph_gen.optional_input_node_names()
+        }
+        outputs_dict = {
+          n: saved_model_graph.get_tensor_by_name(n + ":0")
+          for n in graph_gen.output_node_names()
+        }
+        inputs_dicts = {
+          tf.saved_model.DEFAULT_SERVING_SIGNATURE_DEF_KEY: {
+            n: saved_model_graph.get_tensor_by_name(n + ":0")
+            for n in graph_gen.input_node_names()
+          }
+        }
+        for signature_name, inputs in graph_gen.alternate_signatures().items():
+          inputs_dicts[signature_name] = {
+            input_name: saved_model_graph.get_tensor_by_name(tensor_name)
+            for input_name, tensor_name in inputs.items()
+          }
+        signature_def_map = {}
+        for signature_name, inputs_dict in inputs_dicts.items():
+          inputs_dict.update(optional_inputs_dict)
+          signature_def_map[signature_name] = (
+            tf.saved_model.signature_def_utils.predict_signature_def(
+              inputs_dict, outputs_dict))
 
-  # Graph preparation complete. Create a SavedModel "file" (actually a
-  # directory)
-  saved_model_graph = tf.Graph()
-  with saved_model_graph.as_default():
-    with tf.Session() as sess:
-      tf.import_graph_def(g.to_graph_def(), name="")
-
-      # Recreate the hash table initializers collection, which got wiped out
-      # when we round-tripped the graph through the GraphDef format.
-      hash_table_init_op = saved_model_graph.get_operation_by_name(
-        _HASH_TABLE_INIT_OP_NAME)
-      saved_model_graph.add_to_collection(tf.GraphKeys.TABLE_INITIALIZERS,
-                                          hash_table_init_op)
-
-      # simple_save needs pointers to tensors, so pull input and output
-      # tensors out of the graph.
-      inputs_dict = {
-        n: saved_model_graph.get_tensor_by_name(n + ":0")
-        for n in graph_gen.input_node_names()
-      }
-      outputs_dict = {
-        n: saved_model_graph.get_tensor_by_name(n + ":0")
-        for n in graph_gen.output_node_names()
-      }
-      if os.path.isdir(saved_model_location):
-        shutil.rmtree(saved_model_location)
-      tf.saved_model.simple_save(sess,
-                                 export_dir=saved_model_location,
-                                 inputs=inputs_dict,
-                                 outputs=outputs_dict,
-                                 legacy_init_op=hash_table_init_op)
+        # Equivalent to tf.saved_model.simple_save(), but with more than one
+        # signature.
+        if os.path.isdir(saved_model_location):
+          shutil.rmtree(saved_model_location)
+        builder = tf.saved_model.builder.SavedModelBuilder(
+          saved_model_location)
+        builder.add_meta_graph_and_variables(
+          sess,
+          tags=[tf.saved_model.tag_constants.SERVING],
+          signature_def_map=signature_def_map,
+          main_op=hash_table_init_op,
+          clear_devices=True)
+        builder.save()
+  cache.put_dir("python_saved_model", saved_model_key, saved_model_location)
   print("SavedModel written to {}".format(saved_model_location))
 
 
-def _make_javascript_deployable_graph(frozen_graph_def, graph_gen,
-                                      temp_dir, saved_model_location):
-  # type: (tf.GraphDef, prepost.GraphGen, str, str) -> None
+def _make_javascript_deployable_graph(
+        core_graph_def,  # type: tf.GraphDef
+        core_key,  # type: str
+        graph_gen,  # type: prepost.GraphGen
+        dumper,  # type: util.GraphDumper
+        saved_model_location,  # type: str
+        timer,  # type: _StageTimer
+        cache  # type: build_cache.BuildCache
+):
+  # type: (...) -> None
   """
   Prepare a SavedModel directory with a graph that is deployable via
   TensorFlow.js
 
   Args:
-    frozen_graph_def: Base starter graph produced by inference, after turning
-      variables to constants but before other rewrites.
+    core_graph_def: Rewritten core model graph, i.e. the output of
+      `_apply_generic_deployment_rewrites()`
+    core_key: Build cache key of `core_graph_def`
     graph_gen: Callbacks for the current model
-    temp_dir: Temporary directory in which to dump intermediate results in
-      case they are needed for debugging.
+    dumper: Writes intermediate graphs for debugging, if enabled
     saved_model_location: Location where the final output SavedModel should go
+    timer: Collects the time that each stage of the build takes
+    cache: Cache of the outputs of previous builds
 
   Returns:
     A graph that has been optimized. No preprocessing or postprocessing ops
     are attached, as the ops we would like to use for those purposes are not
     currently implemented in TensorFlow.js
   """
-  g = gde.Graph(frozen_graph_def)
-
-  print("            Number of ops in frozen graph: {}".format(len(
-    frozen_graph_def.node)))
+  saved_model_key = cache.key(
+    core_key, graph_gen.input_node_names(), graph_gen.output_node_names(),
+    tf.__version__, _BUILD_CACHE_VERSION)
+  with timer.stage("copy cached SavedModel"):
+    if cache.get_dir("javascript_saved_model", saved_model_key,
+                     saved_model_location):
+      print("Cached SavedModel copied to {}".format(saved_model_location))
+      return
 
-  g = _apply_generic_deployment_rewrites(g, graph_gen, temp_dir)
+  # The core graph needs no further changes, so create a SavedModel "file"
+  # (actually a directory) right away.
+  with timer.stage("write SavedModel"):
+    saved_model_graph = tf.Graph()
+    with saved_model_graph.as_default():
+      with tf.Session() as sess:
+        tf.import_graph_def(core_graph_def, name="")
 
-  # Graph preparation complete. Create a SavedModel "file" (actually a
-  # directory)
-  saved_model_graph = tf.Graph()
-  with saved_model_graph.as_default():
-    with tf.Session() as sess:
-      tf.import_graph_def(g.to_graph_def(), name="")
-
-      # simple_save needs pointers to tensors, so pull input and output
-      # tensors out of the graph.
-      inputs_dict = {
-        n: saved_model_graph.get_tensor_by_name(n + ":0")
-        for n in graph_gen.input_node_names()
-      }
-      outputs_dict = {
-        n: saved_model_graph.get_tensor_by_name(n + ":0")
-        for n in graph_gen.output_node_names()
-      }
-      if os.path.isdir(saved_model_location):
-        shutil.rmtree(saved_model_location)
-      tf.saved_model.simple_save(sess,
-                                 export_dir=saved_model_location,
-                                 inputs=inputs_dict,
-                                 outputs=outputs_dict)
+        # simple_save needs pointers to tensors, so pull input and output
+        # tensors out of the graph.
+        inputs_dict = {
+          n: saved_model_graph.get_tensor_by_name(n + ":0")
+          for n in graph_gen.input_node_names()
+        }
+        outputs_dict = {
+          n: saved_model_graph.get_tensor_by_name(n + ":0")
+          for n in graph_gen.output_node_names()
+        }
+        if os.path.isdir(saved_model_location):
+          shutil.rmtree(saved_model_location)
+        tf.saved_model.simple_save(sess,
+                                   export_dir=saved_model_location,
+                                   inputs=inputs_dict,
+                                   outputs=outputs_dict)
+  cache.put_dir("javascript_saved_model", saved_model_key,
+                saved_model_location)
   print("SavedModel written to {}".format(saved_model_location))
 
 
-def _make_temp_dir():
+def _make_quantized_python_deployable_graph(
+        core_graph_def,  # type: tf.GraphDef
+        core_key,  # type: str
+        graph_gen,  # type: prepost.GraphGen
+        dumper,  # type: util.GraphDumper
+        saved_model_location,  # type: str
+        timer,  # type: _StageTimer
+        cache  # type: build_cache.BuildCache
+):
+  # type: (...) -> None
+  """
+  Same as `_make_python_deployable_graph()`, but with the weights of the
+  core model quantized to 8 bits. Pre- and post-processing are grafted on
+  after quantization and keep their float (and string) constants.
+
+  Args:
+    core_graph_def: Rewritten core model graph, i.e. the output of
+      `_apply_generic_deployment_rewrites()`
+    core_key: Build cache key of `core_graph_def`
+    graph_gen: Callback object for current model
+    dumper: Writes intermediate graphs for debugging, if enabled
+    saved_model_location: Location where the final output SavedModel should go
+    timer: Collects the time that each stage of the build takes
+    cache: Cache of the outputs of previous builds
+  """
+  # Quantizing after the generic rewrites means that batch norms have
+  # already been folded into the weights that we quantize.
+  quantized_key = cache.key(core_key, _QUANTIZE_WEIGHTS_TRANSFORMS,
+                            tf.__version__, _BUILD_CACHE_VERSION)
+  quantized_graph_def = cache.get_graph_def("after_quantize_weights",
+                                            quantized_key)
+  if quantized_graph_def is not None:
+    print("Reusing cached graph with quantized weights")
+  else:
+    with timer.stage("quantize weights"):
+      quantized_graph_def = graph_transforms.TransformGraph(
+        core_graph_def,
+        inputs=graph_gen.input_node_names(),
+        outputs=graph_gen.output_node_names(),
+        transforms=_QUANTIZE_WEIGHTS_TRANSFORMS)
+    cache.put_graph_def("after_quantize_weights", quantized_key,
+                        quantized_graph_def)
+    dumper.dump(quantized_graph_def, "after_quantize_weights",
+                "Graph with quantized weights")
+  print("    Size of core graph before/after quantizing weights: {:.1f}/"
+        "{:.1f} MB".format(core_graph_def.ByteSize() / 1e6,
+                           quantized_graph_def.ByteSize() / 1e6))
+
+  _make_python_deployable_graph(quantized_graph_def, quantized_key,
+                                graph_gen, dumper, saved_model_location,
+                                timer, cache)
+
+
+def _record_requantization_ranges(graph_def, calibration_images, log_file):
+  # type: (tf.GraphDef, List[bytes], str) -> int
   """
-  Wrapper around tempfile so that we can enable/disable deletion of temp
-  directories from a single place
+  Run calibration images through a graph with eight-bit ops, one image at a
+  time, and write the output range of every RequantizationRange op on every
+  run to a log file for the freeze_requantization_ranges transform.
+
+  Args:
+    graph_def: Output of `_QUANTIZE_NODES_TRANSFORMS`, with pre- and
+      post-processing grafted on so that the images go through the same
+      decoding and resizing as in production
+    calibration_images: Image files to run through the graph
+    log_file: Path of the log file to write
+
+  Returns the number of RequantizationRange ops in the graph.
   """
-  _DELETE_TEMP_DIRS = False
-  if _DELETE_TEMP_DIRS:
-    return tempfile.TemporaryDirectory(prefix=".")
+  range_op_names = [n.name for n in graph_def.node
+                    if n.op == "RequantizationRange"]
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name="")
+  fetches = [(graph.get_tensor_by_name(n + ":0"),
+              graph.get_tensor_by_name(n + ":1"))
+             for n in range_op_names]
+  image_input = graph.get_tensor_by_name(_CALIBRATION_INPUT_TENSOR)
+  with tf.Session(graph=graph) as sess, open(log_file, "w") as f:
+    for image in calibration_images:
+      ranges = sess.run(fetches, feed_dict={image_input: [image]})
+      for name, (range_min, range_max) in zip(range_op_names, ranges):
+        f.write(_REQUANT_RANGE_LOG_LINE.format(name, range_min, range_max))
+  return len(range_op_names)
+
+
+def _make_eightbit_python_deployable_graph(
+        core_graph_def,  # type: tf.GraphDef
+        core_key,  # type: str
+        graph_gen,  # type: prepost.GraphGen
+        dumper,  # type: util.GraphDumper
+        saved_model_location,  # type: str
+        timer,  # type: _StageTimer
+        cache,  # type: build_cache.BuildCache
+        calibration_images=None  # type: List[bytes]
+):
+  # type: (...) -> None
+  """
+  Same as `_make_python_deployable_graph()`, but with the convolutions of
+  the core model computing in eight bits, with activation ranges calibrated
+  on a set of representative images. Pre- and post-processing, including
+  image decoding and the label lookup table, stay in float (and string).
+
+  Args:
+    core_graph_def: Rewritten core model graph, i.e. the output of
+      `_apply_generic_deployment_rewrites()`
+    core_key: Build cache key of `core_graph_def`
+    graph_gen: Callback object for current model
+    dumper: Writes intermediate graphs for debugging, if enabled
+    saved_model_location: Location where the final output SavedModel should go
+    timer: Collects the time that each stage of the build takes
+    cache: Cache of the outputs of previous builds
+    calibration_images: Image files to calibrate the activation ranges of
+      the eight-bit ops with
+  """
+  if calibration_images is None or len(calibration_images) == 0:
+    raise ValueError("Eight-bit target needs calibration images")
+  # Calibration runs on the graph that production will run, pre- and
+  # post-processing included, so the calibrated ranges depend on them too.
+  with timer.stage("generate pre/post graphs"):
+    preproc_graph_def = graph_gen.pre_processing_graph().as_graph_def()
+    postproc_graph_def = graph_gen.post_processing_graph().as_graph_def()
+  quantized_key = cache.key(core_key, _QUANTIZE_NODES_TRANSFORMS,
+                            tf.__version__, _BUILD_CACHE_VERSION)
+  calibrated_key = cache.key(quantized_key, _FREEZE_RANGES_TRANSFORM,
+                             preproc_graph_def, postproc_graph_def,
+                             *calibration_images)
+  calibrated_graph_def = cache.get_graph_def("after_calibration",
+                                             calibrated_key)
+  if calibrated_graph_def is not None:
+    print("Reusing cached graph with calibrated eight-bit ops")
   else:
-    return tempfile.mkdtemp(prefix=".")
+    quantized_graph_def = cache.get_graph_def("after_quantize_nodes",
+                                              quantized_key)
+    if quantized_graph_def is not None:
+      print("Reusing cached graph with eight-bit ops")
+    else:
+      with timer.stage("quantize nodes"):
+        quantized_graph_def = graph_transforms.TransformGraph(
+          core_graph_def,
+          inputs=graph_gen.input_node_names(),
+          outputs=graph_gen.output_node_names(),
+          transforms=_QUANTIZE_NODES_TRANSFORMS)
+      cache.put_graph_def("after_quantize_nodes", quantized_key,
+                          quantized_graph_def)
+      dumper.dump(quantized_graph_def, "after_quantize_nodes",
+                  "Graph with eight-bit ops")
+
+    with timer.stage("graft pre/post"):
+      calibration_graph_def = _graft_pre_and_post(
+        quantized_graph_def, preproc_graph_def, postproc_graph_def)
+    with tempfile.TemporaryDirectory() as temp_dir:
+      log_file = os.path.join(temp_dir, "requant_ranges.log")
+      with timer.stage("calibrate"):
+        num_ranges = _record_requantization_ranges(
+          calibration_graph_def, calibration_images, log_file)
+      print("    Calibrated {} eight-bit ops on {} images".format(
+        num_ranges, len(calibration_images)))
+
+      with timer.stage("freeze ranges"):
+        calibrated_graph_def = graph_transforms.TransformGraph(
+          quantized_graph_def,
+          inputs=graph_gen.input_node_names(),
+          outputs=graph_gen.output_node_names(),
+          transforms=[_FREEZE_RANGES_TRANSFORM.format(log_file)])
+    cache.put_graph_def("after_calibration", calibrated_key,
+                        calibrated_graph_def)
+    dumper.dump(calibrated_graph_def, "after_calibration",
+                "Graph with calibrated eight-bit ops")
+
+  _make_python_deployable_graph(calibrated_graph_def, calibrated_key,
+                                graph_gen, dumper, saved_model_location,
+                                timer, cache)
+
+
+def _evaluate_constants(graph_def, graph_gen, tensor_names):
+  # type: (tf.GraphDef, prepost.GraphGen, List[str]) -> Dict[str, np.ndarray]
+  """
+  Evaluate tensors of the core model graph that don't depend on the values
+  of its inputs, only on their shapes, such as the anchor boxes of a
+  detector.
+
+  Args:
+    graph_def: Core model graph
+    graph_gen: Callback object for current model. The shapes of the inputs
+      come from its `input_signatures()`, with a batch size of 1.
+    tensor_names: Names of the tensors to evaluate
+
+  Returns a dict from tensor name to value.
+  """
+  input_signatures = graph_gen.input_signatures()
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name="")
+  feed_dict = {}
+  for name in graph_gen.input_node_names():
+    if name not in input_signatures:
+      raise ValueError("Input '{}' has no input signature".format(name))
+    shape = [1] + input_signatures[name]["shape"][1:]
+    if any(d < 0 for d in shape):
+      raise ValueError("Input '{}' has no fixed shape".format(name))
+    feed_dict[graph.get_tensor_by_name(name + ":0")] = np.zeros(
+      shape, dtype=input_signatures[name]["dtype"])
+  with tf.Session(graph=graph) as sess:
+    values = sess.run(tensor_names, feed_dict=feed_dict)
+  return dict(zip(tensor_names, values))
+
+
+def _make_tflite_deployable_graph(
+        core_graph_def,  # type: tf.GraphDef
+        core_key,  # type: str
+        graph_gen,  # type: prepost.GraphGen
+        dumper,  # type: util.GraphDumper
+        saved_model_location,  # type: str
+        timer,  # type: _StageTimer
+        cache  # type: build_cache.BuildCache
+):
+  # type: (...) -> None
+  """
+  Prepare a directory with a TensorFlow Lite version of the part of the core
+  model that `graph_gen.tflite_subgraph()` describes, for
+  `inference_request.TFLiteRunner`.
+
+  Args:
+    core_graph_def: Rewritten core model graph, i.e. the output of
+      `_apply_generic_deployment_rewrites()`
+    core_key: Build cache key of `core_graph_def`
+    graph_gen: Callback object for current model
+    dumper: Writes intermediate graphs for debugging, if enabled
+    saved_model_location: Directory where the TensorFlow Lite model and the
+      constants that go with it should go
+    timer: Collects the time that each stage of the build takes
+    cache: Cache of the outputs of previous builds
+  """
+  subgraph = graph_gen.tflite_subgraph()
+  if subgraph is None:
+    raise ValueError("Model does not describe a TensorFlow Lite subgraph")
+  tflite_key = cache.key(core_key, subgraph, tf.__version__,
+                         _BUILD_CACHE_VERSION)
+  with timer.stage("copy cached model"):
+    if cache.get_dir("tflite_model", tflite_key, saved_model_location):
+      print("Cached TensorFlow Lite model copied to {}".format(
+        saved_model_location))
+      return
+
+  # The inputs of the subgraph don't have to be placeholders; the converter
+  # cuts the graph at whatever tensors we name.
+  with timer.stage("convert to tflite"):
+    converter = tf.lite.TFLiteConverter(
+      core_graph_def, None, None,
+      input_arrays_with_shape=list(subgraph["input_shapes"].items()),
+      output_arrays=subgraph["output_names"])
+    tflite_model = converter.convert()
+  with timer.stage("evaluate constants"):
+    constants = _evaluate_constants(core_graph_def, graph_gen,
+                                    subgraph["constants"])
+  print("    Size of core graph/TensorFlow Lite model: {:.1f}/{:.1f} MB"
+        "".format(core_graph_def.ByteSize() / 1e6, len(tflite_model) / 1e6))
+
+  with timer.stage("write tflite model"):
+    if os.path.isdir(saved_model_location):
+      shutil.rmtree(saved_model_location)
+    os.makedirs(saved_model_location)
+    with open(os.path.join(saved_model_location,
+                           inference_request.TFLITE_MODEL_FILE_NAME),
+              "wb") as f:
+      f.write(tflite_model)
+    np.savez(os.path.join(saved_model_location,
+                          inference_request.TFLITE_CONSTANTS_FILE_NAME),
+             **constants)
+  cache.put_dir("tflite_model", tflite_key, saved_model_location)
+  print("TensorFlow Lite model written to {}".format(saved_model_location))
+
+
+# Deployment targets that main() can build: name -> (function that builds the
+# target from the rewritten core graph, output location)
+_TARGETS = collections.OrderedDict([
+  ("python", (_make_python_deployable_graph, _PYTHON_SAVED_MODEL_DIR)),
+  ("javascript", (_make_javascript_deployable_graph, _JS_SAVED_MODEL_DIR)),
+  ("python_quantized", (_make_quantized_python_deployable_graph,
+                        _QUANTIZED_SAVED_MODEL_DIR)),
+  ("python_eightbit", (_make_eightbit_python_deployable_graph,
+                       _EIGHTBIT_SAVED_MODEL_DIR)),
+  ("tflite", (_make_tflite_deployable_graph, _TFLITE_MODEL_DIR)),
+])
+
+
+def _build_target(
+        target_name,  # type: str
+        core_graph_def_bytes,  # type: bytes
+        core_key,  # type: str
+        dump_policy,  # type: str
+        dump_dir,  # type: str
+        cache,  # type: build_cache.BuildCache
+        options  # type: Dict[str, Any]
+):
+  # type: (...) -> List[Tuple[str, float]]
+  """
+  Body of the worker process that builds one deployment target.
+
+  Args:
+    target_name: Key of the target in `_TARGETS`
+    core_graph_def_bytes: Serialized output of
+      `_apply_generic_deployment_rewrites()`. Passed in serialized form
+      because protobufs can't be pickled.
+    core_key: Build cache key of the core graph
+    dump_policy: One of `util.DUMP_POLICIES`
+    dump_dir: Directory to write intermediate graphs to, if `dump_policy`
+      isn't "off"
+    cache: Cache of the outputs of previous builds
+    options: Additional keyword arguments of the target's build function,
+      from `_target_options()`
+
+  Returns the `(stage name, seconds)` pairs of the target's build.
+  """
+  build_fn, saved_model_location = _TARGETS[target_name]
+  timer = _StageTimer()
+  with timer.stage("parse core graph"):
+    core_graph_def = tf.GraphDef.FromString(core_graph_def_bytes)
+  dumper = util.GraphDumper(dump_policy, dump_dir)
+  build_fn(core_graph_def, core_key, handlers.GraphGenerators(), dumper,
+           saved_model_location, timer, cache, **options)
+  with timer.stage("wait for dumps"):
+    dumper.close()
+  return timer.stages
+
+
+def _target_options(target_name):
+  # type: (str) -> Dict[str, Any]
+  """
+  Returns the keyword arguments, beyond the ones that every target takes,
+  that main() passes to the build function of a target. Flags are only
+  parsed in the main process, so their values have to be passed along.
+  """
+  if target_name == "python_eightbit":
+    if len(FLAGS.calibration_image_dir) == 0:
+      raise ValueError("The python_eightbit target needs a directory of "
+                       "images to calibrate with; pass "
+                       "--calibration_image_dir")
+    images = util.read_image_dir(FLAGS.calibration_image_dir,
+                                 FLAGS.num_calibration_images)
+    return {"calibration_images": [i for _, i in images]}
+  return {}
+
+
+def _build_variant(
+        batch_size,  # type: int
+        frozen_graph_def_bytes,  # type: bytes
+        saved_model_location,  # type: str
+        dump_policy,  # type: str
+        dump_dir,  # type: str
+        cache  # type: build_cache.BuildCache
+):
+  # type: (...) -> List[Tuple[str, float]]
+  """
+  Body of the worker process that builds the variant of the Python target
+  for one batch size. Unlike the targets that `_build_target()` builds, the
+  variant needs rewrites of its own, since they depend on the input shapes.
+
+  Args:
+    batch_size: Batch size to specialize the graph for
+    frozen_graph_def_bytes: Serialized frozen graph of the model
+    saved_model_location: Location where the variant's SavedModel should go
+    dump_policy: One of `util.DUMP_POLICIES`
+    dump_dir: Directory to write intermediate graphs to, if `dump_policy`
+      isn't "off"
+    cache: Cache of the outputs of previous builds
+
+  Returns the `(stage name, seconds)` pairs of the variant's build.
+  """
+  timer = _StageTimer()
+  with timer.stage("parse frozen graph"):
+    frozen_graph_def = tf.GraphDef.FromString(frozen_graph_def_bytes)
+  graph_gen = handlers.GraphGenerators()
+  dumper = util.GraphDumper(dump_policy, dump_dir)
+  core_graph_def, core_key = _apply_generic_deployment_rewrites(
+    frozen_graph_def, graph_gen, dumper, timer, cache, batch_size)
+  _make_python_deployable_graph(
+    core_graph_def, core_key, graph_gen, dumper, saved_model_location, timer,
+    cache, batch_size)
+  with timer.stage("wait for dumps"):
+    dumper.close()
+  return timer.stages
+
+
+def _print_timings(timings, wall_clock_secs):
+  # type: (List[Tuple[str, List[Tuple[str, float]]]], float) -> None
+  """
+  Print the per-stage timing breakdown of a build.
+
+  Args:
+    timings: (part of the build, (stage name, seconds) pairs) pairs
+    wall_clock_secs: Elapsed time of the whole build
+  """
+  print("Build time per stage (seconds):")
+  for part, stages in timings:
+    # A stage can run more than once
+    totals = collections.OrderedDict()  # type: Dict[str, float]
+    for stage_name, secs in stages:
+      totals[stage_name] = totals.get(stage_name, 0.0) + secs
+    for stage_name, secs in totals.items():
+      print("  {:<18} {:<26} {:>8.2f}".format(part, stage_name, secs))
+    print("  {:<18} {:<26} {:>8.2f}".format(part, "(total)",
+                                              sum(totals.values())))
+  print("  {:<45} {:>8.2f}".format("wall clock", wall_clock_secs))
 
 
 def main(_):
+  start_time = time.perf_counter()
+  unknown_targets = [t for t in FLAGS.targets if t not in _TARGETS]
+  if len(unknown_targets) > 0:
+    raise ValueError("Unknown target(s) {}. Valid targets are {}."
+                     "".format(unknown_targets, list(_TARGETS.keys())))
+  # Read inputs such as calibration images before the long parts of the
+  # build, so that bad flags fail fast.
+  target_options = {t: _target_options(t) for t in FLAGS.targets}
+  timer = _StageTimer()
+  cache = build_cache.BuildCache(FLAGS.build_cache_dir,
+                                 enabled=FLAGS.use_build_cache)
+  dumper = util.GraphDumper(FLAGS.dump_graphs,
+                            os.path.join(FLAGS.dump_dir, "shared"))
+
   # We start with a frozen graph for the model. "Frozen" means that all
   # variables have been converted to constants.
   graph_generators = handlers.GraphGenerators()
-  frozen_graph_def = graph_generators.frozen_graph()
+  with timer.stage("load frozen graph"):
+    frozen_graph_def = graph_generators.frozen_graph()
+
+  dumper.dump(frozen_graph_def, "frozen_graph", "Frozen graph")
+
+  # The rewrites of the core model are the same for every target, so do them
+  # once.
+  core_graph_def, core_key = _apply_generic_deployment_rewrites(
+    frozen_graph_def, graph_generators, dumper, timer, cache)
+  core_graph_def_bytes = core_graph_def.SerializeToString()
+
+  # Build the targets themselves in parallel, each in its own process,
+  # along with any variants of the Python target.
+  jobs = [(t, _build_target,
+           (t, core_graph_def_bytes, core_key, FLAGS.dump_graphs,
+            os.path.join(FLAGS.dump_dir, t), cache, target_options[t]))
+          for t in FLAGS.targets]
+  batch_sizes = [int(b) for b in FLAGS.batch_size_variants]
+  if "python" in FLAGS.targets:
+    # Don't leave variants for batch sizes that are no longer requested
+    if os.path.isdir(FLAGS.variants_dir):
+      shutil.rmtree(FLAGS.variants_dir)
+  if "python" in FLAGS.targets and len(batch_sizes) > 0:
+    if len(graph_generators.input_signatures()) == 0:
+      print("Model has no input signatures. Not building batch size "
+            "variants.")
+    else:
+      frozen_graph_def_bytes = frozen_graph_def.SerializeToString()
+      for b in batch_sizes:
+        jobs.append((
+          "python[batch={}]".format(b), _build_variant,
+          (b, frozen_graph_def_bytes,
+           inference_request.batch_variant_dir(FLAGS.variants_dir, b),
+           FLAGS.dump_graphs,
+           os.path.join(FLAGS.dump_dir, "python_batch_{}".format(b)),
+           cache)))
+  num_workers = (FLAGS.build_workers if FLAGS.build_workers > 0
+                 else len(jobs))
+  if num_workers == 1:
+    job_stages = [fn(*args) for _, fn, args in jobs]
+  else:
+    # TensorFlow doesn't survive fork(), hence the "spawn" context.
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(min(num_workers, len(jobs))) as pool:
+      results = [pool.apply_async(fn, args) for _, fn, args in jobs]
+      job_stages = [r.get() for r in results]
 
-  util.protobuf_to_file(frozen_graph_def, "frozen_graph.pbtxt",
-                        "Frozen graph")
+  # The shared dumps were written in the background while the targets were
+  # being built.
+  with timer.stage("wait for dumps"):
+    dumper.close()
+  timings = [("shared", timer.stages)]
+  timings.extend(zip([name for name, _, _ in jobs], job_stages))
 
-  _make_python_deployable_graph(frozen_graph_def, graph_generators,
-                                _make_temp_dir(), _PYTHON_SAVED_MODEL_DIR)
-  _make_javascript_deployable_graph(frozen_graph_def, graph_generators,
-                                    _make_temp_dir(), _JS_SAVED_MODEL_DIR)
+  _print_timings(timings, time.perf_counter() - start_time)
 
 
 if __name__ == "__main__":
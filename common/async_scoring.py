@@ -0,0 +1,196 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""asyncio version of the scoring entry point.
+
+The generated WML `score()` function and the other entry points in this
+repo block the calling thread for the whole request, so a caller that keeps
+thousands of requests open at once needs thousands of threads.
+`AsyncScorer.score()` is a coroutine with the same contract as the
+generated `score()`. Parsing, validation, pre-processing, and
+post-processing run on the event loop, which is cheap for this model since
+image decoding happens inside the graph. Only the model itself runs on a
+thread pool, and at most `max_concurrency` requests run it at once; the
+rest wait as suspended coroutines rather than as blocked threads.
+
+Example:
+```
+  runner = inference_request.LocalTFRunner.from_saved_model("./saved_model")
+  scorer = async_scoring.AsyncScorer(handlers.ObjectDetectorHandlers(),
+                                     runner.run, max_concurrency=4)
+  result = await scorer.score({"fields": ["image", "threshold"],
+                               "values": [[image_base64, 0.7]]})
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Callable, Dict
+
+import asyncio
+import base64
+import concurrent.futures
+
+# Local imports
+from common.inference_request import InferenceRequest
+from common.prepost import PrePost
+
+
+class AsyncScorer(object):
+  """
+  Scores Watson V3 payloads from coroutines, offloading only model
+  execution to a thread pool.
+
+  Every method must be called from the same event loop.
+  """
+
+  def __init__(self,
+               handlers,  # type: PrePost
+               run_fn,  # type: Callable[[InferenceRequest], None]
+               max_concurrency=4,  # type: int
+               executor=None  # type: concurrent.futures.Executor
+               ):
+    """
+    Args:
+      handlers: Pre- and post-processing callbacks, e.g. an instance of
+        `handlers.ObjectDetectorHandlers`
+      run_fn: Blocking function that takes an `InferenceRequest` with
+        populated `processed_inputs` and populates its `raw_outputs`, e.g.
+        `inference_request.LocalTFRunner.run`,
+        `batching.BatchingScheduler.submit`, or
+        `response_cache.ResponseCache.run`. Must be thread-safe.
+      max_concurrency: Maximum number of requests that run `run_fn` at the
+        same time. Requests beyond this number wait on the event loop.
+      executor: Thread pool to call `run_fn` on. If None, the scorer
+        creates one with `max_concurrency` threads and shuts it down in
+        `close()`.
+    """
+    if max_concurrency < 1:
+      raise ValueError("max_concurrency must be at least 1, got {}"
+                       "".format(max_concurrency))
+    self._handlers = handlers
+    self._run_fn = run_fn
+    self._max_concurrency = max_concurrency
+    self._owns_executor = executor is None
+    self._executor = (executor if executor is not None
+                      else concurrent.futures.ThreadPoolExecutor(
+                        max_workers=max_concurrency,
+                        thread_name_prefix="AsyncScorer"))
+    # Created on first use, since before Python 3.10 a semaphore belongs to
+    # the event loop that is current when it is created.
+    self._semaphore = None  # type: asyncio.Semaphore
+    self._num_waiting = 0
+    self._num_running = 0
+
+  @property
+  def max_concurrency(self):
+    # type: () -> int
+    return self._max_concurrency
+
+  def stats(self):
+    # type: () -> Dict[str, int]
+    """
+    Number of requests waiting for, and running, the model right now.
+    """
+    return {
+      "num_waiting": self._num_waiting,
+      "num_running": self._num_running,
+    }
+
+  async def score(self, payload):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """
+    Coroutine version of the generated WML `score()` function.
+
+    Args:
+      payload: Parsed Watson V3 request, with an optional "encoding" key
+        that names one of `InferenceRequest.RESPONSE_ENCODINGS`
+
+    Returns the same dict that the WML function returns: the processed
+    outputs for the "json" encoding, or the base64-encoded result under the
+    key "data" for other encodings. Raises ValueError if the payload is
+    malformed, without ever touching the thread pool.
+    """
+    request = InferenceRequest()
+    try:
+      request.set_raw_inputs_from_watson_v3(payload)
+    except KeyError as e:
+      raise ValueError("Payload has no {} key".format(e))
+    request.response_encoding = payload.get("encoding", "json")
+    if request.response_encoding not in InferenceRequest.RESPONSE_ENCODINGS:
+      raise ValueError("Unknown response encoding '{}'".format(
+        request.response_encoding))
+    await self.score_request(request)
+    if request.response_encoding == "json":
+      return request.processed_outputs
+    data, content_type = request.encode_result()
+    return {
+      "encoding": request.response_encoding,
+      "content_type": content_type,
+      "data": base64.b64encode(data).decode("utf-8")
+    }
+
+  async def score_request(self, request):
+    # type: (InferenceRequest) -> InferenceRequest
+    """
+    Run a request whose `raw_inputs` are already populated through
+    pre-processing, the model, and post-processing. Callers that want the
+    encoded response bytes can call `request.encode_result()` afterwards.
+
+    Returns `request`, with `processed_outputs` populated.
+
+    Cancelling the coroutine while the model runs doesn't stop the run,
+    which keeps its slot of `max_concurrency` until the thread is done.
+    """
+    with request.timed("pre_process"):
+      self._handlers.pre_process(request)
+    if self._semaphore is None:
+      self._semaphore = asyncio.Semaphore(self._max_concurrency)
+    self._num_waiting += 1
+    try:
+      with request.timed("queue"):
+        await self._semaphore.acquire()
+    finally:
+      self._num_waiting -= 1
+    self._num_running += 1
+
+    def finish_run(_):
+      self._num_running -= 1
+      self._semaphore.release()
+
+    try:
+      run_future = asyncio.get_running_loop().run_in_executor(
+        self._executor, self._run_fn, request)
+    except Exception:
+      finish_run(None)
+      raise
+    # Release the slot when the thread finishes, not when this coroutine
+    # stops waiting for it; the shield keeps cancellation of the coroutine
+    # from marking the run as done while the thread is still in it.
+    run_future.add_done_callback(finish_run)
+    with request.timed("inference"):
+      await asyncio.shield(run_future)
+    with request.timed("post_process"):
+      self._handlers.post_process(request)
+    return request
+
+  def close(self):
+    """
+    Shut down the thread pool, if the scorer created it. Waits for
+    requests that are running the model to finish.
+    """
+    if self._owns_executor:
+      self._executor.shutdown(wait=True)
@@ -0,0 +1,378 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Dynamic micro-batching of in-flight inference requests.
+
+Under concurrent load, running every request through the model on its own
+means the model only ever sees batches of size 1. The scheduler in this
+module sits in front of a function like `inference_request.pass_to_local_tf`,
+coalesces requests that arrive close together into a single batch, runs the
+batch once, and scatters the outputs back to the original requests.
+
+Example:
+```
+  scheduler = batching.BatchingScheduler(
+    lambda r: inference_request.pass_to_local_tf(r, sess, graph, signature),
+    max_batch_size=16, max_wait_secs=0.005)
+  handlers.pre_process(request)
+  scheduler.submit(request)  # Blocks until request.raw_outputs is populated
+  handlers.post_process(request)
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+import numpy as np
+
+# Local imports
+from common.inference_request import InferenceRequest
+
+
+# Sentinel that tells the scheduler thread to exit
+_SHUTDOWN = object()
+
+
+class _QueueEntry(object):
+  """
+  A request waiting in the scheduler's queue, along with the bookkeeping
+  needed to scatter results back to it.
+  """
+  def __init__(self, request):
+    # type: (InferenceRequest) -> None
+    self.request = request
+    self.num_rows = _num_rows(request)
+    self.enqueue_time = time.monotonic()
+    self.future = concurrent.futures.Future()
+
+
+class BatchingStats(object):
+  """
+  Thread-safe counters describing what the scheduler has been doing.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._num_requests = 0
+    self._num_batches = 0
+    self._batch_size_counts = collections.Counter()
+    self._total_queue_delay_secs = 0.0
+    self._max_queue_delay_secs = 0.0
+    self._total_run_secs = 0.0
+
+  def record_batch(self, batch_size, queue_delays_secs, run_secs):
+    # type: (int, List[float], float) -> None
+    with self._lock:
+      self._num_requests += len(queue_delays_secs)
+      self._num_batches += 1
+      self._batch_size_counts[batch_size] += 1
+      self._total_queue_delay_secs += sum(queue_delays_secs)
+      self._max_queue_delay_secs = max([self._max_queue_delay_secs]
+                                       + queue_delays_secs)
+      self._total_run_secs += run_secs
+
+  def merge(self, snapshot):
+    # type: (Dict[str, Any]) -> None
+    """
+    Adds the counters in `snapshot`, the result of `snapshot()` on another
+    `BatchingStats`, e.g. one in another process. Also takes snapshots that
+    have been through JSON, whose batch sizes are strings.
+    """
+    with self._lock:
+      self._num_requests += snapshot["num_requests"]
+      self._num_batches += snapshot["num_batches"]
+      for size, count in snapshot["batch_size_counts"].items():
+        self._batch_size_counts[int(size)] += count
+      self._total_queue_delay_secs += (snapshot["mean_queue_delay_secs"]
+                                       * snapshot["num_requests"])
+      self._max_queue_delay_secs = max(self._max_queue_delay_secs,
+                                       snapshot["max_queue_delay_secs"])
+      self._total_run_secs += (snapshot["mean_batch_run_secs"]
+                               * snapshot["num_batches"])
+
+  def snapshot(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns a point-in-time copy of the counters as a JSON-friendly dict.
+    Batch sizes are counted in rows (i.e. images), not requests.
+    """
+    with self._lock:
+      num_rows = sum(size * count
+                     for size, count in self._batch_size_counts.items())
+      return {
+        "num_requests": self._num_requests,
+        "num_batches": self._num_batches,
+        "batch_size_counts": dict(self._batch_size_counts),
+        "mean_batch_size": (num_rows / self._num_batches
+                            if self._num_batches > 0 else 0.0),
+        "mean_queue_delay_secs": (
+          self._total_queue_delay_secs / self._num_requests
+          if self._num_requests > 0 else 0.0),
+        "max_queue_delay_secs": self._max_queue_delay_secs,
+        "mean_batch_run_secs": (self._total_run_secs / self._num_batches
+                                if self._num_batches > 0 else 0.0),
+      }
+
+
+class BatchingScheduler(object):
+  """
+  Collects in-flight `InferenceRequest`s into batches of up to
+  `max_batch_size` rows, waiting at most `max_wait_secs` after the first
+  request of a batch arrives, and runs each batch through a single call to
+  `run_fn`.
+
+  Every output in `raw_outputs` must have the batch as its first dimension.
+  So must every input in `processed_inputs`, except for scalar inputs such
+  as a detection threshold. Requests are only coalesced if they target the
+  same signature, have the same set of inputs, and have equal values for
+  every scalar input, unless the caller provides a function to merge that
+  input's values. A request that itself carries more than `max_batch_size`
+  rows is run on its own.
+  """
+
+  def __init__(self,
+               run_fn,  # type: Callable[[InferenceRequest], None]
+               max_batch_size=8,  # type: int
+               max_wait_secs=0.005,  # type: float
+               merge_fns=None  # type: Dict[str, Callable[[List[Any]], Any]]
+               ):
+    """
+    Create a scheduler and start its background thread.
+
+    Args:
+      run_fn: Function that takes an `InferenceRequest` with populated
+        `processed_inputs` and populates its `raw_outputs`, for example a
+        closure around `inference_request.pass_to_local_tf`. Only ever
+        called from the scheduler's thread.
+      max_batch_size: Maximum number of rows to coalesce into one batch.
+      max_wait_secs: Maximum time that the first request of a batch waits
+        for other requests to join it.
+      merge_fns: Optional dict from the name of a scalar input to a function
+        that combines the values of that input across the requests of a
+        batch into the value fed for the whole batch. For example, `min`
+        is a valid merge function for a detection threshold if
+        post-processing applies each request's own threshold afterwards.
+    """
+    if max_batch_size < 1:
+      raise ValueError("max_batch_size must be at least 1, got {}"
+                       "".format(max_batch_size))
+    self._run_fn = run_fn
+    self._max_batch_size = max_batch_size
+    self._max_wait_secs = max_wait_secs
+    self._merge_fns = dict(merge_fns) if merge_fns is not None else {}
+    self._queue = queue.Queue()
+    self._stats = BatchingStats()
+    # Guards _closed, so that no request is queued behind _SHUTDOWN
+    self._lock = threading.Lock()
+    self._closed = False
+    self._thread = threading.Thread(target=self._run_loop,
+                                    name="BatchingScheduler", daemon=True)
+    self._thread.start()
+
+  @property
+  def queue_depth(self):
+    # type: () -> int
+    """
+    Approximate number of requests waiting to be put into a batch.
+    """
+    return self._queue.qsize()
+
+  def stats(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns current queue depth plus the counters in `BatchingStats`.
+    """
+    result = self._stats.snapshot()
+    result["queue_depth"] = self.queue_depth
+    return result
+
+  def submit_async(self, request):
+    # type: (InferenceRequest) -> concurrent.futures.Future
+    """
+    Enqueue a request whose `processed_inputs` are populated.
+
+    Returns a future that completes when `request.raw_outputs` has been
+    populated, or that carries the exception raised while running the batch
+    that contained the request.
+
+    Raises ValueError if the scheduler has been closed.
+    """
+    entry = _QueueEntry(request)
+    with self._lock:
+      if self._closed:
+        raise ValueError("Scheduler is closed")
+      self._queue.put(entry)
+    return entry.future
+
+  def submit(self, request):
+    # type: (InferenceRequest) -> None
+    """
+    Blocking version of `submit_async()`.
+    """
+    self.submit_async(request).result()
+
+  def close(self):
+    """
+    Stop the background thread after it drains the requests already queued.
+    Later calls to `submit_async()` raise ValueError.
+    """
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      self._queue.put(_SHUTDOWN)
+    self._thread.join()
+
+  def _run_loop(self):
+    carried_over = None
+    while True:
+      first = carried_over if carried_over is not None else self._queue.get()
+      carried_over = None
+      if first is _SHUTDOWN:
+        return
+      batch = [first]
+      num_rows = first.num_rows
+      deadline = first.enqueue_time + self._max_wait_secs
+      shutting_down = False
+      while num_rows < self._max_batch_size:
+        remaining_secs = deadline - time.monotonic()
+        try:
+          if remaining_secs > 0:
+            entry = self._queue.get(timeout=remaining_secs)
+          else:
+            # Still sweep up anything that is already waiting.
+            entry = self._queue.get_nowait()
+        except queue.Empty:
+          break
+        if entry is _SHUTDOWN:
+          shutting_down = True
+          break
+        if (num_rows + entry.num_rows > self._max_batch_size
+                or not self._compatible(first, entry)):
+          carried_over = entry
+          break
+        batch.append(entry)
+        num_rows += entry.num_rows
+      self._run_batch(batch, num_rows)
+      if shutting_down:
+        self._queue.put(_SHUTDOWN)
+
+  def _compatible(self, first, entry):
+    # type: (_QueueEntry, _QueueEntry) -> bool
+    """
+    Returns True if `entry` can join the batch that starts with `first`.
+    """
+    if first.request.signature_name != entry.request.signature_name:
+      return False
+    first_inputs = first.request.processed_inputs
+    entry_inputs = entry.request.processed_inputs
+    if set(first_inputs.keys()) != set(entry_inputs.keys()):
+      return False
+    for key in first_inputs:
+      if key in self._merge_fns or not _is_scalar(first_inputs[key]):
+        continue
+      if first_inputs[key] != entry_inputs[key]:
+        return False
+    return True
+
+  def _run_batch(self, batch, num_rows):
+    # type: (List[_QueueEntry], int) -> None
+    start_time = time.monotonic()
+    queue_delays = [start_time - e.enqueue_time for e in batch]
+    try:
+      if len(batch) == 1:
+        self._run_fn(batch[0].request)
+      else:
+        merged = _merge_requests([e.request for e in batch],
+                                 self._merge_fns)
+        self._run_fn(merged)
+        _scatter_outputs(merged, batch)
+    except Exception as e:
+      for entry in batch:
+        entry.future.set_exception(e)
+      return
+    finally:
+      self._stats.record_batch(num_rows, queue_delays,
+                               time.monotonic() - start_time)
+    for entry in batch:
+      entry.future.set_result(None)
+
+
+def _is_scalar(value):
+  # type: (Any) -> bool
+  return not isinstance(value, list) and np.ndim(value) == 0
+
+
+def _num_rows(request):
+  # type: (InferenceRequest) -> int
+  """
+  Size of the batch dimension of a request's processed inputs.
+  """
+  batched = [v for v in request.processed_inputs.values()
+             if not _is_scalar(v)]
+  if len(batched) == 0:
+    raise ValueError("Request has no batched processed inputs. Run "
+                     "pre_process() before submitting it.")
+  return len(batched[0])
+
+
+def _concat(values):
+  # type: (List[Any]) -> Any
+  """
+  Concatenate a list of batch-major values along their first dimension.
+  """
+  if all(isinstance(v, list) for v in values):
+    return [x for v in values for x in v]
+  return np.concatenate([np.asarray(v) for v in values], axis=0)
+
+
+def _merge_requests(requests, merge_fns):
+  # type: (List[InferenceRequest], Dict[str, Callable[[List[Any]], Any]]) -> InferenceRequest
+  """
+  Build a single request whose processed inputs are the concatenation of
+  the processed inputs of `requests`. Scalar inputs are combined with the
+  corresponding function in `merge_fns` if there is one; otherwise they
+  are equal across `requests`.
+  """
+  merged = InferenceRequest()
+  merged.signature_name = requests[0].signature_name
+  for key in requests[0].processed_inputs:
+    values = [r.processed_inputs[key] for r in requests]
+    if key in merge_fns:
+      merged.processed_inputs[key] = merge_fns[key](values)
+    elif _is_scalar(values[0]):
+      merged.processed_inputs[key] = values[0]
+    else:
+      merged.processed_inputs[key] = _concat(values)
+  return merged
+
+
+def _scatter_outputs(merged, batch):
+  # type: (InferenceRequest, List[_QueueEntry]) -> None
+  """
+  Slice the raw outputs of a merged request back into the original requests.
+  """
+  start = 0
+  for entry in batch:
+    end = start + entry.num_rows
+    for key, value in merged.raw_outputs.items():
+      entry.request.raw_outputs[key] = value[start:end]
+    start = end
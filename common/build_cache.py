@@ -0,0 +1,168 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Content-addressed cache of the intermediate and final outputs of
+build_graph.py.
+
+Every stage of the build is keyed by a hash of everything that goes into it:
+the key of the stage before it, plus the stage's own inputs, such as the
+list of rewrites that it applies, the graphs that it grafts on, and the
+TensorFlow version. A stage whose key is in the cache is not run again, and
+changing one stage only invalidates that stage and the ones after it.
+
+Intermediate graphs are stored as binary GraphDef files, and finished
+SavedModels as copies of their directories. Entries are never evicted;
+delete the cache directory to reclaim the space.
+
+Example:
+```
+  cache = build_cache.BuildCache("./cached_files/build_cache")
+  key = cache.key("rewrites", frozen_graph_def, transforms, tf.__version__)
+  graph_def = cache.get_graph_def("after_rewrites", key)
+  if graph_def is None:
+    graph_def = rewrite(frozen_graph_def)
+    cache.put_graph_def("after_rewrites", key, graph_def)
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import tensorflow as tf
+
+
+class BuildCache(object):
+  """
+  Directory of build outputs, keyed by content hash. Safe to share between
+  processes: entries are written under a temporary name and then renamed
+  into place.
+  """
+
+  def __init__(self, cache_dir, enabled=True):
+    # type: (str, bool) -> None
+    """
+    Args:
+      cache_dir: Directory that holds the cache. Created on first write.
+      enabled: If False, every lookup misses and nothing is written, so that
+        the build runs every stage.
+    """
+    self._cache_dir = cache_dir
+    self._enabled = enabled
+
+  @property
+  def enabled(self):
+    # type: () -> bool
+    return self._enabled
+
+  @staticmethod
+  def key(*parts):
+    # type: (*Any) -> str
+    """
+    Hash any number of inputs of a build stage into a cache key.
+
+    Args:
+      parts: Inputs of the stage. Each one can be bytes, a string, a
+        protobuf message (hashed in its deterministic serialized form), or
+        any value that the `json` module can serialize.
+
+    Returns the key, as a hex string.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+      if isinstance(part, bytes):
+        data = part
+      elif isinstance(part, str):
+        data = part.encode("utf-8")
+      elif hasattr(part, "SerializeToString"):
+        data = part.SerializeToString(deterministic=True)
+      else:
+        data = json.dumps(part, sort_keys=True).encode("utf-8")
+      # Length prefix, so that ("ab", "c") and ("a", "bc") hash differently.
+      h.update(len(data).to_bytes(8, "little"))
+      h.update(data)
+    return h.hexdigest()
+
+  def _path(self, name, key):
+    # type: (str, str) -> str
+    return os.path.join(self._cache_dir, "{}-{}".format(name, key))
+
+  def get_graph_def(self, name, key):
+    # type: (str, str) -> tf.GraphDef
+    """
+    Returns the cached graph for stage `name` and key `key`, or None if
+    there isn't one.
+    """
+    path = self._path(name, key) + ".pb"
+    if not self._enabled or not os.path.exists(path):
+      return None
+    with open(path, "rb") as f:
+      return tf.GraphDef.FromString(f.read())
+
+  def put_graph_def(self, name, key, graph_def):
+    # type: (str, str, tf.GraphDef) -> None
+    """
+    Store the output graph of stage `name` under key `key`.
+    """
+    if not self._enabled:
+      return
+    os.makedirs(self._cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=self._cache_dir, prefix=".")
+    with os.fdopen(fd, "wb") as f:
+      f.write(graph_def.SerializeToString())
+    os.replace(temp_path, self._path(name, key) + ".pb")
+
+  def get_dir(self, name, key, dest_dir):
+    # type: (str, str, str) -> bool
+    """
+    Replace `dest_dir` with a copy of the cached directory for stage `name`
+    and key `key`, if there is one.
+
+    Returns True if the directory was in the cache and has been copied.
+    """
+    path = self._path(name, key)
+    if not self._enabled or not os.path.isdir(path):
+      return False
+    if os.path.isdir(dest_dir):
+      shutil.rmtree(dest_dir)
+    shutil.copytree(path, dest_dir)
+    return True
+
+  def put_dir(self, name, key, src_dir):
+    # type: (str, str, str) -> None
+    """
+    Store a copy of `src_dir`, such as a SavedModel directory, as the output
+    of stage `name` under key `key`.
+    """
+    if not self._enabled:
+      return
+    path = self._path(name, key)
+    if os.path.isdir(path):
+      return
+    os.makedirs(self._cache_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=self._cache_dir, prefix=".")
+    shutil.copytree(src_dir, os.path.join(temp_path, "contents"))
+    try:
+      os.rename(os.path.join(temp_path, "contents"), path)
+    except OSError:
+      # Another process stored the same entry first.
+      pass
+    shutil.rmtree(temp_path)
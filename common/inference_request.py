@@ -17,9 +17,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from typing import Dict
+from typing import Any, Callable, Dict, List, Sequence, Tuple
 
+import concurrent.futures
 import json
+import os
+import re
+import threading
+import time
 import tensorflow as tf
 import numpy as np
 
@@ -30,14 +35,152 @@ class InferenceRequest(object):
   Class for representing in-flight inference reqeusts as they go through
   preprocessing, inference, and postprocessing.
   """
+  # printf-style formats that write each floating-point type with just
+  # enough digits to read back the same value. Other numeric types
+  # don't need special handling; float64 goes through `json`, which already
+  # writes the shortest such representation.
+  _JSON_NUMBER_FORMATS = {
+    np.dtype(np.float16): "%.5g",
+    np.dtype(np.float32): "%.9g",
+  }
+
+  # Encodings that `encode_result()` supports, and the content type of each
+  RESPONSE_ENCODINGS = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "arrays": "application/vnd.max.arrays",
+  }
+
+  # First bytes of a result in the "arrays" encoding
+  _ARRAYS_MAGIC = b"MAXA"
+  # Alignment of array data in the "arrays" encoding
+  _ARRAYS_ALIGNMENT = 8
+
+  # Functions to call with every phase duration and payload size that any
+  # request records; see `add_listener()`. Replaced rather than modified, so
+  # that requests can iterate over it without a lock.
+  _listeners = []  # type: List[Callable[[str, str, float], None]]
+
+  class _PhaseTimer(object):
+    """
+    Context manager that `InferenceRequest.timed()` returns.
+    """
+    def __init__(self, request, name):
+      self._request = request
+      self._name = name
+      self._start = 0.0
+
+    def __enter__(self):
+      self._start = time.perf_counter()
+      return self
+
+    def __exit__(self, *exc_info):
+      self._request.record_phase(self._name, self._start)
+      return False
+
   def __init__(self):
     """
     Create an empty request object.
     """
     self._raw_inputs = {}  # type: Dict[str, Any]
+    self._raw_input_batch = []  # type: List[Dict[str, Any]]
     self._processed_inputs = {}  # type: Dict[str, Any]
     self._raw_outputs = {}  # type: Dict[str, Any]
     self._processed_outputs = {}  # type: Dict[str, Any]
+    # Key of the SavedModel signature that the processed inputs target.
+    # Preprocessing callbacks can change this.
+    self.signature_name = "serving_default"
+    # Key of `RESPONSE_ENCODINGS` that `encode_result()` uses. Postprocessing
+    # callbacks can look at this to decide whether they can return numpy
+    # arrays instead of nested lists.
+    self.response_encoding = "json"
+    # Timestamps from time.perf_counter(), which is monotonic
+    self.created_at = time.perf_counter()
+    self._phases = []  # type: List[Tuple[str, float, float]]
+    self._sizes = {}  # type: Dict[str, int]
+
+  def timed(self, phase_name):
+    # type: (str) -> Any
+    """
+    Returns a context manager that records how long its body takes as a
+    phase of this request's lifecycle, for example:
+    ```
+      with request.timed("pre_process"):
+        handlers.pre_process(request)
+    ```
+    The phase is recorded even if the body raises.
+    """
+    return InferenceRequest._PhaseTimer(self, phase_name)
+
+  def record_phase(self, phase_name, start, end=None):
+    # type: (str, float, float) -> None
+    """
+    Record a phase of this request's lifecycle that ran from `start` to
+    `end` (by default, now), both from `time.perf_counter()`, and pass its
+    duration to the listeners. Phases that run more than once are recorded
+    once per run.
+    """
+    if end is None:
+      end = time.perf_counter()
+    self._phases.append((phase_name, start, end))
+    for listener in InferenceRequest._listeners:
+      listener("phase", phase_name, end - start)
+
+  def record_size(self, name, num_bytes):
+    # type: (str, int) -> None
+    """
+    Record the size of a payload associated with this request, such as the
+    body of the HTTP request that carried it, and pass it to the listeners.
+    """
+    self._sizes[name] = num_bytes
+    for listener in InferenceRequest._listeners:
+      listener("size", name, num_bytes)
+
+  @property
+  def phase_durations(self):
+    # type: () -> Dict[str, float]
+    """
+    Total time in seconds spent in each phase recorded so far.
+    """
+    result = {}
+    for name, start, end in self._phases:
+      result[name] = result.get(name, 0.0) + (end - start)
+    return result
+
+  def trace(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns a JSON-friendly record of the phases and payload sizes recorded
+    so far. Phase start times are relative to the creation of the request.
+    """
+    end = max([e for _, _, e in self._phases] + [self.created_at])
+    return {
+      "phases": [
+        {"name": name, "start_ms": (start - self.created_at) * 1000.0,
+         "duration_ms": (e - start) * 1000.0}
+        for name, start, e in self._phases
+      ],
+      "sizes": dict(self._sizes),
+      "total_ms": (end - self.created_at) * 1000.0,
+    }
+
+  @staticmethod
+  def add_listener(listener):
+    # type: (Callable[[str, str, float], None]) -> None
+    """
+    Register a function to call whenever any request records a phase or a
+    payload size, e.g. to feed histograms. The function receives "phase"
+    and the phase name and duration in seconds, or "size" and the payload
+    name and size in bytes. It runs on the thread that records the value,
+    so it must be fast and thread-safe.
+    """
+    InferenceRequest._listeners = InferenceRequest._listeners + [listener]
+
+  @staticmethod
+  def remove_listener(listener):
+    # type: (Callable[[str, str, float], None]) -> None
+    InferenceRequest._listeners = [l for l in InferenceRequest._listeners
+                                   if l is not listener]
 
   @property
   def raw_inputs(self):
@@ -53,9 +196,42 @@ class InferenceRequest(object):
   def raw_inputs(self, value):
     """
     Replace the current value of the raw_inputs property with a *shallow copy*
-    of the provided dict.
+    of the provided dict. Any multi-tuple batch previously set on this request
+    is discarded.
     """
     self._raw_inputs = value.copy()
+    self._raw_input_batch = []
+
+  @property
+  def raw_input_batch(self):
+    # type: () -> List[Dict[str, Any]]
+    """
+    The raw inputs to the inference request as a list of key-value pairs,
+    one dict per input tuple. For a request that carries a single tuple,
+    this is a one-element list containing `raw_inputs`.
+    """
+    if len(self._raw_input_batch) == 0:
+      return [self._raw_inputs]
+    return self._raw_input_batch
+
+  @raw_input_batch.setter
+  def raw_input_batch(self, value):
+    """
+    Replace the current batch of raw inputs with *shallow copies* of the
+    provided dicts. `raw_inputs` becomes the first element of the batch.
+    """
+    if len(value) == 0:
+      raise ValueError("Batch of raw inputs must contain at least one tuple")
+    self._raw_input_batch = [v.copy() for v in value]
+    self._raw_inputs = self._raw_input_batch[0]
+
+  @property
+  def batch_size(self):
+    # type: () -> int
+    """
+    Number of input tuples in this request.
+    """
+    return len(self.raw_input_batch)
 
   def set_raw_inputs_from_watson_v3(self, request_json):
     # type: (Dict[str, Any]) -> None
@@ -94,30 +270,33 @@ class InferenceRequest(object):
     allow abitrary JSON for a field value. We also don't attempt to enforce
     that every tuple has the same type in a given field.
 
-    Currently we only support a single input tuple.
+    Each tuple under "values" becomes one element of `raw_input_batch`, in
+    order. `raw_inputs` holds the first tuple.
+
+    Records its run time as the "parse_inputs" phase.
 
     Args:
       request_json: Parsed JSON request in Watson V3 format.
     """
+    with self.timed("parse_inputs"):
+      self._set_raw_inputs_from_watson_v3(request_json)
+
+  def _set_raw_inputs_from_watson_v3(self, request_json):
+    # type: (Dict[str, Any]) -> None
     fields_list = request_json["fields"]
     tuples_list = request_json["values"]
-    # TODO: Handle requests with multiple tuples
-    if len(tuples_list) > 1:
-      raise ValueError("Received {} tuples of values, but current "
-                       "implementation can only handle "
-                       "1".format(len(tuples_list)))
-    first_tuple = tuples_list[0]
-    if len(first_tuple) != len(fields_list):
-      raise ValueError("Received {} field names and {} field values"
-                       "".format(len(fields_list), len(first_tuple)))
-    self.raw_inputs.clear()
-    for i in range(len(fields_list)):
-      field_name = fields_list[i]
-      field_value = first_tuple[i]
-      self.raw_inputs[field_name] = field_value
-
-  def set_raw_outputs_from_watson_v3(self, response_json):
-    # type: (Dict[str, Any]) -> None
+    if len(tuples_list) == 0:
+      raise ValueError("Received a request with no tuples of values")
+    batch = []
+    for t in tuples_list:
+      if len(t) != len(fields_list):
+        raise ValueError("Received {} field names and {} field values"
+                         "".format(len(fields_list), len(t)))
+      batch.append({fields_list[i]: t[i] for i in range(len(fields_list))})
+    self.raw_input_batch = batch
+
+  def set_raw_outputs_from_watson_v3(self, response_json, output_specs=None):
+    # type: (Dict[str, Any], Dict[str, Dict[str, Any]]) -> None
     """
     Set the `raw_outputs` property of this request using a JSON response in
     Watson V3 API format, as defined at https://watson-ml-api.mybluemix.net.
@@ -125,7 +304,18 @@ class InferenceRequest(object):
 
     Args:
       response_json: JSON response in Watson V3 format.
+      output_specs: Optional dict from output name to the expected dtype and
+        shape of that output, in the format that `PrePost.output_specs()`
+        returns. Outputs with a spec are decoded straight to the right dtype
+        and have their shape checked; see `json_to_value()`.
+
+    Records its run time as the "parse_outputs" phase.
     """
+    with self.timed("parse_outputs"):
+      self._set_raw_outputs_from_watson_v3(response_json, output_specs)
+
+  def _set_raw_outputs_from_watson_v3(self, response_json, output_specs):
+    # type: (Dict[str, Any], Dict[str, Dict[str, Any]]) -> None
     # As of April 23, 2019, the structure of a WML TensorFlow model response is:
     # {
     #   "keyed_values" : [
@@ -149,10 +339,8 @@ class InferenceRequest(object):
       key = pair_as_dict["key"]
       values = pair_as_dict["values"]
 
-      # The values that WML returns appear to be in a format that is always
-      # compatible with numpy.array(), so use that function as a shortcut for
-      # decoding.
-      self.raw_outputs[key] = np.array(values)
+      spec = output_specs.get(key) if output_specs is not None else None
+      self.raw_outputs[key] = InferenceRequest.json_to_value(values, spec)
 
   @property
   def processed_inputs(self):
@@ -180,6 +368,134 @@ class InferenceRequest(object):
     else:
       return v
 
+  @staticmethod
+  def json_to_value(values, spec=None):
+    # type: (Any, Dict[str, Any]) -> np.ndarray
+    """
+    Inverse of `value_to_json()`: turn a value parsed from JSON into an
+    array.
+
+    Args:
+      values: Nested JSON arrays of numbers or strings
+      spec: Optional dict with the expected "dtype" (a TensorFlow dtype name
+        such as "float32" or "string") and "shape" (a list of dimensions,
+        with -1 for dimensions of unknown size) of the result. Without a
+        spec, numpy guesses the dtype, which means that e.g. float32 tensors
+        come back as float64.
+
+    Returns the decoded value as a numpy array. Strings come back as an array
+    of Python objects, as they do from a TensorFlow session.
+
+    Raises ValueError if the value doesn't match the shape in `spec`.
+    """
+    if spec is None:
+      # The values that WML returns appear to be in a format that is always
+      # compatible with numpy.array(), so use that function as a shortcut for
+      # decoding.
+      return np.array(values)
+    if spec["dtype"] == "string":
+      result = np.array(values, dtype=object)
+    else:
+      # Telling numpy the dtype up front saves it a pass over the values to
+      # infer one, plus a conversion afterwards.
+      result = np.asarray(values, dtype=spec["dtype"])
+    expected_shape = spec.get("shape")
+    if expected_shape is None:
+      return result
+    if result.size == 0 and result.ndim < len(expected_shape):
+      # JSON can't express the inner dimensions of an empty array.
+      result = result.reshape(result.shape + tuple(
+        max(d, 0) for d in expected_shape[result.ndim:]))
+    if (result.ndim != len(expected_shape)
+        or any(e >= 0 and e != d
+               for e, d in zip(expected_shape, result.shape))):
+      raise ValueError("Expected value of shape {}, but got shape {}"
+                       "".format(expected_shape, list(result.shape)))
+    return result
+
+  @staticmethod
+  def value_to_json_text(v):
+    # type: (Any) -> str
+    """
+    Serialize a single value to compact JSON text, without optional
+    whitespace. Equivalent to `json.dumps(value_to_json(v),
+    separators=(",", ":"))`, but writes numeric arrays directly, without
+    first converting them to nested Python lists, and writes float16/float32
+    values with only as many digits as their precision warrants.
+    """
+    if not isinstance(v, np.ndarray):
+      return json.dumps(InferenceRequest.value_to_json(v),
+                        separators=(",", ":"))
+    if v.dtype == np.object_:
+      # Strings, which come out of TensorFlow as bytes
+      return json.dumps(InferenceRequest._decode_nested_bytes(v.tolist()),
+                        separators=(",", ":"))
+    if v.dtype.kind in "iu":
+      number_format = "%d"
+    elif (v.dtype in InferenceRequest._JSON_NUMBER_FORMATS
+          and np.isfinite(v).all()):
+      # printf writes infinities and NaNs in a form that `json` can't read,
+      # so leave arrays that contain them to the slow path.
+      number_format = InferenceRequest._JSON_NUMBER_FORMATS[v.dtype]
+    else:
+      return json.dumps(v.tolist(), separators=(",", ":"))
+    # Build a template with the nesting of the array and one format
+    # specifier per element, then fill it in with a single % operation.
+    template = number_format
+    for dim in reversed(v.shape):
+      template = "[" + ",".join([template] * dim) + "]"
+    return template % tuple(v.ravel().tolist())
+
+  @staticmethod
+  def _decode_nested_bytes(value):
+    # type: (Any) -> Any
+    if isinstance(value, list):
+      return [InferenceRequest._decode_nested_bytes(v) for v in value]
+    elif isinstance(value, bytes):
+      return value.decode("utf-8")
+    return value
+
+  @staticmethod
+  def to_json_text(obj, compact=True):
+    # type: (Any, bool) -> str
+    """
+    Serialize a JSON-compatible structure that may contain numpy arrays,
+    writing the arrays with `value_to_json_text()`.
+
+    Args:
+      obj: Dicts, lists, and JSON scalars, with numpy arrays and scalars
+        anywhere a JSON value can go.
+      compact: If True, leave out all optional whitespace. Otherwise indent
+        nested structures (but not the contents of arrays) by 4 spaces.
+    """
+    arrays = []  # type: List[np.ndarray]
+
+    def replace_array(value):
+      # `json` calls this for every value it can't serialize itself.
+      if isinstance(value, (np.ndarray, np.generic)):
+        arrays.append(np.asarray(value))
+        return "\0{}\0".format(len(arrays) - 1)
+      raise TypeError("Object of type {} is not JSON serializable"
+                      "".format(type(value).__name__))
+
+    dumps_args = ({"separators": (",", ":")} if compact
+                  else {"indent": 4})
+    text = json.dumps(obj, default=replace_array, **dumps_args)
+    if len(arrays) == 0:
+      return text
+    # Each array is now a string literal holding a NUL-delimited index.
+    pieces = text.split('"\\u0000')
+    if len(pieces) != len(arrays) + 1:
+      # Some other string starts with NUL, so the placeholders are
+      # ambiguous; take the slow path.
+      return json.dumps(
+        obj, default=lambda v: InferenceRequest._decode_nested_bytes(
+          np.asarray(v).tolist()), **dumps_args)
+    for i in range(1, len(pieces)):
+      index, rest = pieces[i].split('\\u0000"', 1)
+      pieces[i] = InferenceRequest.value_to_json_text(arrays[int(index)]) + rest
+    return "".join(pieces)
+
   def processed_inputs_as_watson_v3(self):
     # type: () -> Dict[str, Any]
     """
@@ -262,12 +578,139 @@ class InferenceRequest(object):
     """
     return self._processed_outputs
 
-  def json_result(self):
-    # type: () -> str
+  def json_result(self, compact=False):
+    # type: (bool) -> str
     """
-    Generate a human-readable JSON string version of the result of this request.
+    Generate a JSON string version of the result of this request.
+
+    Records its run time as the "serialize" phase, and the length of the
+    result as the "response" size.
+
+    Args:
+      compact: If True, generate the smallest possible JSON, for sending over
+        the wire. Otherwise generate human-readable JSON.
     """
-    return json.dumps(self.processed_outputs, indent=4)
+    with self.timed("serialize"):
+      if compact:
+        result = InferenceRequest.to_json_text(self.processed_outputs)
+      else:
+        result = json.dumps(self.processed_outputs, indent=4)
+    self.record_size("response", len(result))
+    return result
+
+  def encode_result(self):
+    # type: () -> Tuple[bytes, str]
+    """
+    Serialize `processed_outputs` in the encoding named by
+    `response_encoding`:
+    * "json": Compact JSON.
+    * "msgpack": MessagePack (https://msgpack.org), with the same structure
+      as the JSON encoding. Requires the `msgpack` package.
+    * "arrays": Binary container for numeric arrays, designed to be read
+      with `numpy.frombuffer()` or the equivalent in other languages. The
+      container starts with the four bytes `MAXA`, followed by the length
+      of a JSON header as a little-endian uint32, followed by the header.
+      The header holds every entry of `processed_outputs` that isn't a
+      numeric numpy array, plus the key "__arrays__", a list with the
+      "name", "dtype" (a numpy type string such as "<f4"), "shape", and
+      "offset" of each numeric array. Array data follows the header, which
+      is padded to a multiple of 8 bytes; offsets are from the end of the
+      header and are multiples of 8. Array data is little-endian and
+      C-ordered.
+
+    Returns the encoded bytes and their content type. Records its run time
+    as the "serialize" phase, and the length of the result as the "response"
+    size.
+
+    Raises ValueError if the encoding is unknown or not available.
+    """
+    if self.response_encoding not in InferenceRequest.RESPONSE_ENCODINGS:
+      raise ValueError("Unknown response encoding '{}'. Supported encodings "
+                       "are: {}".format(
+                         self.response_encoding,
+                         list(InferenceRequest.RESPONSE_ENCODINGS.keys())))
+    content_type = InferenceRequest.RESPONSE_ENCODINGS[self.response_encoding]
+    with self.timed("serialize"):
+      if self.response_encoding == "json":
+        payload = InferenceRequest.to_json_text(
+          self.processed_outputs).encode("utf-8")
+      elif self.response_encoding == "msgpack":
+        payload = InferenceRequest._encode_msgpack(self.processed_outputs)
+      else:
+        payload = InferenceRequest._encode_arrays(self.processed_outputs)
+    self.record_size("response", len(payload))
+    return payload, content_type
+
+  @staticmethod
+  def decode_result(payload, encoding):
+    # type: (bytes, str) -> Dict[str, Any]
+    """
+    Inverse of `encode_result()`. Arrays in the "arrays" encoding come back
+    as read-only numpy arrays that share memory with `payload`.
+    """
+    if encoding == "json":
+      return json.loads(payload.decode("utf-8"))
+    elif encoding == "msgpack":
+      import msgpack
+      return msgpack.unpackb(payload, raw=False)
+    elif encoding == "arrays":
+      if payload[:4] != InferenceRequest._ARRAYS_MAGIC:
+        raise ValueError("Payload is not in the 'arrays' encoding")
+      header_len = int(np.frombuffer(payload, dtype="<u4", count=1,
+                                     offset=4)[0])
+      result = json.loads(payload[8:8 + header_len].decode("utf-8"))
+      for a in result.pop("__arrays__"):
+        result[a["name"]] = np.frombuffer(
+          payload, dtype=a["dtype"], count=int(np.prod(a["shape"])),
+          offset=8 + header_len + a["offset"]).reshape(a["shape"])
+      return result
+    raise ValueError("Unknown response encoding '{}'".format(encoding))
+
+  @staticmethod
+  def _encode_msgpack(obj):
+    # type: (Any) -> bytes
+    try:
+      import msgpack
+    except ImportError:
+      raise ValueError("The 'msgpack' response encoding requires the msgpack "
+                       "package")
+    return msgpack.packb(obj, use_bin_type=True,
+                         default=lambda v: np.asarray(v).tolist())
+
+  @staticmethod
+  def _encode_arrays(outputs):
+    # type: (Dict[str, Any]) -> bytes
+    alignment = InferenceRequest._ARRAYS_ALIGNMENT
+    header = {}
+    arrays = []
+    for name, value in outputs.items():
+      if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+        arrays.append((name, np.ascontiguousarray(
+          value, dtype=value.dtype.newbyteorder("<"))))
+      else:
+        header[name] = value
+
+    # Offsets are relative to the end of the header, so that they don't
+    # depend on the size of the header that they are part of.
+    descriptions = []
+    offset = 0
+    for name, value in arrays:
+      descriptions.append({"name": name, "dtype": value.dtype.str,
+                           "shape": list(value.shape), "offset": offset})
+      offset += -(-value.nbytes // alignment) * alignment
+    header["__arrays__"] = descriptions
+    header_text = InferenceRequest.to_json_text(header).encode("utf-8")
+    # Pad the header with spaces, which JSON ignores, so that the array data
+    # starts at an aligned offset.
+    header_text += b" " * (-(8 + len(header_text)) % alignment)
+
+    pieces = [InferenceRequest._ARRAYS_MAGIC,
+              np.array([len(header_text)], dtype="<u4").tobytes(),
+              header_text]
+    for _, value in arrays:
+      pieces.append(value.tobytes())
+      pieces.append(b"\0" * (-value.nbytes % alignment))
+    return b"".join(pieces)
 
 # END MARKER FOR CODE GENERATOR -- DO NOT DELETE
 
@@ -278,7 +721,8 @@ def pass_to_local_tf(
         request, # type: InferenceRequest
         sess, # type: tf.Session
         graph, # type: tf.Graph
-        signature # type: tf.SignatureDef
+        signature, # type: tf.SignatureDef
+        profiler=None # type: Any
   ):
   # type: (...) -> Dict[str, Any]
   """
@@ -286,28 +730,495 @@ def pass_to_local_tf(
   emulating the way that TensorFlow Serving would handle the request.
   Populates `request.raw_outputs` with the results.
 
+  This function resolves the signature's tensors on every call. Code that
+  sends many requests to the same model should use `LocalTFRunner` instead.
+
   Args:
     request: Request to pass to local TensorFlow
     sess: TensorFlow session in which the graph lives
     graph: Graph that has been initialized with the model that this
     inference request targets
     signature: "Method" signature from the SavedModel
+    profiler: Optional `profiling.OpProfiler` for `graph`, which decides
+      whether to trace this run and receives the trace
   """
   input_dict = {}
   for key in signature.inputs:
-    tensor_name = signature.inputs[key].name
-    input_dict[tensor_name] = request.processed_inputs[key]
+    # Inputs backed by PlaceholderWithDefault ops are optional.
+    if key in request.processed_inputs:
+      tensor_name = signature.inputs[key].name
+      input_dict[tensor_name] = request.processed_inputs[key]
   fetch_tensor_names = []
   fetch_output_names = []
   for key in signature.outputs:
     tensor_name = signature.outputs[key].name
     fetch_tensor_names.append(tensor_name)
     fetch_output_names.append(key)
-  results = sess.run(fetch_tensor_names, feed_dict=input_dict)
+  if profiler is not None and profiler.should_sample():
+    run_metadata = tf.RunMetadata()
+    results = sess.run(fetch_tensor_names, feed_dict=input_dict,
+                       options=profiler.run_options(),
+                       run_metadata=run_metadata)
+    profiler.add(run_metadata)
+  else:
+    results = sess.run(fetch_tensor_names, feed_dict=input_dict)
   for i in range(len(fetch_output_names)):
     output_name = fetch_output_names[i]
     request.raw_outputs[output_name] = results[i]
 
 
+def session_config(intra_op_threads=0, inter_op_threads=0):
+  # type: (int, int) -> tf.ConfigProto
+  """
+  Build a session configuration with thread pools of the given sizes.
+
+  TensorFlow runs independent ops of a graph in parallel on the inter-op
+  thread pool and splits large individual ops, such as convolutions, across
+  the intra-op thread pool. By default both pools have one thread per core,
+  so a session that runs several steps at once can have up to twice as many
+  busy threads as cores. When requests run concurrently, smaller pools are
+  usually faster; see benchmarks/session_threads.py.
+
+  Args:
+    intra_op_threads: Size of the intra-op thread pool, or 0 to let
+      TensorFlow choose
+    inter_op_threads: Size of the inter-op thread pool, or 0 to let
+      TensorFlow choose
+  """
+  return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                        inter_op_parallelism_threads=inter_op_threads)
+
+
+def load_saved_model(saved_model_dir, config=None):
+  # type: (str, tf.ConfigProto) -> Tuple[tf.Session, tf.Graph, tf.MetaGraphDef]
+  """
+  Load a SavedModel into a new graph and a session dedicated to that graph.
+
+  Args:
+    saved_model_dir: Location of the SavedModel directory
+    config: Optional session configuration
+
+  Returns a tuple of session, graph, and the MetaGraphDef of the SavedModel.
+  """
+  graph = tf.Graph()
+  sess = tf.Session(graph=graph, config=config)
+  with graph.as_default():
+    meta_graph = tf.saved_model.loader.load(
+      sess,
+      [tf.saved_model.tag_constants.SERVING],
+      saved_model_dir)  # type: tf.MetaGraphDef
+  return sess, graph, meta_graph
+
+
+# Name of the subdirectory of a variants directory that holds the variant of
+# a SavedModel for one batch size
+_BATCH_VARIANT_DIR_FORMAT = "batch_{}"
+_BATCH_VARIANT_DIR_REGEX = re.compile(r"^batch_(\d+)$")
 
 
+def batch_variant_dir(variants_dir, batch_size):
+  # type: (str, int) -> str
+  """
+  Location of the SavedModel variant for `batch_size` in `variants_dir`.
+  """
+  return os.path.join(variants_dir,
+                      _BATCH_VARIANT_DIR_FORMAT.format(batch_size))
+
+
+def load_batch_variants(variants_dir, config=None):
+  # type: (str, tf.ConfigProto) -> Dict[int, Tuple[tf.Session, tf.Graph, tf.MetaGraphDef]]
+  """
+  Load every SavedModel variant in a directory of variants that
+  build_graph.py specialized for fixed batch sizes, each into its own graph
+  and session.
+
+  Args:
+    variants_dir: Directory of variants. Missing directories hold no
+      variants.
+    config: Optional session configuration
+
+  Returns a dict from batch size to the output of `load_saved_model()` for
+  the variant with that batch size.
+  """
+  result = {}
+  if not os.path.isdir(variants_dir):
+    return result
+  for name in sorted(os.listdir(variants_dir)):
+    match = _BATCH_VARIANT_DIR_REGEX.match(name)
+    if match is not None:
+      result[int(match.group(1))] = load_saved_model(
+        os.path.join(variants_dir, name), config)
+  return result
+
+
+class LocalTFRunner(object):
+  """
+  Reusable equivalent of `pass_to_local_tf()` for one signature of a loaded
+  model.
+
+  The signature's input and output tensors are resolved once, when the
+  runner is created. Each distinct combination of fed inputs and requested
+  outputs gets its own callable from `tf.Session.make_callable()`, which is
+  created on first use and then reused, so that subsequent requests skip
+  feed/fetch name resolution and validation. Inputs that a request does
+  not provide are not fed, which lets optional inputs take their default
+  values. If the runner has a `profiling.OpProfiler`, the runs that the
+  profiler samples are traced.
+
+  Instances are safe to use from multiple threads.
+  """
+
+  def __init__(self,
+               sess,  # type: tf.Session
+               graph,  # type: tf.Graph
+               signature,  # type: tf.SignatureDef
+               profiler=None  # type: Any
+               ):
+    """
+    Args:
+      sess: TensorFlow session in which the graph lives
+      graph: Graph that has been initialized with the model that requests
+        target
+      signature: "Method" signature from the SavedModel
+      profiler: Optional `profiling.OpProfiler` for `graph`
+    """
+    self._sess = sess
+    self._profiler = profiler
+    self._graph = graph
+    self._input_names = sorted(signature.inputs.keys())
+    self._input_tensors = {
+      k: graph.get_tensor_by_name(signature.inputs[k].name)
+      for k in self._input_names
+    }
+    self._output_tensors = {
+      k: graph.get_tensor_by_name(signature.outputs[k].name)
+      for k in signature.outputs
+    }
+    self._all_output_names = tuple(sorted(signature.outputs.keys()))
+    self._callables = {}  # type: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], Any]
+    self._callables_lock = threading.Lock()
+
+  @classmethod
+  def from_saved_model(cls, saved_model_dir,
+                       signature_name="serving_default", config=None,
+                       profile_sample_rate=0.0):
+    # type: (str, str, tf.ConfigProto, float) -> LocalTFRunner
+    """
+    Load a SavedModel into a new session and create a runner for one of its
+    signatures.
+
+    Args:
+      saved_model_dir: Location of the SavedModel directory
+      signature_name: Key of the signature to run in the SavedModel's
+        signature map
+      config: Optional session configuration
+      profile_sample_rate: If greater than 0, the runner gets a
+        `profiling.OpProfiler` that traces this fraction of runs
+    """
+    sess, graph, meta_graph = load_saved_model(saved_model_dir, config)
+    profiler = None
+    if profile_sample_rate > 0:
+      from common import profiling
+      profiler = profiling.OpProfiler(graph, profile_sample_rate)
+    return cls(sess, graph, meta_graph.signature_def[signature_name],
+               profiler)
+
+  @property
+  def session(self):
+    # type: () -> tf.Session
+    return self._sess
+
+  @property
+  def graph(self):
+    # type: () -> tf.Graph
+    return self._graph
+
+  @property
+  def profiler(self):
+    # type: () -> Any
+    return self._profiler
+
+  @property
+  def output_names(self):
+    # type: () -> Tuple[str, ...]
+    """
+    Names of all the outputs of the signature, in sorted order.
+    """
+    return self._all_output_names
+
+  def _get_callable(self, input_names, output_names):
+    # type: (Tuple[str, ...], Tuple[str, ...]) -> Any
+    key = (input_names, output_names)
+    result = self._callables.get(key)
+    if result is None:
+      with self._callables_lock:
+        result = self._callables.get(key)
+        if result is None:
+          result = self._sess.make_callable(
+            [self._output_tensors[n] for n in output_names],
+            feed_list=[self._input_tensors[n] for n in input_names],
+            accept_options=self._profiler is not None)
+          self._callables[key] = result
+    return result
+
+  def run(self, request, output_names=None):
+    # type: (InferenceRequest, Sequence[str]) -> None
+    """
+    Pass the processed inputs of a request through the model and populate
+    `request.raw_outputs` with the results.
+
+    Args:
+      request: Request to pass to local TensorFlow
+      output_names: Optional subset of the signature's outputs to compute.
+        By default, all outputs are computed.
+    """
+    if output_names is None:
+      output_names = self._all_output_names
+    else:
+      output_names = tuple(output_names)
+      unknown = set(output_names) - set(self._all_output_names)
+      if len(unknown) > 0:
+        raise ValueError("Signature does not have outputs {}".format(
+          sorted(unknown)))
+    input_names = tuple(k for k in self._input_names
+                        if k in request.processed_inputs)
+    fn = self._get_callable(input_names, output_names)
+    feeds = [request.processed_inputs[k] for k in input_names]
+    if self._profiler is not None and self._profiler.should_sample():
+      run_metadata = tf.RunMetadata()
+      results = fn(*feeds, options=self._profiler.run_options(),
+                   run_metadata=run_metadata)
+      self._profiler.add(run_metadata)
+    else:
+      results = fn(*feeds)
+    for i in range(len(output_names)):
+      request.raw_outputs[output_names[i]] = results[i]
+
+
+class VariantRunner(object):
+  """
+  Runs each request on the variant of a model that was specialized for the
+  request's batch size, if there is one, and on the general version of the
+  model otherwise. A drop-in replacement for `LocalTFRunner`, for one
+  signature.
+
+  Variants come from build_graph.py's --batch_size_variants. Their shapes
+  are fixed, so shape-dependent parts of the graph have been folded away,
+  and they compute the same outputs as the general model.
+
+  Instances are safe to use from multiple threads.
+  """
+
+  def __init__(self,
+               default_runner,  # type: LocalTFRunner
+               variant_runners  # type: Dict[int, LocalTFRunner]
+               ):
+    """
+    Args:
+      default_runner: Runner for the general version of the model, for
+        requests whose batch size has no variant
+      variant_runners: Runner for each batch size that has a variant. Each
+        runner must be for the same signature as `default_runner`.
+    """
+    self._default_runner = default_runner
+    self._variant_runners = dict(variant_runners)
+
+  @property
+  def profiler(self):
+    # type: () -> Any
+    return self._default_runner.profiler
+
+  @property
+  def output_names(self):
+    # type: () -> Tuple[str, ...]
+    return self._default_runner.output_names
+
+  @property
+  def batch_sizes(self):
+    # type: () -> List[int]
+    """
+    Batch sizes that have a variant, in increasing order.
+    """
+    return sorted(self._variant_runners.keys())
+
+  @staticmethod
+  def _batch_size(request):
+    # type: (InferenceRequest) -> int
+    """
+    Batch size of the processed inputs of a request, i.e. the first
+    dimension of the first input that isn't a scalar, or None if every input
+    is a scalar.
+    """
+    for value in request.processed_inputs.values():
+      # np.shape() would copy a list of images into an array first.
+      if isinstance(value, (list, tuple)):
+        return len(value)
+      shape = np.shape(value)
+      if len(shape) > 0:
+        return shape[0]
+    return None
+
+  def run(self, request, output_names=None):
+    # type: (InferenceRequest, Sequence[str]) -> None
+    """
+    Same as `LocalTFRunner.run()`.
+    """
+    runner = self._variant_runners.get(self._batch_size(request),
+                                       self._default_runner)
+    runner.run(request, output_names)
+
+
+class ConcurrentRunner(object):
+  """
+  Runs requests through a function such as `LocalTFRunner.run` on a fixed
+  pool of threads, so that up to `num_threads` of them are in flight at
+  once.
+
+  `tf.Session.run` is thread-safe, and concurrent steps on one session share
+  the session's inter- and intra-op thread pools, so running several
+  requests at once on a single session keeps more cores busy than running
+  them one at a time, without the memory cost of loading the model once per
+  thread. Bounding the number of concurrent steps keeps a burst of requests
+  from oversubscribing those thread pools.
+  """
+
+  def __init__(self,
+               run_fn,  # type: Callable[[InferenceRequest], None]
+               num_threads  # type: int
+               ):
+    """
+    Args:
+      run_fn: Function that takes an `InferenceRequest` with populated
+        `processed_inputs` and populates its `raw_outputs`. Must be safe to
+        call from multiple threads at once, as `LocalTFRunner.run` is.
+      num_threads: Maximum number of calls to `run_fn` in flight at once
+    """
+    if num_threads < 1:
+      raise ValueError("num_threads must be at least 1, got {}"
+                       "".format(num_threads))
+    self._run_fn = run_fn
+    self._num_threads = num_threads
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=num_threads, thread_name_prefix="ConcurrentRunner")
+
+  @property
+  def num_threads(self):
+    # type: () -> int
+    return self._num_threads
+
+  def submit_async(self, request):
+    # type: (InferenceRequest) -> concurrent.futures.Future
+    """
+    Queue a request whose `processed_inputs` are populated.
+
+    Returns a future that completes when `request.raw_outputs` has been
+    populated, or that carries the exception raised while running the
+    request.
+    """
+    return self._executor.submit(self._run_fn, request)
+
+  def submit(self, request):
+    # type: (InferenceRequest) -> None
+    """
+    Blocking version of `submit_async()`.
+    """
+    self.submit_async(request).result()
+
+  def close(self):
+    """
+    Stop the threads after they finish the requests already queued.
+    """
+    self._executor.shutdown(wait=True)
+
+
+# Files in a directory that build_graph.py writes a TensorFlow Lite model to
+TFLITE_MODEL_FILE_NAME = "model.tflite"
+TFLITE_CONSTANTS_FILE_NAME = "constants.npz"
+
+
+class TFLiteRunner(object):
+  """
+  Counterpart of `LocalTFRunner` for a TensorFlow Lite model from
+  build_graph.py. The TensorFlow Lite interpreter maps the model file into
+  memory instead of parsing it, so loading takes next to no time.
+
+  Inputs and outputs are named after the tensors of the TensorFlow graph
+  that the model was converted from. The model only covers part of that
+  graph, so the pre- and post-processing callbacks of the model take on the
+  rest; see `handlers.TFLiteObjectDetectorHandlers`.
+
+  build_graph.py converts the model for a batch size of 1, so the images of
+  a batch go through the interpreter one at a time, and so do requests.
+  Instances are safe to use from multiple threads.
+  """
+
+  def __init__(self, model_dir):
+    # type: (str) -> None
+    """
+    Args:
+      model_dir: Directory that holds the model file and the constants that
+        build_graph.py saved next to it
+    """
+    self._interpreter = tf.lite.Interpreter(
+      model_path=os.path.join(model_dir, TFLITE_MODEL_FILE_NAME))
+    self._interpreter.allocate_tensors()
+    self._input_details = {d["name"]: d
+                           for d in self._interpreter.get_input_details()}
+    self._output_details = {d["name"]: d
+                            for d in self._interpreter.get_output_details()}
+    self._all_output_names = tuple(sorted(self._output_details.keys()))
+    with np.load(os.path.join(model_dir, TFLITE_CONSTANTS_FILE_NAME)) as f:
+      self._constants = {k: f[k] for k in f.files}
+    self._lock = threading.Lock()
+
+  @property
+  def profiler(self):
+    # type: () -> Any
+    """
+    Always None; TensorFlow Lite runs aren't profiled.
+    """
+    return None
+
+  @property
+  def output_names(self):
+    # type: () -> Tuple[str, ...]
+    """
+    Names of all the outputs of the model, in sorted order.
+    """
+    return self._all_output_names
+
+  @property
+  def constants(self):
+    # type: () -> Dict[str, np.ndarray]
+    """
+    Values of the tensors of the original graph that build_graph.py
+    evaluated and saved alongside the model, by tensor name.
+    """
+    return self._constants
+
+  def run(self, request, output_names=None):
+    # type: (InferenceRequest, Sequence[str]) -> None
+    """
+    Same as `LocalTFRunner.run()`. Every input of the model must be in
+    `request.processed_inputs`, with the batch as its first dimension.
+    """
+    if output_names is None:
+      output_names = self._all_output_names
+    inputs = {
+      name: np.asarray(request.processed_inputs[name], dtype=d["dtype"])
+      for name, d in self._input_details.items()
+    }
+    batch_size = len(next(iter(inputs.values())))
+    slices = {n: [] for n in output_names}  # type: Dict[str, List[np.ndarray]]
+    with self._lock:
+      for i in range(batch_size):
+        for name, d in self._input_details.items():
+          self._interpreter.set_tensor(d["index"], inputs[name][i:i + 1])
+        self._interpreter.invoke()
+        for name in output_names:
+          # get_tensor() returns a copy, which stays valid after the next
+          # invoke().
+          slices[name].append(self._interpreter.get_tensor(
+            self._output_details[name]["index"]))
+    for name in output_names:
+      request.raw_outputs[name] = np.concatenate(slices[name])
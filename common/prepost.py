@@ -64,6 +64,21 @@ class PrePost(object):
       error_message: String that describes what went wrong during inference
     """
     raise NotImplementedError()
+
+  def output_specs(self):
+    # type: () -> Dict[str, Dict[str, Any]]
+    """
+    Optional callback that describes the raw model outputs that
+    `post_process` consumes, so that they can be decoded efficiently when
+    they arrive as JSON.
+
+    Returns a dict from output name to a dict with the keys "dtype" (a
+    TensorFlow dtype name such as "float32" or "string") and "shape" (a list
+    of dimensions, with -1 for dimensions of unknown size). Outputs without
+    an entry are decoded by guessing their type. The default implementation
+    returns an empty dict.
+    """
+    return {}
 # END MARKER FOR CODE GENERATOR -- DO NOT REMOVE
 
 
@@ -96,6 +111,71 @@ class GraphGen(object):
     """
     raise NotImplementedError()
 
+  def input_signatures(self):
+    # type: () -> Dict[str, Dict[str, Any]]
+    """
+    Optional callback that describes the values that the input placeholders
+    of the graph returned by `frozen_graph` receive once the model is
+    deployed, i.e. after preprocessing.
+
+    Returns a dict from the name of each input placeholder to a dict with the
+    keys "dtype" (a TensorFlow dtype name such as "uint8") and "shape" (a
+    list of dimensions, with -1 for dimensions of unknown size). The first
+    dimension is the batch. build_graph.py uses these signatures to build
+    variants of the graph that are specialized for fixed batch sizes. The
+    default implementation returns an empty dict, which rules out such
+    variants.
+    """
+    return {}
+
+  def optional_input_node_names(self):
+    # type: () -> List[str]
+    """
+    Returns a list of the names of PlaceholderWithDefault ops in the
+    graphs returned by `pre_processing_graph` and `post_processing_graph`
+    that should be exposed as additional, optional inputs of the final
+    graph. By default there are none.
+    """
+    return []
+
+  def alternate_signatures(self):
+    # type: () -> Dict[str, Dict[str, str]]
+    """
+    Returns additional serving signatures for the final graph, as a dict
+    from signature name to a dict that maps each input name of that
+    signature to the name of the tensor that the input feeds.
+
+    These signatures replace the inputs returned by `input_node_names` with
+    intermediate tensors of the preprocessing graph, so that callers can
+    skip preprocessing steps they don't need. They share the optional inputs
+    and the outputs of the default signature. By default there are none.
+    """
+    return {}
+
+  def tflite_subgraph(self):
+    # type: () -> Dict[str, Any]
+    """
+    Optional callback that describes the part of the graph returned by
+    `frozen_graph` that build_graph.py converts to TensorFlow Lite. Models
+    whose graphs use ops that TensorFlow Lite lacks can convert the part
+    between those ops, and implement the rest in the pre- and
+    post-processing callbacks of the TensorFlow Lite model.
+
+    Returns None if the model has no TensorFlow Lite version, which is the
+    default, or a dict with the keys:
+      "input_shapes": Dict from the name of each input of the part, which
+        can be any op that produces a float tensor, to its shape. The first
+        dimension is the batch, which must be 1.
+      "output_names": List of the names of the ops whose first outputs are
+        the outputs of the part
+      "constants": List of names of tensors of the full graph whose values
+        the pre- and post-processing callbacks need, such as generated
+        anchor boxes. build_graph.py evaluates these tensors once, on an
+        input of zeros of the shape in `input_signatures()`, and saves their
+        values next to the TensorFlow Lite model.
+    """
+    return None
+
   def pre_processing_graph(self):
     # type: () -> tf.Graph
     """
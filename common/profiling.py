@@ -0,0 +1,283 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Sampled per-op profiling of session runs.
+
+Tracing every op of every run slows the model down, so `OpProfiler` only
+asks for a full trace (`tf.RunOptions.FULL_TRACE`) on a configurable
+fraction of runs. It adds up the step stats of the sampled runs by op, by op
+type, and by part of the graph, and can write the most recent sampled run
+as a timeline for chrome://tracing.
+
+The parts of the graph follow the way that build_graph.py puts the model
+together:
+* "preprocessing": the grafted preprocessing graph, i.e. everything that
+  computes `image_tensor_preprocessed` (base64 and image decoding, resize)
+* "detector/nms": the detector's non-maximum suppression postprocessor
+* "detector": the rest of the detector
+* "postprocessing/label_lookup": hash table ops of the grafted
+  postprocessing graph, which turn class IDs into labels
+* "postprocessing": the rest of the grafted postprocessing graph, i.e.
+  everything downstream of the detector's original outputs
+  (`__original__<output name>`)
+* "other": ops that aren't in the graph, such as the runtime's own
+  `_SOURCE` and `_Recv` nodes
+
+Example:
+```
+  profiler = profiling.OpProfiler(graph, sample_rate=0.01)
+  runner = inference_request.LocalTFRunner(sess, graph, signature,
+                                           profiler=profiler)
+  ...  # Run requests
+  print(profiler.format_report())
+  profiler.write_chrome_trace("./temp/timeline.json")
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, List, Set
+
+import collections
+import threading
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+# Op that the preprocessing graph outputs; see `graph_util.add_preprocessing()`.
+# Models built before build_graph.py kept this op have no "preprocessing"
+# part; their preprocessing ops count as part of the detector.
+_PREPROCESSED_OP_NAME = "image_tensor_preprocessed"
+# Prefix that `graph_util.add_postprocessing()` gives the original outputs of
+# the detector
+_ORIGINAL_OUTPUT_PREFIX = "__original__"
+# Name scope of the object detection API's postprocessor, which holds NMS
+_NMS_NAME_PREFIX = "Postprocessor/"
+# Op types of lookup tables and their initializers
+_LOOKUP_OP_TYPES = frozenset([
+  "HashTable", "HashTableV2", "LookupTableFind", "LookupTableFindV2",
+  "InitializeTable", "InitializeTableV2", "LookupTableSize",
+  "LookupTableSizeV2",
+])
+
+
+def _connected_ops(start_ops, downstream):
+  # type: (List[tf.Operation], bool) -> Set[str]
+  """
+  Names of `start_ops` and of every op upstream (or downstream) of them.
+  Upstream includes control inputs; downstream only follows data edges.
+  """
+  seen = set()
+  stack = list(start_ops)
+  while len(stack) > 0:
+    op = stack.pop()
+    if op.name in seen:
+      continue
+    seen.add(op.name)
+    if downstream:
+      stack.extend(c for t in op.outputs for c in t.consumers())
+    else:
+      stack.extend(t.op for t in op.inputs)
+      stack.extend(op.control_inputs)
+  return seen
+
+
+class OpProfiler(object):
+  """
+  Samples a fraction of the runs of one graph with full tracing and
+  aggregates the results. Thread-safe.
+  """
+
+  def __init__(self, graph, sample_rate):
+    # type: (tf.Graph, float) -> None
+    """
+    Args:
+      graph: Graph whose runs will be profiled
+      sample_rate: Fraction of runs to trace, between 0 and 1. Sampling is
+        deterministic: with a rate of 0.01, every hundredth run is traced.
+    """
+    if not 0.0 <= sample_rate <= 1.0:
+      raise ValueError("sample_rate must be between 0 and 1, got {}"
+                       "".format(sample_rate))
+    self._sample_rate = sample_rate
+    self._op_types = {op.name: op.type for op in graph.get_operations()}
+    self._categories = self._categorize(graph)
+    self._lock = threading.Lock()
+    self._num_runs = 0
+    self._num_samples = 0
+    # Op name -> [number of executions, total microseconds]
+    self._op_costs = collections.defaultdict(lambda: [0, 0])
+    self._last_step_stats = None  # type: Any
+
+  def _categorize(self, graph):
+    # type: (tf.Graph) -> Dict[str, str]
+    """
+    Map the name of every op in the graph to the part of the graph that it
+    belongs to.
+    """
+    ops = graph.get_operations()
+    preprocessing = set()
+    if _PREPROCESSED_OP_NAME in self._op_types:
+      preprocessing = _connected_ops(
+        [graph.get_operation_by_name(_PREPROCESSED_OP_NAME)],
+        downstream=False)
+    postprocessing = _connected_ops(
+      [op for op in ops if op.name.startswith(_ORIGINAL_OUTPUT_PREFIX)],
+      downstream=True)
+    # The originals themselves are part of the detector.
+    postprocessing = {n for n in postprocessing
+                      if not n.startswith(_ORIGINAL_OUTPUT_PREFIX)}
+    result = {}
+    for op in ops:
+      if op.type in _LOOKUP_OP_TYPES:
+        # Table ops have no inputs from the detector, so check them first.
+        result[op.name] = "postprocessing/label_lookup"
+      elif op.name in preprocessing:
+        result[op.name] = "preprocessing"
+      elif op.name in postprocessing:
+        result[op.name] = "postprocessing"
+      elif op.name.startswith(_NMS_NAME_PREFIX):
+        result[op.name] = "detector/nms"
+      else:
+        result[op.name] = "detector"
+    return result
+
+  def should_sample(self):
+    # type: () -> bool
+    """
+    Count a run, and return True if it should be traced.
+    """
+    with self._lock:
+      n = self._num_runs
+      self._num_runs += 1
+      return (int((n + 1) * self._sample_rate)
+              > int(n * self._sample_rate))
+
+  @staticmethod
+  def run_options():
+    # type: () -> tf.RunOptions
+    return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+
+  def add(self, run_metadata):
+    # type: (tf.RunMetadata) -> None
+    """
+    Add the step stats of a traced run to the totals.
+    """
+    with self._lock:
+      self._num_samples += 1
+      self._last_step_stats = run_metadata.step_stats
+      for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+          cost = self._op_costs[node_stats.node_name]
+          cost[0] += 1
+          cost[1] += node_stats.all_end_rel_micros
+
+  def report(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns a JSON-friendly summary of the sampled runs: the time spent in
+    each op, op type, and part of the graph, as a total over all samples
+    and as a mean per sampled run, sorted by decreasing total. Times are
+    the sum of the ops' run times, so with ops running in parallel they
+    add up to more than the wall clock time of a run.
+    """
+    with self._lock:
+      num_samples = self._num_samples
+      op_costs = {k: list(v) for k, v in self._op_costs.items()}
+      num_runs = self._num_runs
+
+    def summarize(groups):
+      rows = [
+        {"name": name, "count": count, "total_us": total,
+         "mean_us_per_run": total / num_samples if num_samples > 0 else 0.0}
+        for name, (count, total) in groups.items()
+      ]
+      return sorted(rows, key=lambda r: -r["total_us"])
+
+    by_type = collections.defaultdict(lambda: [0, 0])
+    by_category = collections.defaultdict(lambda: [0, 0])
+    for name, (count, total) in op_costs.items():
+      for key, groups in [(self._op_types.get(name, "(runtime)"), by_type),
+                          (self._categories.get(name, "other"),
+                           by_category)]:
+        groups[key][0] += count
+        groups[key][1] += total
+
+    ops = summarize(op_costs)
+    for row in ops:
+      row["type"] = self._op_types.get(row["name"], "(runtime)")
+      row["category"] = self._categories.get(row["name"], "other")
+    return {
+      "num_runs": num_runs,
+      "num_samples": num_samples,
+      "categories": summarize(by_category),
+      "op_types": summarize(by_type),
+      "ops": ops,
+    }
+
+  def format_report(self, max_rows=20):
+    # type: (int) -> str
+    """
+    `report()` as human-readable tables, with at most `max_rows` rows each.
+    """
+    r = self.report()
+    lines = ["{} of {} runs sampled".format(r["num_samples"], r["num_runs"])]
+    for title, key in [("Part of graph", "categories"),
+                       ("Op type", "op_types"), ("Op", "ops")]:
+      lines.append("")
+      lines.append("{:<60} {:>10} {:>14}".format(title, "count",
+                                                 "us per run"))
+      for row in r[key][:max_rows]:
+        name = row["name"]
+        if key == "ops":
+          name = "{} ({})".format(name, row["type"])
+        lines.append("{:<60} {:>10} {:>14.1f}".format(
+          name[-60:], row["count"], row["mean_us_per_run"]))
+    return "\n".join(lines)
+
+  def chrome_trace(self):
+    # type: () -> str
+    """
+    The most recent sampled run as a Chrome trace (JSON text), for
+    chrome://tracing. Returns None if no run has been sampled yet.
+    """
+    with self._lock:
+      step_stats = self._last_step_stats
+    if step_stats is None:
+      return None
+    return timeline.Timeline(step_stats).generate_chrome_trace_format()
+
+  def write_chrome_trace(self, path):
+    # type: (str) -> bool
+    """
+    Write `chrome_trace()` to a file. Returns False, without writing
+    anything, if no run has been sampled yet.
+    """
+    trace = self.chrome_trace()
+    if trace is None:
+      return False
+    with open(path, "w") as f:
+      f.write(trace)
+    return True
+
+  def clear(self):
+    """
+    Drop every sample collected so far.
+    """
+    with self._lock:
+      self._num_runs = 0
+      self._num_samples = 0
+      self._op_costs.clear()
+      self._last_step_stats = None
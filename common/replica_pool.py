@@ -0,0 +1,648 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Pool of worker processes, each with its own copy of a model.
+
+Pre- and post-processing run in Python and hold the GIL, so one process
+can't keep a large machine busy no matter how many threads it runs. The
+pool in this module starts N worker processes, each of which builds a
+"replica" object (for example, something that loads the SavedModel and runs
+requests through `ObjectDetectorHandlers`), and dispatches calls to the
+replicas from the front-end process.
+
+The bulk data of each call, i.e. the request body going in and the encoded
+response coming out, moves through named shared memory blocks instead of
+being pickled through a pipe; only a small message with the name of the
+block goes through the pipe. Shared memory comes from
+`multiprocessing.shared_memory` on Python 3.8 and later, and from memory-
+mapped files in /dev/shm on older versions.
+
+Workers that die are restarted. Calls that were in flight on a dead worker
+fail, rather than being retried, since the call may have been what killed
+the worker.
+
+Workers can be pinned to disjoint sets of cores, e.g. from `core_groups()`.
+On hosts with several NUMA nodes, a single TensorFlow session spreads its
+thread pools over every node and loses cache locality; K pinned workers,
+each with thread pools sized to its own cores, keep each model replica's
+working set local to one node. TensorFlow 1.x has one intra-op thread pool
+per process, so pinning has to happen at the granularity of processes
+rather than of sessions.
+
+Example:
+```
+  class Replica(object):
+    def __init__(self, saved_model_dir):
+      ...  # Load the model
+    def predict(self, body, threshold):
+      ...  # Runs in a worker process
+      return encoded_result, {"status": 200}
+
+  pool = replica_pool.ReplicaPool(Replica, {"saved_model_dir": "..."}, 4)
+  payload, metadata = pool.call("predict", body, threshold=0.5)
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import atexit
+import concurrent.futures
+import itertools
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+import uuid
+
+try:
+  from multiprocessing import shared_memory
+except ImportError:
+  # Python < 3.8
+  shared_memory = None
+
+
+# Directory for shared memory files when multiprocessing.shared_memory isn't
+# available. /dev/shm is a RAM-backed file system on Linux.
+_SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_SHM_PREFIX = "max_replica_"
+
+# Sysfs directories with the CPU and NUMA topology of the host
+_CPU_SYSFS_DIR = "/sys/devices/system/cpu"
+_NODE_SYSFS_DIR = "/sys/devices/system/node"
+
+# How long close() waits for a worker to exit before terminating it
+_SHUTDOWN_TIMEOUT_SECS = 10.0
+
+
+class _SharedBuffer(object):
+  """
+  Named block of memory that other processes can attach to by name.
+  """
+
+  def __init__(self, name, size, create):
+    # type: (str, int, bool) -> None
+    # Zero-length blocks aren't allowed.
+    size = max(size, 1)
+    if shared_memory is not None:
+      self._shm = shared_memory.SharedMemory(name=name, create=create,
+                                             size=size if create else 0)
+      self._mmap = None
+      self.buf = self._shm.buf
+    else:
+      self._shm = None
+      path = os.path.join(_SHM_DIR, name)
+      if create:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        os.ftruncate(fd, size)
+      else:
+        fd = os.open(path, os.O_RDWR)
+        size = os.fstat(fd).st_size
+      try:
+        self._mmap = mmap.mmap(fd, size)
+      finally:
+        os.close(fd)
+      self.buf = memoryview(self._mmap)
+    self.name = name
+
+  @classmethod
+  def create(cls, size):
+    # type: (int) -> _SharedBuffer
+    return cls(_SHM_PREFIX + uuid.uuid4().hex, size, create=True)
+
+  @classmethod
+  def attach(cls, name):
+    # type: (str) -> _SharedBuffer
+    return cls(name, 0, create=False)
+
+  @classmethod
+  def write(cls, data):
+    # type: (bytes) -> str
+    """
+    Copy `data` into a new block and return the name of the block. The
+    block stays around until someone calls `unlink()` on it.
+    """
+    block = cls.create(len(data))
+    try:
+      block.buf[:len(data)] = data
+    finally:
+      block.close()
+    return block.name
+
+  @classmethod
+  def read(cls, name, size, unlink):
+    # type: (str, int, bool) -> bytes
+    """
+    Copy the first `size` bytes of a block, optionally removing the block
+    afterwards.
+    """
+    block = cls.attach(name)
+    try:
+      return bytes(block.buf[:size])
+    finally:
+      block.close()
+      if unlink:
+        block.unlink()
+
+  def close(self):
+    """
+    Detach from the block in this process. The block itself survives.
+    """
+    self.buf.release()
+    if self._shm is not None:
+      self._shm.close()
+    else:
+      self._mmap.close()
+
+  def unlink(self):
+    """
+    Remove the block. Must be called exactly once, by any process.
+    """
+    if self._shm is not None:
+      self._shm.unlink()
+    else:
+      os.unlink(os.path.join(_SHM_DIR, self.name))
+
+  @staticmethod
+  def unlink_name(name):
+    # type: (str) -> None
+    try:
+      block = _SharedBuffer.attach(name)
+    except FileNotFoundError:
+      return
+    block.close()
+    block.unlink()
+
+
+def _parse_cpu_list(text):
+  # type: (str) -> List[int]
+  """
+  Parse a Linux CPU list such as "0-3,8-11".
+  """
+  cpus = []
+  for part in text.strip().split(","):
+    if len(part) == 0:
+      continue
+    if "-" in part:
+      first, last = part.split("-")
+      cpus.extend(range(int(first), int(last) + 1))
+    else:
+      cpus.append(int(part))
+  return cpus
+
+
+def _read_int(path, default):
+  # type: (str, int) -> int
+  try:
+    with open(path) as f:
+      return int(f.read().strip())
+  except (OSError, ValueError):
+    return default
+
+
+def _cpu_numa_nodes():
+  # type: () -> Dict[int, int]
+  """
+  Returns a dict from CPU number to NUMA node, which is empty if the host
+  doesn't say.
+  """
+  result = {}
+  try:
+    nodes = [n for n in os.listdir(_NODE_SYSFS_DIR)
+             if n.startswith("node") and n[4:].isdigit()]
+  except OSError:
+    return result
+  for node in nodes:
+    try:
+      with open(os.path.join(_NODE_SYSFS_DIR, node, "cpulist")) as f:
+        cpus = _parse_cpu_list(f.read())
+    except OSError:
+      continue
+    for cpu in cpus:
+      result[cpu] = int(node[4:])
+  return result
+
+
+def core_groups(num_groups):
+  # type: (int) -> List[List[int]]
+  """
+  Split the CPUs that this process may run on into `num_groups` disjoint
+  groups of nearly equal size, for use as the `cpu_sets` argument of
+  `ReplicaPool`.
+
+  CPUs are ordered by NUMA node, socket, and physical core before the split,
+  so that a group doesn't straddle two nodes unless it has to, and
+  hyperthreads of the same core end up in the same group.
+  """
+  cpus = sorted(os.sched_getaffinity(0))
+  if num_groups < 1 or num_groups > len(cpus):
+    raise ValueError("Can't split {} CPUs into {} groups"
+                     "".format(len(cpus), num_groups))
+  nodes = _cpu_numa_nodes()
+
+  def topology_key(cpu):
+    topology_dir = os.path.join(_CPU_SYSFS_DIR, "cpu{}".format(cpu),
+                                "topology")
+    return (nodes.get(cpu, 0),
+            _read_int(os.path.join(topology_dir, "physical_package_id"), 0),
+            _read_int(os.path.join(topology_dir, "core_id"), cpu),
+            cpu)
+
+  cpus.sort(key=topology_key)
+  groups = []
+  start = 0
+  for i in range(num_groups):
+    end = start + len(cpus) // num_groups + (
+      1 if i < len(cpus) % num_groups else 0)
+    groups.append(sorted(cpus[start:end]))
+    start = end
+  return groups
+
+
+def _pin_process(cpus):
+  # type: (Sequence[int]) -> None
+  """
+  Restrict every thread of this process, and any threads it creates later,
+  to `cpus`.
+  """
+  # On Linux, sched_setaffinity(0) only affects the calling thread. Threads
+  # created later inherit the mask of the thread that creates them, but
+  # threads that already exist (e.g. from imports) need to be set one by
+  # one.
+  os.sched_setaffinity(0, cpus)
+  try:
+    thread_ids = [int(t) for t in os.listdir("/proc/self/task")]
+  except OSError:
+    return
+  for thread_id in thread_ids:
+    try:
+      os.sched_setaffinity(thread_id, cpus)
+    except OSError:
+      # Thread exited in the meantime
+      pass
+
+
+def _worker_main(factory, factory_kwargs, cpus, num_threads, conn):
+  # type: (Callable[..., Any], Dict[str, Any], Sequence[int], int, Any) -> None
+  """
+  Main loop of a worker process. If `cpus` isn't None, pins the process to
+  those CPUs before creating the replica, so that the thread pools that
+  the replica creates only use those CPUs.
+
+  Runs up to `num_threads` calls on the replica at once, so that a replica
+  can batch or overlap the calls it gets, and answers calls in the order
+  that they finish.
+
+  Messages in: None to shut down, or
+  (call ID, method name, input block name, input size, keyword args).
+  Messages out: ("ready",) once the replica exists, then for each call either
+  ("result", call ID, output block name, output size, metadata) or
+  ("error", call ID, error message).
+  """
+  if cpus is not None:
+    _pin_process(cpus)
+  replica = factory(**factory_kwargs)
+  send_lock = threading.Lock()
+
+  def run_call(call_id, method, in_name, in_size, kwargs):
+    try:
+      data = _SharedBuffer.read(in_name, in_size, unlink=False)
+      payload, metadata = getattr(replica, method)(data, **kwargs)
+      out_name = _SharedBuffer.write(payload)
+      message = ("result", call_id, out_name, len(payload), metadata)
+    except Exception as e:
+      message = ("error", call_id, "{}: {}".format(type(e).__name__, e))
+    with send_lock:
+      conn.send(message)
+
+  conn.send(("ready",))
+  executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=num_threads, thread_name_prefix="ReplicaCall")
+  try:
+    while True:
+      try:
+        message = conn.recv()
+      except EOFError:
+        # Front end went away
+        return
+      if message is None:
+        return
+      executor.submit(run_call, *message)
+  finally:
+    executor.shutdown(wait=True)
+
+
+class _Call(object):
+  """
+  A call that has been sent to a worker and hasn't come back yet.
+  """
+  def __init__(self, in_name):
+    # type: (str) -> None
+    self.in_name = in_name
+    self.future = concurrent.futures.Future()
+
+
+class _Worker(object):
+  """
+  Front-end bookkeeping for one worker process.
+  """
+  def __init__(self, process, conn):
+    self.process = process
+    self.conn = conn
+    self.send_lock = threading.Lock()
+    self.ready = False
+    # False once the process has exited. Dead workers get no more calls.
+    self.alive = True
+    # Call ID -> _Call
+    self.outstanding = {}  # type: Dict[int, _Call]
+
+
+class ReplicaPool(object):
+  """
+  Starts `num_workers` worker processes, each of which calls
+  `factory(**factory_kwargs)` once to create its replica, and dispatches
+  calls to the worker with the fewest calls outstanding.
+
+  Replica methods that the pool calls take the input bytes as their first
+  argument, plus keyword arguments, and return a tuple of output bytes and
+  a small picklable metadata object.
+  """
+
+  def __init__(self,
+               factory,  # type: Callable[..., Any]
+               factory_kwargs,  # type: Dict[str, Any]
+               num_workers,  # type: int
+               cpu_sets=None,  # type: Sequence[Sequence[int]]
+               threads_per_worker=1  # type: int
+               ):
+    """
+    Start the worker processes. Doesn't wait for them to create their
+    replicas; calls made in the meantime wait in the workers' queues.
+
+    Args:
+      factory: Function or class that creates a replica. Must be picklable,
+        i.e. defined at the top level of a module.
+      factory_kwargs: Picklable keyword arguments for `factory`
+      num_workers: Number of worker processes
+      cpu_sets: Optional list with one collection of CPU numbers per
+        worker. Each worker, including any replacement for it, is pinned to
+        its CPUs. See `core_groups()`.
+      threads_per_worker: Number of calls that each worker runs on its
+        replica at once. Must be more than 1 for the replica to batch
+        calls or run several of them concurrently.
+    """
+    if num_workers < 1:
+      raise ValueError("num_workers must be at least 1, got {}"
+                       "".format(num_workers))
+    if threads_per_worker < 1:
+      raise ValueError("threads_per_worker must be at least 1, got {}"
+                       "".format(threads_per_worker))
+    if cpu_sets is not None and len(cpu_sets) != num_workers:
+      raise ValueError("Got {} CPU sets for {} workers"
+                       "".format(len(cpu_sets), num_workers))
+    self._cpu_sets = (None if cpu_sets is None
+                      else [sorted(c) for c in cpu_sets])
+    self._factory = factory
+    self._factory_kwargs = dict(factory_kwargs)
+    self._threads_per_worker = threads_per_worker
+    # Fork would copy whatever threads and TensorFlow state the front end
+    # has, so always start workers from scratch.
+    self._ctx = multiprocessing.get_context("spawn")
+    self._lock = threading.Lock()
+    self._call_ids = itertools.count()
+    self._closed = False
+    self._num_calls = 0
+    self._num_restarts = 0
+    self._workers = [None] * num_workers  # type: List[_Worker]
+    for i in range(num_workers):
+      self._start_worker(i)
+    # Otherwise the workers exiting along with this process look like
+    # crashes, and we would try to restart them.
+    atexit.register(self.close)
+
+  def _start_worker(self, index):
+    # type: (int) -> None
+    parent_conn, child_conn = self._ctx.Pipe()
+    process = self._ctx.Process(
+      target=_worker_main,
+      args=(self._factory, self._factory_kwargs,
+            None if self._cpu_sets is None else self._cpu_sets[index],
+            self._threads_per_worker, child_conn),
+      name="ReplicaWorker-{}".format(index), daemon=True)
+    process.start()
+    # Close our copy of the child's end, so that we see EOF when the child
+    # dies.
+    child_conn.close()
+    worker = _Worker(process, parent_conn)
+    self._workers[index] = worker
+    threading.Thread(target=self._read_results, args=(index, worker),
+                     name="ReplicaReader-{}".format(index),
+                     daemon=True).start()
+
+  @property
+  def num_workers(self):
+    # type: () -> int
+    return len(self._workers)
+
+  def stats(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns a point-in-time snapshot of the pool's state as a JSON-friendly
+    dict.
+    """
+    with self._lock:
+      return {
+        "num_workers": len(self._workers),
+        "num_calls": self._num_calls,
+        "num_restarts": self._num_restarts,
+        "outstanding_calls": [len(w.outstanding) for w in self._workers],
+        "ready": [w.ready for w in self._workers],
+        "alive": [w.alive for w in self._workers],
+        "cpu_sets": self._cpu_sets,
+      }
+
+  def call_async(self, method, data, **kwargs):
+    # type: (str, bytes, **Any) -> concurrent.futures.Future
+    """
+    Call a method of one of the replicas.
+
+    Args:
+      method: Name of the replica method
+      data: Input bytes, which go to the worker through shared memory
+      kwargs: Small picklable keyword arguments for the method
+
+    Returns a future for the (output bytes, metadata) tuple that the method
+    returns. If the method raises, or the worker dies, the future carries a
+    RuntimeError.
+
+    Raises RuntimeError if no worker process is alive, e.g. because every
+    worker failed to create its replica.
+    """
+    in_name = _SharedBuffer.write(data)
+    with self._lock:
+      try:
+        live_workers = self._live_workers()
+      except Exception:
+        _SharedBuffer.unlink_name(in_name)
+        raise
+      worker = min(live_workers, key=lambda w: len(w.outstanding))
+      call_id, call = self._add_call(worker, in_name)
+    self._send_call(worker, call_id, call, method, len(data), kwargs)
+    return call.future
+
+  def call(self, method, data, **kwargs):
+    # type: (str, bytes, **Any) -> Tuple[bytes, Any]
+    """
+    Blocking version of `call_async()`.
+    """
+    return self.call_async(method, data, **kwargs).result()
+
+  def call_all(self, method, data, **kwargs):
+    # type: (str, bytes, **Any) -> List[Tuple[bytes, Any]]
+    """
+    Call a method of every replica whose worker is alive, e.g. to collect
+    each replica's counters, and wait for the results. Takes the same
+    arguments as `call_async()`.
+
+    Returns one (output bytes, metadata) tuple per live worker. Raises
+    RuntimeError if any of the calls fails or no worker process is alive.
+    """
+    # Each call needs its own input block, since the worker's answer frees
+    # it. Create them before taking the lock, as `call_async()` does.
+    in_names = [_SharedBuffer.write(data) for _ in self._workers]
+    with self._lock:
+      try:
+        live_workers = self._live_workers()
+      except Exception:
+        for in_name in in_names:
+          _SharedBuffer.unlink_name(in_name)
+        raise
+      for in_name in in_names[len(live_workers):]:
+        _SharedBuffer.unlink_name(in_name)
+      calls = [(worker,) + self._add_call(worker, in_name)
+               for worker, in_name in zip(live_workers, in_names)]
+    for worker, call_id, call in calls:
+      self._send_call(worker, call_id, call, method, len(data), kwargs)
+    return [call.future.result() for _, _, call in calls]
+
+  def _live_workers(self):
+    # type: () -> List[_Worker]
+    """
+    Returns the workers that can take calls. Caller must hold the lock.
+    """
+    if self._closed:
+      raise ValueError("Pool is closed")
+    live_workers = [w for w in self._workers if w.alive]
+    if len(live_workers) == 0:
+      raise RuntimeError("No replica worker process is running")
+    return live_workers
+
+  def _add_call(self, worker, in_name):
+    # type: (_Worker, str) -> Tuple[int, _Call]
+    """
+    Registers a call on `worker` and returns its ID and the call. Caller
+    must hold the lock.
+    """
+    call_id = next(self._call_ids)
+    call = _Call(in_name)
+    worker.outstanding[call_id] = call
+    self._num_calls += 1
+    return call_id, call
+
+  def _send_call(self, worker, call_id, call, method, in_size, kwargs):
+    # type: (_Worker, int, _Call, str, int, Dict[str, Any]) -> None
+    try:
+      with worker.send_lock:
+        worker.conn.send((call_id, method, call.in_name, in_size, kwargs))
+    except (OSError, ValueError) as e:
+      # The worker died after we picked it. Fail the call, unless the reader
+      # thread has already failed it along with the worker's other calls.
+      with self._lock:
+        unsent = worker.outstanding.pop(call_id, None) is not None
+      if unsent:
+        _SharedBuffer.unlink_name(call.in_name)
+        call.future.set_exception(RuntimeError(
+          "Could not send the call to the replica worker process: {}"
+          "".format(e)))
+
+  def close(self):
+    """
+    Shut down the worker processes after they finish their outstanding
+    calls.
+    """
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      workers = list(self._workers)
+    for w in workers:
+      try:
+        with w.send_lock:
+          w.conn.send(None)
+      except (OSError, ValueError):
+        pass
+    for w in workers:
+      w.process.join(_SHUTDOWN_TIMEOUT_SECS)
+      if w.process.is_alive():
+        w.process.terminate()
+
+  def _read_results(self, index, worker):
+    # type: (int, _Worker) -> None
+    """
+    Body of the thread that receives results from one worker, and restarts
+    the worker if it dies.
+    """
+    while True:
+      try:
+        message = worker.conn.recv()
+      except (EOFError, OSError):
+        break
+      if message[0] == "ready":
+        with self._lock:
+          worker.ready = True
+        continue
+      call_id = message[1]
+      with self._lock:
+        call = worker.outstanding.pop(call_id)
+      _SharedBuffer.unlink_name(call.in_name)
+      if message[0] == "result":
+        _, _, out_name, out_size, metadata = message
+        call.future.set_result(
+          (_SharedBuffer.read(out_name, out_size, unlink=True), metadata))
+      else:
+        call.future.set_exception(RuntimeError(message[2]))
+
+    # The worker exited.
+    worker.process.join()
+    with self._lock:
+      worker.alive = False
+      failed = list(worker.outstanding.values())
+      worker.outstanding.clear()
+      restart = not self._closed
+      if restart and not worker.ready:
+        # It died before it created its replica; starting another one is
+        # likely to fail the same way.
+        restart = False
+      if restart:
+        self._num_restarts += 1
+        self._start_worker(index)
+    for call in failed:
+      _SharedBuffer.unlink_name(call.in_name)
+      call.future.set_exception(RuntimeError(
+        "Replica worker process exited with code {} while handling the call"
+        "".format(worker.process.exitcode)))
@@ -0,0 +1,186 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Histograms of the phase timings and payload sizes of requests.
+
+`InferenceRequest` records how long each phase of its lifecycle takes (see
+`InferenceRequest.timed()`) and how big its payloads are, and passes each
+value to any registered listeners. `RequestMetrics` is such a listener: it
+aggregates the values of all requests into fixed-bucket histograms, which
+are cheap to update and can be exported as is to monitoring systems that
+take cumulative bucket counts, such as Prometheus.
+
+Example:
+```
+  metrics = request_metrics.RequestMetrics()
+  metrics.attach()
+  ...  # Serve requests
+  print(metrics.snapshot()["phases"]["pre_process"]["p99_secs"])
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+import bisect
+import threading
+
+# Local imports
+from common.inference_request import InferenceRequest
+
+# Upper bounds of the histogram buckets: 50 microseconds to about 100
+# seconds for phases, and 256 bytes to 256 MB for sizes. Values above the
+# last bound go into an overflow bucket.
+_PHASE_BUCKETS_SECS = [5e-5 * 2 ** i for i in range(22)]
+_SIZE_BUCKETS_BYTES = [256 * 4 ** i for i in range(11)]
+
+_PERCENTILES = [50, 95, 99]
+
+
+class _Histogram(object):
+  """
+  Counts of values in fixed buckets. Not thread-safe by itself.
+  """
+
+  def __init__(self, bounds):
+    # type: (List[float]) -> None
+    self._bounds = bounds
+    self._counts = [0] * (len(bounds) + 1)
+    self._sum = 0.0
+    self._max = 0.0
+
+  def add(self, value):
+    # type: (float) -> None
+    self._counts[bisect.bisect_left(self._bounds, value)] += 1
+    self._sum += value
+    self._max = max(self._max, value)
+
+  def merge(self, snapshot, unit):
+    # type: (Dict[str, Any], str) -> None
+    """
+    Adds the values counted in `snapshot`, the result of `snapshot(unit)`
+    on a histogram with the same bounds.
+    """
+    previous = 0
+    for i, (_, cumulative) in enumerate(snapshot["buckets"]):
+      self._counts[i] += cumulative - previous
+      previous = cumulative
+    self._sum += snapshot["sum_" + unit]
+    self._max = max(self._max, snapshot["max_" + unit])
+
+  def snapshot(self, unit):
+    # type: (str) -> Dict[str, Any]
+    """
+    Returns count, sum, mean, max, and percentiles of the values, plus
+    cumulative bucket counts. Percentiles are the upper bounds of the
+    buckets that contain them, and so overestimate by up to one bucket.
+    """
+    count = sum(self._counts)
+    result = {
+      "count": count,
+      "sum_" + unit: self._sum,
+      "mean_" + unit: self._sum / count if count > 0 else 0.0,
+      "max_" + unit: self._max,
+    }
+    cumulative = []
+    total = 0
+    for c in self._counts:
+      total += c
+      cumulative.append(total)
+    for p in _PERCENTILES:
+      rank = p / 100.0 * count
+      i = bisect.bisect_left(cumulative, rank) if count > 0 else 0
+      result["p{}_{}".format(p, unit)] = (
+        self._bounds[i] if i < len(self._bounds) else self._max)
+    # Prometheus-style "le" buckets; the overflow bucket is "+Inf".
+    result["buckets"] = [[b, n] for b, n in zip(self._bounds, cumulative)]
+    result["buckets"].append(["+Inf", cumulative[-1]])
+    return result
+
+
+class RequestMetrics(object):
+  """
+  Thread-safe histograms of the phase durations and payload sizes that
+  requests record, one histogram per phase or payload name.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._phases = {}  # type: Dict[str, _Histogram]
+    self._sizes = {}  # type: Dict[str, _Histogram]
+
+  def attach(self):
+    """
+    Start receiving the values that every `InferenceRequest` records.
+    """
+    InferenceRequest.add_listener(self.record)
+
+  def detach(self):
+    """
+    Stop receiving values. Histograms keep what they have.
+    """
+    InferenceRequest.remove_listener(self.record)
+
+  def record(self, kind, name, value):
+    # type: (str, str, float) -> None
+    """
+    Listener for `InferenceRequest.add_listener()`.
+    """
+    if kind == "phase":
+      histograms, bounds = self._phases, _PHASE_BUCKETS_SECS
+    else:
+      histograms, bounds = self._sizes, _SIZE_BUCKETS_BYTES
+    with self._lock:
+      histogram = histograms.get(name)
+      if histogram is None:
+        histogram = histograms[name] = _Histogram(bounds)
+      histogram.add(value)
+
+  def merge(self, snapshot):
+    # type: (Dict[str, Any]) -> None
+    """
+    Adds the values counted in `snapshot`, the result of `snapshot()` on
+    another `RequestMetrics`, e.g. one in another process. Bucket counts are
+    cumulative, so they add, and percentiles come out as if this object had
+    recorded every value itself.
+    """
+    with self._lock:
+      for histograms, bounds, key, unit in [
+          (self._phases, _PHASE_BUCKETS_SECS, "phases", "secs"),
+          (self._sizes, _SIZE_BUCKETS_BYTES, "sizes", "bytes")]:
+        for name, histogram_snapshot in snapshot[key].items():
+          histogram = histograms.get(name)
+          if histogram is None:
+            histogram = histograms[name] = _Histogram(bounds)
+          histogram.merge(histogram_snapshot, unit)
+
+  def snapshot(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns a point-in-time copy of every histogram as a JSON-friendly dict,
+    with phase durations in seconds and sizes in bytes.
+    """
+    with self._lock:
+      return {
+        "phases": {k: h.snapshot("secs") for k, h in self._phases.items()},
+        "sizes": {k: h.snapshot("bytes") for k, h in self._sizes.items()},
+      }
+
+  def clear(self):
+    with self._lock:
+      self._phases.clear()
+      self._sizes.clear()
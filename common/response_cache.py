@@ -0,0 +1,298 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Content-addressed cache of raw model outputs.
+
+Sits between pre- and post-processing, in the same place as
+`batching.BatchingScheduler`. Each row of a request's batched processed
+inputs (i.e. each image) is hashed, and the model only runs on rows whose
+outputs aren't already cached. Rows that are being computed for another
+request at the same time wait for that computation instead of starting
+their own.
+
+Inputs that only affect post-processing, such as a detection threshold, are
+left out of the cache key and are not fed to the model, so that the cached
+outputs are valid for any value of those inputs. Post-processing then
+applies each request's own value.
+
+Example:
+```
+  cache = response_cache.ResponseCache(
+    lambda r: inference_request.pass_to_local_tf(r, sess, graph, signature),
+    max_bytes=64 * 1024 * 1024, ignored_inputs=["threshold"])
+  handlers.pre_process(request)
+  cache.run(request)  # Populates request.raw_outputs
+  handlers.post_process(request)
+```
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List, Sequence
+
+import collections
+import concurrent.futures
+import hashlib
+import threading
+import numpy as np
+
+# Local imports
+from common.inference_request import InferenceRequest
+
+
+class ResponseCache(object):
+  """
+  Thread-safe LRU cache of per-row raw outputs, bounded by the total size in
+  bytes of the cached outputs.
+  """
+
+  def __init__(self,
+               run_fn,  # type: Callable[[InferenceRequest], None]
+               max_bytes,  # type: int
+               ignored_inputs=None,  # type: Sequence[str]
+               key_fns=None  # type: Dict[str, Callable[[Any], bytes]]
+               ):
+    """
+    Args:
+      run_fn: Function that takes an `InferenceRequest` with populated
+        `processed_inputs` and populates its `raw_outputs`, for example a
+        closure around `inference_request.pass_to_local_tf` or
+        `batching.BatchingScheduler.submit`. Every output must have the
+        batch as its first dimension.
+      max_bytes: Upper bound on the total size of the cached outputs.
+      ignored_inputs: Names of processed inputs that don't affect the
+        cached outputs. These inputs are removed from requests before they
+        are passed to `run_fn`, so the model uses their default values.
+      key_fns: Optional dict from the name of a batched input to a function
+        that turns one row of that input into the bytes to hash. Use this
+        to make different encodings of the same data share cache entries,
+        e.g. base64 text and raw bytes of the same image file. Rows of
+        other inputs are hashed as is.
+    """
+    if max_bytes < 0:
+      raise ValueError("max_bytes must be non-negative, got {}"
+                       "".format(max_bytes))
+    self._run_fn = run_fn
+    self._max_bytes = max_bytes
+    self._ignored_inputs = frozenset(ignored_inputs or [])
+    self._key_fns = dict(key_fns) if key_fns is not None else {}
+    self._lock = threading.Lock()
+    # Key -> (row outputs, size in bytes), least recently used first
+    self._entries = collections.OrderedDict()
+    # Key -> future for rows that some request is currently computing
+    self._in_flight = {}  # type: Dict[bytes, concurrent.futures.Future]
+    self._num_bytes = 0
+    self._num_hits = 0
+    self._num_misses = 0
+    self._num_coalesced = 0
+    self._num_evictions = 0
+
+  def stats(self):
+    # type: () -> Dict[str, Any]
+    """
+    Returns a point-in-time copy of the cache's counters as a JSON-friendly
+    dict. Counts are in rows (i.e. images), not requests.
+    """
+    with self._lock:
+      return {
+        "num_entries": len(self._entries),
+        "num_bytes": self._num_bytes,
+        "max_bytes": self._max_bytes,
+        "num_hits": self._num_hits,
+        "num_misses": self._num_misses,
+        "num_coalesced": self._num_coalesced,
+        "num_evictions": self._num_evictions,
+      }
+
+  def clear(self):
+    """
+    Drop every cached entry. Doesn't affect in-flight computations.
+    """
+    with self._lock:
+      self._entries.clear()
+      self._num_bytes = 0
+
+  def run(self, request):
+    # type: (InferenceRequest) -> None
+    """
+    Populate `request.raw_outputs`, running `run_fn` on only those rows of
+    `request.processed_inputs` whose outputs are neither cached nor being
+    computed for another request.
+
+    Raises whatever `run_fn` raises. Requests that were waiting on the
+    failed rows get the same exception.
+    """
+    keys = self._row_keys(request)
+    rows = [None] * len(keys)  # type: List[Any]
+    to_compute = collections.OrderedDict()  # Key -> row index
+    to_wait_for = []  # (row index, future)
+    with self._lock:
+      for i, key in enumerate(keys):
+        if key in self._entries:
+          self._entries.move_to_end(key)
+          rows[i] = self._entries[key][0]
+          self._num_hits += 1
+        elif key in self._in_flight:
+          to_wait_for.append((i, self._in_flight[key]))
+          self._num_coalesced += 1
+        else:
+          to_compute[key] = i
+          self._in_flight[key] = concurrent.futures.Future()
+          self._num_misses += 1
+
+    # Compute this request's own rows first, so that their in-flight entries
+    # are resolved and removed even if a row computed by another request
+    # fails.
+    if len(to_compute) > 0:
+      for i, row in zip(to_compute.values(),
+                        self._compute(request, to_compute)):
+        rows[i] = row
+    for i, future in to_wait_for:
+      rows[i] = future.result()
+    request.raw_outputs = _stack_rows(rows)
+
+  def _compute(self, request, to_compute):
+    # type: (InferenceRequest, Dict[bytes, int]) -> List[Dict[str, np.ndarray]]
+    """
+    Run the rows in `to_compute` through `run_fn`, store their outputs, and
+    complete and remove their in-flight futures, whether or not `run_fn`
+    succeeds.
+
+    Returns the outputs of the rows, in the order of `to_compute`.
+    """
+    indices = list(to_compute.values())
+    sub_request = InferenceRequest()
+    sub_request.signature_name = request.signature_name
+    for name, value in request.processed_inputs.items():
+      if name in self._ignored_inputs:
+        continue
+      if _is_scalar(value):
+        sub_request.processed_inputs[name] = value
+      elif isinstance(value, list):
+        sub_request.processed_inputs[name] = [value[i] for i in indices]
+      else:
+        sub_request.processed_inputs[name] = np.asarray(value)[indices]
+    try:
+      self._run_fn(sub_request)
+      # Copy so that cache entries don't pin the whole batch's outputs.
+      rows = [{k: np.array(v[row_num])
+               for k, v in sub_request.raw_outputs.items()}
+              for row_num in range(len(to_compute))]
+    except Exception as e:
+      with self._lock:
+        for key in to_compute:
+          self._in_flight.pop(key).set_exception(e)
+      raise
+
+    with self._lock:
+      for key, row in zip(to_compute, rows):
+        self._insert(key, row)
+        self._in_flight.pop(key).set_result(row)
+    return rows
+
+  def _insert(self, key, row):
+    # type: (bytes, Dict[str, np.ndarray]) -> None
+    """
+    Add an entry, evicting least recently used entries to make room. Must
+    be called with `self._lock` held.
+    """
+    size = len(key) + sum(_num_bytes(v) for v in row.values())
+    if size > self._max_bytes or key in self._entries:
+      return
+    while self._num_bytes + size > self._max_bytes:
+      _, (_, evicted_size) = self._entries.popitem(last=False)
+      self._num_bytes -= evicted_size
+      self._num_evictions += 1
+    self._entries[key] = (row, size)
+    self._num_bytes += size
+
+  def _row_keys(self, request):
+    # type: (InferenceRequest) -> List[bytes]
+    """
+    Compute the cache key of every row of a request's processed inputs.
+    """
+    base = hashlib.sha256()
+    batched = []
+    for name in sorted(request.processed_inputs.keys()):
+      if name in self._ignored_inputs:
+        continue
+      value = request.processed_inputs[name]
+      if _is_scalar(value):
+        base.update(repr(value).encode("utf-8"))
+      else:
+        batched.append((self._key_fns.get(name, _row_bytes), value))
+    if len(batched) == 0:
+      raise ValueError("Request has no batched processed inputs. Run "
+                       "pre_process() before passing it to the cache.")
+    keys = []
+    for i in range(len(batched[0][1])):
+      h = base.copy()
+      for key_fn, value in batched:
+        h.update(key_fn(value[i]))
+      keys.append(h.digest())
+    return keys
+
+
+def _is_scalar(value):
+  # type: (Any) -> bool
+  return not isinstance(value, list) and np.ndim(value) == 0
+
+
+def _row_bytes(row):
+  # type: (Any) -> bytes
+  if isinstance(row, (bytes, bytearray)):
+    return bytes(row)
+  if isinstance(row, str):
+    return row.encode("utf-8")
+  return np.ascontiguousarray(row).tobytes()
+
+
+def _num_bytes(value):
+  # type: (np.ndarray) -> int
+  """
+  Approximate memory footprint of an array, including the contents of
+  arrays of Python strings.
+  """
+  if value.dtype == np.object_:
+    return value.nbytes + sum(len(v) for v in value.flat)
+  return value.nbytes
+
+
+def _stack_rows(rows):
+  # type: (List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]
+  """
+  Stack per-row outputs into batch-major arrays. Rows that came from
+  different runs of the model may have different widths, e.g. when the
+  graph trims its outputs to the largest number of detections in the
+  batch; narrower rows are padded with zeros (or empty strings), which the
+  consumer must treat as garbage, just like the rows past
+  `num_detections`.
+  """
+  result = {}
+  for name in rows[0]:
+    values = [r[name] for r in rows]
+    shape = values[0].shape
+    if values[0].ndim > 0:
+      shape = tuple(np.max([v.shape for v in values], axis=0))
+    if all(v.shape == shape for v in values):
+      result[name] = np.stack(values)
+      continue
+    fill = b"" if values[0].dtype == np.object_ else 0
+    stacked = np.full((len(values),) + shape, fill, dtype=values[0].dtype)
+    for i, v in enumerate(values):
+      stacked[(i,) + tuple(slice(0, d) for d in v.shape)] = v
+    result[name] = stacked
+  return result
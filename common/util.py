@@ -17,8 +17,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from typing import Dict
+from typing import Dict, List, Tuple
 
+import concurrent.futures
 import inspect
 import os
 import shutil
@@ -43,6 +44,112 @@ def protobuf_to_file(pb, path, human_readable_name):
   print("{} written to {}".format(human_readable_name, path))
 
 
+# Values of the `policy` argument of `GraphDumper`
+DUMP_POLICIES = ["off", "binary", "text"]
+
+# Tensor-valued attributes up to this size keep their values in text dumps,
+# so that scalars such as thresholds stay visible.
+_MAX_TEXT_DUMP_TENSOR_BYTES = 64
+
+
+def elide_constants(graph_def):
+  # type: (tf.GraphDef) -> tf.GraphDef
+  """
+  Returns a copy of a graph with the values of all but the smallest
+  tensor-valued attributes, such as the weights in `Const` ops, removed.
+  Each tensor keeps its dtype and shape, so the copy still shows the
+  structure of the graph, at a fraction of the size.
+  """
+  result = tf.GraphDef()
+  result.CopyFrom(graph_def)
+  for node in result.node:
+    for attr in node.attr.values():
+      if (attr.HasField("tensor")
+              and attr.tensor.ByteSize() > _MAX_TEXT_DUMP_TENSOR_BYTES):
+        dtype = attr.tensor.dtype
+        shape = tf.TensorShapeProto()
+        shape.CopyFrom(attr.tensor.tensor_shape)
+        attr.tensor.Clear()
+        attr.tensor.dtype = dtype
+        attr.tensor.tensor_shape.CopyFrom(shape)
+  return result
+
+
+class GraphDumper(object):
+  """
+  Writes dumps of intermediate graphs for debugging, on a background thread
+  so that they don't hold up the code that produces the graphs.
+
+  Depending on the policy, dumps are:
+  * "off": not written at all
+  * "binary": binary GraphDef files (`<name>.pb`), which
+    `tf.GraphDef.FromString()` can read back
+  * "text": text-format GraphDef files (`<name>.pbtxt`) with the values of
+    large constants elided; see `elide_constants()`
+  """
+
+  def __init__(self, policy, dump_dir):
+    # type: (str, str) -> None
+    """
+    Args:
+      policy: One of `DUMP_POLICIES`
+      dump_dir: Directory to write dumps to. Created on the first dump.
+    """
+    if policy not in DUMP_POLICIES:
+      raise ValueError("Unknown dump policy '{}'. Valid policies are {}."
+                       "".format(policy, DUMP_POLICIES))
+    self._policy = policy
+    self._dump_dir = dump_dir
+    self._executor = (None if policy == "off"
+                      else concurrent.futures.ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="GraphDumper"))
+    self._pending = []  # type: List[concurrent.futures.Future]
+
+  @property
+  def enabled(self):
+    # type: () -> bool
+    return self._policy != "off"
+
+  def dump(self, graph_def, name, human_readable_name):
+    # type: (tf.GraphDef, str, str) -> None
+    """
+    Queue a dump of a graph and return right away. The caller must not
+    modify `graph_def` afterwards.
+
+    Args:
+      graph_def: Graph to dump
+      name: File name of the dump within the dump directory, without
+        extension
+      human_readable_name: Description of the graph for log messages
+    """
+    if self._executor is not None:
+      self._pending.append(self._executor.submit(
+        self._write, graph_def, name, human_readable_name))
+
+  def _write(self, graph_def, name, human_readable_name):
+    # type: (tf.GraphDef, str, str) -> None
+    os.makedirs(self._dump_dir, exist_ok=True)
+    path = os.path.join(self._dump_dir, name)
+    if self._policy == "binary":
+      with open(path + ".pb", "wb") as f:
+        f.write(graph_def.SerializeToString())
+      print("{} written to {}".format(human_readable_name, path + ".pb"))
+    else:
+      protobuf_to_file(elide_constants(graph_def), path + ".pbtxt",
+                       human_readable_name)
+
+  def close(self):
+    """
+    Wait for every queued dump to be written. Raises the exception of the
+    first dump that failed, if any.
+    """
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+      for f in self._pending:
+        f.result()
+      self._pending = []
+
+
 def fetch_or_use_cached(temp_dir, file_name, url):
   # type: (str, str, str) -> str
   """
@@ -68,6 +175,34 @@ def fetch_or_use_cached(temp_dir, file_name, url):
   return cached_filename
 
 
+# File name extensions of the images that `read_image_dir()` reads
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+
+
+def read_image_dir(image_dir, max_images):
+  # type: (str, int) -> List[Tuple[str, bytes]]
+  """
+  Read the JPEG, PNG, and GIF files in a local directory, such as a set of
+  representative images for calibrating or comparing models.
+
+  Args:
+    image_dir: Directory to read. Subdirectories are ignored.
+    max_images: Maximum number of images to read
+
+  Returns (file name, file contents) of up to `max_images` images, in order
+  of file name.
+  """
+  names = sorted(n for n in os.listdir(image_dir)
+                 if n.lower().endswith(IMAGE_EXTENSIONS))[:max_images]
+  if len(names) == 0:
+    raise ValueError("No JPEG, PNG, or GIF images in {}".format(image_dir))
+  result = []
+  for name in names:
+    with open(os.path.join(image_dir, name), "rb") as f:
+      result.append((name, f.read()))
+  return result
+
+
 _BEGIN_MARKER = "# BEGIN MARKER FOR CODE GENERATOR"
 _END_MARKER = "# END MARKER FOR CODE GENERATOR"
 _INDENT_TO_ADD = "  "
@@ -133,7 +268,9 @@ ai_parms = {{ "wml_credentials" : wml_credentials,
            }}  
   
 def deployable_function(parms=ai_parms):
+  import base64
   import json
+  import time
   import numpy as np
 {prepost_class_def}
 {inference_request_class_def}
@@ -146,21 +283,46 @@ def deployable_function(parms=ai_parms):
   # its argument a Python dictionary. Inside this dictionary, there must be a 
   # key called "values". The actual parameters of the request must be stored 
   # in dictionary under the "values" key.
+  # An optional "encoding" key selects one of the encodings in
+  # InferenceRequest.RESPONSE_ENCODINGS for the result. WML functions must
+  # return JSON, so results in any encoding other than "json" come back
+  # base64-encoded under the key "data".
+  # If the payload has a true "trace" key, the result also holds the time
+  # spent in each phase of the request under the key "trace".
   def score(function_payload):
     request = InferenceRequest()
     request.set_raw_inputs_from_watson_v3(function_payload)
+    request.response_encoding = function_payload.get("encoding", "json")
+    if request.response_encoding not in InferenceRequest.RESPONSE_ENCODINGS:
+      raise ValueError("Unknown response encoding '{{}}'".format(
+        request.response_encoding))
     h = {handlers_class_name}()
-    h.pre_process(request)
+    with request.timed("pre_process"):
+      h.pre_process(request)
     # Uncomment the following to log the request to the local filesystem in a 
     # format suitable for the CLI
     # with open("model_request.json", "w") as f:
     #   f.write(json.dumps(request.processed_inputs_as_wml_cli(), indent=2))
-    request.set_raw_outputs_from_watson_v3(
-      client.deployments.score(
+    with request.timed("inference"):
+      response_json = client.deployments.score(
         parms["model_deployment_endpoint_url"], 
-        request.processed_inputs_as_watson_v3()))
-    h.post_process(request)
-    return request.processed_outputs
+        request.processed_inputs_as_watson_v3())
+    request.set_raw_outputs_from_watson_v3(response_json, h.output_specs())
+    with request.timed("post_process"):
+      h.post_process(request)
+    if request.response_encoding == "json":
+      result = request.processed_outputs
+    else:
+      payload, content_type = request.encode_result()
+      result = {{
+        "encoding": request.response_encoding,
+        "content_type": content_type,
+        "data": base64.b64encode(payload).decode("utf-8")
+      }}
+    if function_payload.get("trace", False):
+      result = dict(result)
+      result["trace"] = request.trace()
+    return result
     
   return score
 """
@@ -21,9 +21,13 @@ from common.prepost import PrePost, GraphGen
 from common.inference_request import InferenceRequest
 from common import util
 
+import base64
+import io
 import re
 import tarfile
+import numpy as np
 import tensorflow as tf
+from PIL import Image
 
 
 ################################################################################
@@ -39,10 +43,86 @@ _LABEL_MAP_URL = ("https://raw.githubusercontent.com/tensorflow/models/"
                   "object_detection/data/mscoco_label_map.pbtxt")
 _FROZEN_GRAPH_MEMBER = _LONG_MODEL_NAME + "/frozen_inference_graph.pb"
 
+# Default height and width to which the preprocessing graph resizes each
+# image before stacking a batch. Matches the fixed_shape_resizer in the
+# pipeline config of ssd_mobilenet_v1_coco.
+_DEFAULT_IMAGE_SIZE = [300, 300]
+
+# Scale factors by which libjpeg can shrink an image while decoding it
+_JPEG_DECODE_RATIOS = [8, 4, 2]
+
+# Name of the SavedModel signature that takes image files as raw bytes
+# instead of base64 text
+_BINARY_SIGNATURE_NAME = "serving_bytes"
+
+# Input and outputs of the part of the detector that build_graph.py converts
+# to TensorFlow Lite: the resized image, scaled to [-1, 1], and the
+# detector's raw box encodings and class logits for each anchor box. The
+# rest of the detector, from image decoding to non-maximum suppression, uses
+# ops that TensorFlow Lite doesn't have, so TFLiteObjectDetectorHandlers
+# implements it in Python.
+_TFLITE_INPUT_NAME = "Preprocessor/sub"
+_TFLITE_BOX_ENCODINGS_NAME = "concat"
+_TFLITE_CLASS_LOGITS_NAME = "concat_1"
+
+# Tensor of the frozen graph that holds the detector's anchor boxes, as
+# [ymin, xmin, ymax, xmax] rows
+_ANCHORS_TENSOR_NAME = "MultipleGridAnchorGenerator/Concatenate/concat:0"
+
+# Settings of the detector's postprocessor, from the pipeline config of
+# ssd_mobilenet_v1_coco: scale factors of the box coder's y, x, height,
+# and width encodings, and the settings of non-maximum suppression.
+_BOX_CODER_SCALES = np.array([10.0, 10.0, 5.0, 5.0], dtype=np.float32)
+_NMS_IOU_THRESHOLD = 0.6
+_NMS_SCORE_THRESHOLD = 1e-8
+_MAX_DETECTIONS_PER_CLASS = 100
+_MAX_DETECTIONS = 100
+
+
+def _read_label_map():
+  # type: () -> Tuple[List[int], List[str]]
+  """
+  Fetches the model's label map, if it isn't cached yet, and returns its
+  class IDs and the corresponding display names.
+  """
+  label_file = util.fetch_or_use_cached(_CACHE_DIR, "labels.pbtext",
+                                        _LABEL_MAP_URL)
+
+  # Category mapping comes in pbtext format. Translate to the format that
+  # TensorFlow's hash table initializers expect (key and value tensors).
+  with open(label_file, "r") as f:
+    raw_data = f.read()
+  # Parse directly instead of going through the protobuf API dance.
+  records = raw_data.split("}")
+  records = records[0:-1]  # Remove empty record at end
+  records = [r.replace("\n", "") for r in records] # Strip newlines
+  regex = re.compile(r"item {  name: \".+\"  id: (.+)  display_name: \"(.+)\"")
+  keys = []
+  values = []
+  for r in records:
+    match = regex.match(r)
+    keys.append(int(match.group(1)))
+    values.append(match.group(2))
+  return keys, values
+
+
 ################################################################################
 # CALLBACKS THAT CREATE GRAPHS
 class GraphGenerators(GraphGen):
 
+  def __init__(self, image_size=None):
+    # type: (List[int]) -> None
+    """
+    Args:
+      image_size: Height and width, in pixels, to which the preprocessing
+        graph shrinks each input image. Defaults to the input resolution of
+        the detector. The detector itself stretches every image to its own
+        input resolution, ignoring aspect ratio, so its normalized detection
+        boxes are only valid if images are stretched here too.
+    """
+    self._image_size = (list(image_size) if image_size is not None
+                        else list(_DEFAULT_IMAGE_SIZE))
+
   def frozen_graph(self):
     # type: () -> tf.GraphDef
     """
@@ -75,6 +155,58 @@ class GraphGenerators(GraphGen):
     return ["detection_boxes", "detection_classes",
             "detection_scores", "num_detections"]
 
+  def input_signatures(self):
+    # type: () -> Dict[str, Dict[str, Any]]
+    """
+    Describes the values that the input placeholders of the graph returned
+    by `frozen_graph` receive in the deployed graph. See
+    `GraphGen.input_signatures`.
+    """
+    # The detector takes a batch of RGB images of any size, but the
+    # preprocessing graph always resizes images to self._image_size.
+    return {
+      "image_tensor": {
+        "dtype": "uint8",
+        "shape": [-1] + self._image_size + [3]
+      }
+    }
+
+  def optional_input_node_names(self):
+    # type: () -> List[str]
+    """
+    Returns a list of the names of PlaceholderWithDefault ops in the
+    graphs returned by `pre_processing_graph` and `post_processing_graph`
+    that should be exposed as additional, optional inputs of the final
+    graph.
+    """
+    return ["threshold"]
+
+  def alternate_signatures(self):
+    # type: () -> Dict[str, Dict[str, str]]
+    """
+    Returns additional serving signatures for the final graph, as a dict
+    from signature name to a dict that maps each input name of that
+    signature to the name of the tensor that the input feeds.
+    """
+    # Callers that have the raw image files can feed them directly to the
+    # output of the base64 decoding op and skip the base64 round trip.
+    return {_BINARY_SIGNATURE_NAME: {"image_bytes": "image_bytes:0"}}
+
+  def tflite_subgraph(self):
+    # type: () -> Dict[str, Any]
+    """
+    Describes the part of the graph returned by `frozen_graph` that
+    build_graph.py converts to TensorFlow Lite. See
+    `GraphGen.tflite_subgraph`.
+    """
+    # The detector's own preprocessor stretches every image to
+    # _DEFAULT_IMAGE_SIZE, whatever self._image_size is.
+    return {
+      "input_shapes": {_TFLITE_INPUT_NAME: [1] + _DEFAULT_IMAGE_SIZE + [3]},
+      "output_names": [_TFLITE_BOX_ENCODINGS_NAME, _TFLITE_CLASS_LOGITS_NAME],
+      "constants": [_ANCHORS_TENSOR_NAME],
+    }
+
   def pre_processing_graph(self):
     # type: () -> tf.Graph
     """
@@ -88,25 +220,64 @@ class GraphGenerators(GraphGen):
     and a second op named "<name of placeholder>_preprocessed", where `<name
     of placeholder>` is the name of the Placeholder op.
     """
-    # Preprocessing steps performed:
-    # 1. Decode base64
-    # 2. Uncompress JPEG/PNG/GIF image file
-    # 3. Massage into a single-image batch
-    # 2 and 3 are handled by the same op
+    # Preprocessing steps performed, independently for each image in the
+    # input vector:
+    # 1. Decode base64 (skipped by callers of the binary signature, which
+    #    feed the "image_bytes" tensor directly)
+    # 2. Uncompress JPEG/PNG/GIF image file. JPEG files that are much larger
+    #    than the target size are shrunk by libjpeg as part of decoding.
+    # 3. Resize to the target size
+    # Then stack the results into a single dense batch.
+    # Steps 2 and 3 run back to back, so a full-size decoded image only lives
+    # until it has been resized, and the detector only ever sees small
+    # images.
+    target_height, target_width = self._image_size
     img_decode_g = tf.Graph()
     with img_decode_g.as_default():
-      raw_image = tf.placeholder(tf.string, name="image_tensor")
-
-      binary_image = tf.io.decode_base64(raw_image)
-
-      # tf.image.decode_image() returns a 4D tensor when it receives a GIF and
-      # a 3D tensor for every other file type. This means that you need
-      # complicated shape-checking and reshaping logic downstream
-      # for it to be of any use in an inference context.
-      # So we use decode_gif, which in spite of its name, also handles JPEG and
-      # PNG files; and which always returns a batch of images.
-      decoded_image_batch = tf.image.decode_gif(
-        binary_image, name="image_tensor_preprocessed")
+      raw_images = tf.placeholder(tf.string, shape=[None],
+                                  name="image_tensor")
+
+      binary_images = tf.io.decode_base64(raw_images, name="image_bytes")
+
+      def _decode_jpeg(binary_image):
+        # libjpeg can shrink a JPEG image by 1/2, 1/4, or 1/8 while decoding
+        # it, for a fraction of the time and memory of decoding it at full
+        # size. Use the largest factor that keeps both dimensions at or above
+        # the target size, so the resize below only ever shrinks the image.
+        # The header tells us the dimensions without decoding the image.
+        jpeg_shape = tf.image.extract_jpeg_shape(binary_image)
+        scale = tf.minimum(jpeg_shape[0] // target_height,
+                           jpeg_shape[1] // target_width)
+
+        def decode_with_ratio(ratio):
+          return lambda: tf.image.decode_jpeg(binary_image, channels=3,
+                                              ratio=ratio)
+        return tf.case(
+          [(tf.greater_equal(scale, r), decode_with_ratio(r))
+           for r in _JPEG_DECODE_RATIOS],
+          default=decode_with_ratio(1), exclusive=False)
+
+      def _decode_and_resize(binary_image):
+        # tf.image.decode_image() returns a 4D tensor when it receives a GIF
+        # and a 3D tensor for every other file type. This means that you need
+        # complicated shape-checking and reshaping logic downstream
+        # for it to be of any use in an inference context.
+        # So we use decode_gif for anything that isn't a JPEG file. In spite
+        # of its name, it also handles PNG files; and it always returns a
+        # batch of images. We keep the first frame.
+        image = tf.cond(tf.image.is_jpeg(binary_image),
+                        lambda: _decode_jpeg(binary_image),
+                        lambda: tf.image.decode_gif(binary_image)[0])
+        # Images in a batch can have different sizes, so we resize each one
+        # to a common shape before stacking. The SSD graph resizes its input
+        # to its own fixed shape without preserving aspect ratio, so doing the
+        # same here doesn't change the (normalized) detection boxes.
+        resized = tf.image.resize_images(image, self._image_size)
+        return tf.cast(tf.round(resized), tf.uint8)
+
+      decoded_image_batch = tf.map_fn(_decode_and_resize, binary_images,
+                                      dtype=tf.uint8, back_prop=False)
+      _ = tf.identity(decoded_image_batch, name="image_tensor_preprocessed")
     return img_decode_g
 
   def post_processing_graph(self):
@@ -127,32 +298,44 @@ class GraphGenerators(GraphGen):
 
     _HASH_TABLE_INIT_OP_NAME = "hash_table_init"
 
-    label_file = util.fetch_or_use_cached(_CACHE_DIR, "labels.pbtext",
-                                          _LABEL_MAP_URL)
-
-    # Category mapping comes in pbtext format. Translate to the format that
-    # TensorFlow's hash table initializers expect (key and value tensors).
-    with open(label_file, "r") as f:
-      raw_data = f.read()
-    # Parse directly instead of going through the protobuf API dance.
-    records = raw_data.split("}")
-    records = records[0:-1]  # Remove empty record at end
-    records = [r.replace("\n", "") for r in records] # Strip newlines
-    regex = re.compile(r"item {  name: \".+\"  id: (.+)  display_name: \"(.+)\"")
-    keys = []
-    values = []
-    for r in records:
-      match = regex.match(r)
-      keys.append(int(match.group(1)))
-      values.append(match.group(2))
+    keys, values = _read_label_map()
 
     result_decode_g = tf.Graph()
     with result_decode_g.as_default():
-      # The original graph produces floating-point output for detection class,
-      # even though the output is always an integer.
-      float_class = tf.placeholder(tf.float32, shape=[None],
+      boxes = tf.placeholder(tf.float32, shape=[None, None, 4],
+                             name="detection_boxes")
+      scores = tf.placeholder(tf.float32, shape=[None, None],
+                              name="detection_scores")
+      # The original graph produces floating-point output for detection class
+      # and number of detections, even though the outputs are always
+      # integers.
+      float_class = tf.placeholder(tf.float32, shape=[None, None],
                                    name="detection_classes")
-      int_class = tf.cast(float_class, tf.int32)
+      float_num_detections = tf.placeholder(tf.float32, shape=[None],
+                                            name="num_detections")
+      threshold = tf.placeholder_with_default(0.0, shape=[],
+                                              name="threshold")
+
+      # Keep only the rows that contain real detections with scores above
+      # the threshold. The detector returns each image's detections sorted
+      # by descending score, so the rows to keep are a prefix of each image's
+      # rows. Trim all images to the longest such prefix, so that the outputs
+      # stay dense and batch-major, and report the per-image prefix lengths
+      # as the new number of detections.
+      num_rows = tf.shape(scores)[1]
+      valid = tf.sequence_mask(tf.cast(float_num_detections, tf.int32),
+                               maxlen=num_rows)
+      keep = tf.logical_and(valid, tf.greater(scores, threshold))
+      num_kept = tf.reduce_sum(tf.cast(keep, tf.int32), axis=1)
+      # reduce_max() of an empty batch is the smallest int32
+      max_kept = tf.maximum(tf.reduce_max(num_kept), 0)
+
+      _ = tf.identity(boxes[:, :max_kept], name="detection_boxes_postprocessed")
+      _ = tf.identity(scores[:, :max_kept],
+                      name="detection_scores_postprocessed")
+      _ = tf.cast(num_kept, tf.float32, name="num_detections_postprocessed")
+
+      int_class = tf.cast(float_class[:, :max_kept], tf.int32)
       key_tensor = tf.constant(keys, dtype=tf.int32)
       value_tensor = tf.constant(values)
       table_init = tf.contrib.lookup.KeyValueTensorInitializer(
@@ -186,12 +369,32 @@ class ObjectDetectorHandlers(PrePost):
         Implementations of this method should populate the
         "processed_inputs" field of `request`.
     """
-    # raw_inputs keys used:
-    # image: Raw image data as Python bytes
+    # raw_inputs keys used, for each tuple in the batch:
+    # image: Image file, either as URL-safe base64 text or as raw bytes
+    # threshold: Numeric detection threshold, 0.0 - 1.0
     #
     # processed_inputs keys produced:
-    # image_tensor: Image data as a Python bytes
-    request.processed_inputs["image_tensor"] = request.raw_inputs["image"]
+    # image_bytes: List of raw image files, one per tuple in the batch, if
+    #              every image arrived as bytes. In this case the request
+    #              targets the "serving_bytes" signature.
+    # image_tensor: List of base64 images, one per tuple in the batch,
+    #               otherwise
+    # threshold: Lowest threshold of any tuple in the batch. The graph drops
+    #            detections below this threshold; post_process() applies
+    #            each tuple's own threshold.
+    images = [t["image"] for t in request.raw_input_batch]
+    if all(isinstance(i, (bytes, bytearray)) for i in images):
+      request.processed_inputs["image_bytes"] = images
+      request.signature_name = "serving_bytes"
+    else:
+      # TensorFlow only decodes URL-safe base64
+      request.processed_inputs["image_tensor"] = [
+        base64.urlsafe_b64encode(i).decode("utf-8")
+        if isinstance(i, (bytes, bytearray)) else i
+        for i in images
+      ]
+    request.processed_inputs["threshold"] = float(
+      min(t["threshold"] for t in request.raw_input_batch))
 
   def post_process(self, request):
     # type: (InferenceRequest) -> None
@@ -205,20 +408,25 @@ class ObjectDetectorHandlers(PrePost):
         Implementations of this method should populate the
         "processed_outputs" field of `request`.
     """
-    # raw_inputs keys used:
+    # raw_inputs keys used, for each tuple in the batch:
     # threshold: Numeric detection threshold, 0.0 - 1.0
     #
-    # raw_outputs keys used:
+    # raw_outputs keys used (first dimension is the batch):
     # detection_boxes: Bounding boxes as float32 tensors
     # detection_classes: String class labels for bounding boxes
     # detection_scores: float32 detection scores, 0.0 - 1.0
     # num_detections: Integer encoded as a float32; how many entries of the
     #                 other three outputs contain data instead of garbage.
+    #                 The graph only returns detections above the "threshold"
+    #                 processed input, so this may be less than the width of
+    #                 the other three outputs.
     #
     # processed_outputs keys produced:
     # status: String result status. "ok" if everything went ok, error message
     # otherwise.
-    # predictions: Array of detected objects in the format:
+    # predictions: Array of detected objects in the format below. If the
+    #   request carried more than one tuple, this is instead a list with one
+    #   such array per tuple, in the order of the tuples.
     #   "predictions": [
     #     {
     #       "label": "boat",
@@ -231,25 +439,75 @@ class ObjectDetectorHandlers(PrePost):
     #       ]
     #     }
     #   ]
-    boxes = request.raw_outputs["detection_boxes"]
-    classes = request.raw_outputs["detection_classes"]
-    scores = request.raw_outputs["detection_scores"]
-    num_detections = int(request.raw_outputs["num_detections"])
-    predictions = []
-    for i in range(num_detections):
-      probability = float(scores[0, i])
-      if probability > request.raw_inputs["threshold"]:
-        classes_value = classes[0, i]
-        if isinstance(classes_value, bytes):
-          classes_value = classes_value.decode("utf-8")
-        predictions.append({
-          "label": classes_value,
-          "probability": probability,
-          "detection_box": boxes[0, i].tolist()
-        })
+    #
+    # If the request's response encoding is "arrays", predictions instead
+    # come back in columnar form, as numpy arrays that the encoding can
+    # transmit without converting them to Python objects. The detections of
+    # all tuples are concatenated, in the order of the tuples:
+    # counts: int32 number of detections of each tuple
+    # detection_boxes: float32 array of shape [total detections, 4]
+    # probabilities: float32 array of shape [total detections]
+    # labels: List of the distinct labels of all detections
+    # label_indices: int32 index into "labels" of each detection
+    boxes = np.asarray(request.raw_outputs["detection_boxes"])
+    classes = np.asarray(request.raw_outputs["detection_classes"])
+    scores = np.asarray(request.raw_outputs["detection_scores"])
+    num_detections = np.asarray(
+      request.raw_outputs["num_detections"]).reshape(-1).astype(np.int64)
+    thresholds = np.array([t["threshold"] for t in request.raw_input_batch],
+                          dtype=np.float64)
+
+    # Rows past num_detections contain garbage. Compare scores in double
+    # precision so that results match comparing Python floats.
+    valid = (np.arange(scores.shape[1])[np.newaxis, :]
+             < num_detections[:, np.newaxis])
+    keep = valid & (scores > thresholds[:, np.newaxis])
+
+    if request.response_encoding == "arrays":
+      labels, label_indices = np.unique(classes[keep], return_inverse=True)
+      request.processed_outputs["status"] = "ok"
+      request.processed_outputs["counts"] = keep.sum(axis=1).astype(np.int32)
+      request.processed_outputs["detection_boxes"] = (
+        boxes[keep].astype(np.float32))
+      request.processed_outputs["probabilities"] = (
+        scores[keep].astype(np.float32))
+      request.processed_outputs["labels"] = [
+        l.decode("utf-8") if isinstance(l, bytes) else l
+        for l in labels.tolist()
+      ]
+      request.processed_outputs["label_indices"] = (
+        label_indices.astype(np.int32))
+      return
+
+    # Boolean indexing flattens the batch in row-major order, so the kept
+    # detections of each tuple are contiguous.
+    # Labels arrive as bytes from a local session and as str from JSON.
+    # Decoding only the kept labels with a comprehension is faster than
+    # np.char.decode(), which loops in Python anyway.
+    kept_labels = [
+      l.decode("utf-8") if isinstance(l, bytes) else l
+      for l in classes[keep].tolist()
+    ]
+    kept_scores = scores[keep].tolist()
+    kept_boxes = boxes[keep].tolist()
+    counts = keep.sum(axis=1).tolist()
+
+    batch_predictions = []
+    start = 0
+    for count in counts:
+      end = start + count
+      batch_predictions.append([
+        {"label": label, "probability": probability, "detection_box": box}
+        for label, probability, box in zip(kept_labels[start:end],
+                                           kept_scores[start:end],
+                                           kept_boxes[start:end])
+      ])
+      start = end
     request.processed_outputs["status"] = "ok"
-    request.processed_outputs["predictions"] = predictions
-    print("Predictions: {}".format(predictions))
+    if request.batch_size == 1:
+      request.processed_outputs["predictions"] = batch_predictions[0]
+    else:
+      request.processed_outputs["predictions"] = batch_predictions
 
   def error_post_process(self, request, error_message):
     # type: (InferenceRequest, str) -> None
@@ -266,4 +524,190 @@ class ObjectDetectorHandlers(PrePost):
     # otherwise.
     request.processed_outputs["status"] = error_message
 
+  def output_specs(self):
+    # type: () -> Dict[str, Dict[str, Any]]
+    """
+    Describes the raw model outputs that `post_process` consumes, so that
+    they can be decoded efficiently when they arrive as JSON.
+
+    Returns a dict from output name to dtype and shape of that output.
+    """
+    # Must match the outputs of the postprocessing graph.
+    return {
+      "detection_boxes": {"dtype": "float32", "shape": [-1, -1, 4]},
+      "detection_classes": {"dtype": "string", "shape": [-1, -1]},
+      "detection_scores": {"dtype": "float32", "shape": [-1, -1]},
+      "num_detections": {"dtype": "float32", "shape": [-1]},
+    }
+
 # END MARKER FOR CODE GENERATOR -- DO NOT DELETE
+
+
+################################################################################
+# CALLBACKS FOR THE TENSORFLOW LITE VERSION OF THE MODEL
+def _non_max_suppression(boxes, scores):
+  # type: (np.ndarray, np.ndarray) -> np.ndarray
+  """
+  Greedy non-maximum suppression with the settings of the detector's
+  postprocessor, for the candidate boxes of one class.
+
+  Args:
+    boxes: float32 array of shape [num candidates, 4], as [ymin, xmin, ymax,
+      xmax] rows
+    scores: float32 array of shape [num candidates]
+
+  Returns the indices of the boxes to keep, in order of decreasing score.
+  """
+  order = np.argsort(-scores, kind="stable")
+  areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+  keep = []
+  while len(order) > 0 and len(keep) < _MAX_DETECTIONS_PER_CLASS:
+    best = order[0]
+    keep.append(best)
+    rest = order[1:]
+    heights = np.maximum(0.0, np.minimum(boxes[best, 2], boxes[rest, 2])
+                         - np.maximum(boxes[best, 0], boxes[rest, 0]))
+    widths = np.maximum(0.0, np.minimum(boxes[best, 3], boxes[rest, 3])
+                        - np.maximum(boxes[best, 1], boxes[rest, 1]))
+    intersections = heights * widths
+    unions = areas[best] + areas[rest] - intersections
+    ious = np.where(unions > 0.0, intersections / np.maximum(unions, 1e-12),
+                    0.0)
+    order = rest[ious <= _NMS_IOU_THRESHOLD]
+  return np.array(keep, dtype=np.int64)
+
+
+class TFLiteObjectDetectorHandlers(ObjectDetectorHandlers):
+  """
+  Pre- and post-processing callbacks for the TensorFlow Lite version of the
+  model that build_graph.py writes, for use with
+  `inference_request.TFLiteRunner`.
+
+  The TensorFlow Lite model only covers the convolutional part of the
+  detector, so these callbacks also do the work of the rest of the
+  SavedModel's graph: decoding and resizing images before the model, and
+  decoding boxes, non-maximum suppression, and the label lookup after it.
+  Requests and results have the same format as with
+  `ObjectDetectorHandlers`.
+  """
+
+  def __init__(self, constants):
+    # type: (Dict[str, np.ndarray]) -> None
+    """
+    Args:
+      constants: `TFLiteRunner.constants` of the model
+    """
+    anchors = constants[_ANCHORS_TENSOR_NAME].astype(np.float32)
+    self._anchor_sizes = anchors[:, 2:] - anchors[:, :2]
+    self._anchor_centers = anchors[:, :2] + 0.5 * self._anchor_sizes
+    keys, values = _read_label_map()
+    # Same default value as the lookup table of the postprocessing graph
+    self._labels = np.full([max(keys) + 1], "Unknown", dtype=object)
+    self._labels[keys] = values
+
+  def pre_process(self, request):
+    # type: (InferenceRequest) -> None
+    """
+    Preprocessing callback. Decodes and resizes the images of a request as
+    the preprocessing graph and the detector's preprocessor do.
+    """
+    # raw_inputs keys used: Same as ObjectDetectorHandlers.pre_process()
+    #
+    # processed_inputs keys produced:
+    # Preprocessor/sub: float32 array of shape [batch, height, width, 3],
+    #                   with each image stretched to the detector's input
+    #                   resolution and scaled to [-1, 1]
+    height, width = _DEFAULT_IMAGE_SIZE
+    pixels = np.empty([request.batch_size, height, width, 3],
+                      dtype=np.float32)
+    for i, t in enumerate(request.raw_input_batch):
+      image_file = t["image"]
+      if not isinstance(image_file, (bytes, bytearray)):
+        image_file = base64.urlsafe_b64decode(image_file)
+      image = Image.open(io.BytesIO(image_file))
+      # Like the preprocessing graph, let libjpeg shrink large JPEG images
+      # while decoding them, but not below the target size. draft() does
+      # nothing for other formats. Multi-frame GIFs keep their first frame.
+      image.draft("RGB", (width, height))
+      image = image.convert("RGB").resize((width, height), Image.BILINEAR)
+      pixels[i] = np.asarray(image, dtype=np.float32)
+    request.processed_inputs[_TFLITE_INPUT_NAME] = (
+      pixels * (2.0 / 255.0) - 1.0)
+
+  def _detect(self, box_encodings, class_logits, threshold):
+    # type: (np.ndarray, np.ndarray, float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    Turn the raw outputs of the model for one image into detections, as the
+    detector's postprocessor does.
+
+    Returns boxes, scores, and class IDs of the detections above
+    `threshold`, in order of decreasing score.
+    """
+    # Decode the box of every anchor
+    relative = box_encodings / _BOX_CODER_SCALES
+    centers = relative[:, :2] * self._anchor_sizes + self._anchor_centers
+    sizes = np.exp(relative[:, 2:]) * self._anchor_sizes
+    boxes = np.clip(np.concatenate([centers - 0.5 * sizes,
+                                    centers + 0.5 * sizes], axis=1),
+                    0.0, 1.0)
+
+    # Column 0 is the background class. The SavedModel drops detections
+    # below the threshold after non-maximum suppression, which only ever
+    # suppresses a box in favor of one with a higher score, so dropping them
+    # first gives the same result with less work.
+    scores = 1.0 / (1.0 + np.exp(-class_logits[:, 1:]))
+    rows, columns = np.nonzero(scores > max(threshold, _NMS_SCORE_THRESHOLD))
+    kept_rows = []
+    kept_columns = []
+    for c in np.unique(columns):
+      class_rows = rows[columns == c]
+      keep = _non_max_suppression(boxes[class_rows], scores[class_rows, c])
+      kept_rows.append(class_rows[keep])
+      kept_columns.append(np.full([len(keep)], c))
+    if len(kept_rows) == 0:
+      return (np.zeros([0, 4], dtype=np.float32),
+              np.zeros([0], dtype=np.float32), np.zeros([0], dtype=np.int64))
+    kept_rows = np.concatenate(kept_rows)
+    kept_columns = np.concatenate(kept_columns)
+    kept_scores = scores[kept_rows, kept_columns]
+    order = np.argsort(-kept_scores, kind="stable")[:_MAX_DETECTIONS]
+    return (boxes[kept_rows[order]], kept_scores[order],
+            kept_columns[order] + 1)
+
+  def post_process(self, request):
+    # type: (InferenceRequest) -> None
+    """
+    Postprocessing callback. Turns the raw outputs of the TensorFlow Lite
+    model into the outputs of the SavedModel's graph, then formats those
+    like `ObjectDetectorHandlers.post_process` does.
+    """
+    # raw_outputs keys used:
+    # concat: float32 box encodings of shape [batch, anchors, 1, 4]
+    # concat_1: float32 class logits of shape [batch, anchors, classes + 1]
+    #
+    # raw_outputs keys produced: Those of the SavedModel; see
+    # ObjectDetectorHandlers.post_process()
+    box_encodings = np.asarray(
+      request.raw_outputs[_TFLITE_BOX_ENCODINGS_NAME]).reshape(
+      [request.batch_size, -1, 4])
+    class_logits = np.asarray(request.raw_outputs[_TFLITE_CLASS_LOGITS_NAME])
+    detections = [
+      self._detect(box_encodings[i], class_logits[i], t["threshold"])
+      for i, t in enumerate(request.raw_input_batch)
+    ]
+
+    # Pad to a dense batch, as the SavedModel does
+    width = max(len(scores) for _, scores, _ in detections)
+    boxes = np.zeros([request.batch_size, width, 4], dtype=np.float32)
+    scores = np.zeros([request.batch_size, width], dtype=np.float32)
+    labels = np.full([request.batch_size, width], "", dtype=object)
+    for i, (image_boxes, image_scores, class_ids) in enumerate(detections):
+      boxes[i, :len(image_scores)] = image_boxes
+      scores[i, :len(image_scores)] = image_scores
+      labels[i, :len(image_scores)] = self._labels[class_ids]
+    request.raw_outputs["detection_boxes"] = boxes
+    request.raw_outputs["detection_scores"] = scores
+    request.raw_outputs["detection_classes"] = labels
+    request.raw_outputs["num_detections"] = np.array(
+      [len(s) for _, s, _ in detections], dtype=np.float32)
+    super(TFLiteObjectDetectorHandlers, self).post_process(request)
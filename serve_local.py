@@ -0,0 +1,911 @@
+# Coypright 2019 IBM. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Long-lived local model server.
+
+Loads the SavedModel produced by build_graph.py once at startup and serves
+every request from the same TensorFlow session. Exposes two APIs:
+
+* `POST /v1/models/<model name>:predict` in the format of TensorFlow
+  Serving's REST API (https://www.tensorflow.org/tfx/serving/api_rest),
+  plus `GET /v1/models/<model name>` and `GET /v1/models/<model name>/metadata`.
+  This API passes tensors straight through to the model's signature.
+* `POST /model/predict`, which runs images through `ObjectDetectorHandlers`'
+  pre- and post-processing. The request body can be the same Watson V3 JSON
+  payload that the generated WML function takes; a single image file with
+  content type `application/octet-stream`; or a `multipart/form-data` form
+  with one or more `image` files and an optional `threshold` field. For the
+  latter two, the threshold can also go in the query string, as in
+  `/model/predict?threshold=0.5`. Image files sent in binary skip base64
+  encoding and decoding entirely. Responses are compact JSON by default;
+  clients can ask for one of the other encodings in
+  `InferenceRequest.RESPONSE_ENCODINGS` with an `encoding` query parameter,
+  as in `/model/predict?encoding=arrays`, or with the encoding's content
+  type in the `Accept` header.
+* `GET /model/stats`, which returns histograms of the time that
+  `/model/predict` requests spend in each phase and of their payload sizes,
+  plus counters from the request batching scheduler and the response
+  cache, if they are enabled.
+* With `--profile_sample_rate`, `GET /model/profile`, which returns the
+  time spent in each op, op type, and part of the graph over the sampled
+  runs, and `GET /model/profile/trace`, which returns the most recent
+  sampled run as a Chrome trace for chrome://tracing.
+
+With `--num_replicas=N`, the server process only handles HTTP, and hands
+each request to one of N worker processes, each of which loads its own copy
+of the model and runs pre-processing, inference, post-processing, and
+response encoding. This sidesteps the GIL on machines with many cores.
+
+With `--variants_dir`, the server also loads the variants of the model that
+build_graph.py specialized for fixed batch sizes, and runs each request on
+the variant for its batch size, if there is one.
+
+To run this script from the root of the project, type:
+   env/bin/python serve_local.py --port=8501
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from typing import Any, Dict, List, Tuple
+
+# Local imports
+from common import batching
+from common import profiling
+from common import replica_pool
+from common import request_metrics
+from common import response_cache
+import common.inference_request as inference_request
+import handlers
+
+# System imports
+import base64
+import binascii
+import http.server
+import json
+import os
+import re
+import socketserver
+import urllib.parse
+import tensorflow as tf
+import numpy as np
+
+tf.flags.DEFINE_string("saved_model_dir", "./saved_model",
+                       "Location of the SavedModel to serve")
+tf.flags.DEFINE_string("variants_dir", "",
+                       "Optional directory of variants of the SavedModel "
+                       "that build_graph.py specialized for fixed batch "
+                       "sizes, e.g. ./saved_model_variants. Requests whose "
+                       "batch size has a variant run on that variant")
+tf.flags.DEFINE_string("model_name", "max_object_detector",
+                       "Model name to use in TensorFlow Serving URLs")
+tf.flags.DEFINE_string("host", "localhost", "Interface to listen on")
+tf.flags.DEFINE_integer("port", 8501, "Port to listen on")
+tf.flags.DEFINE_integer("max_batch_size", 1,
+                        "If greater than 1, coalesce concurrent requests into "
+                        "batches of up to this many images")
+tf.flags.DEFINE_float("max_batch_wait_secs", 0.005,
+                      "Maximum time a request waits for others to join its "
+                      "batch. Only used if --max_batch_size is greater "
+                      "than 1")
+tf.flags.DEFINE_integer("intra_op_threads", 0,
+                        "Size of the session's intra-op thread pool; 0 lets "
+                        "TensorFlow choose")
+tf.flags.DEFINE_integer("inter_op_threads", 0,
+                        "Size of the session's inter-op thread pool; 0 lets "
+                        "TensorFlow choose")
+tf.flags.DEFINE_integer("max_concurrent_runs", 0,
+                        "If greater than 0, run at most this many requests "
+                        "through the session at once. Otherwise every HTTP "
+                        "request thread runs the session directly. Only used "
+                        "if --max_batch_size is 1")
+tf.flags.DEFINE_integer("num_replicas", 1,
+                        "If greater than 1, serve requests from this many "
+                        "worker processes, each with its own copy of the "
+                        "model. Batching, caching, and concurrency flags "
+                        "then apply to each worker separately, and each "
+                        "worker runs up to twice the larger of "
+                        "--max_batch_size and --max_concurrent_runs "
+                        "requests at once")
+tf.flags.DEFINE_bool("pin_replicas", False,
+                     "Pin each replica to its own group of cores, keeping "
+                     "groups within a NUMA node where possible. Each "
+                     "replica's thread pools then default to the size of "
+                     "its group. Only used if --num_replicas is greater "
+                     "than 1")
+tf.flags.DEFINE_float("profile_sample_rate", 0.0,
+                      "Fraction of session runs to trace with per-op step "
+                      "stats for GET /model/profile")
+tf.flags.DEFINE_integer("cache_bytes", 0,
+                        "If greater than 0, cache the model's outputs for "
+                        "up to this many bytes' worth of distinct images, so "
+                        "that repeated images skip inference")
+FLAGS = tf.flags.FLAGS
+
+_DEFAULT_SIGNATURE_NAME = "serving_default"
+_MAX_PREDICT_PATH = "/model/predict"
+_MAX_STATS_PATH = "/model/stats"
+_MAX_PROFILE_PATH = "/model/profile"
+_MAX_PROFILE_TRACE_PATH = "/model/profile/trace"
+_DEFAULT_THRESHOLD = 0.7
+_MULTIPART_NAME_REGEX = re.compile(br'\bname="([^"]*)"')
+_TF_SERVING_PATH_REGEX = re.compile(
+  r"^/v1/models/(?P<name>[^/:]+)(?P<suffix>/metadata|:predict)?$")
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  # Don't let in-flight requests keep the process alive on shutdown.
+  daemon_threads = True
+
+
+class ModelServer(object):
+  """
+  Holds the loaded model and implements the server's API methods
+  independently of the HTTP plumbing.
+  """
+
+  def __init__(self, saved_model_dir, model_name, max_batch_size=1,
+               max_batch_wait_secs=0.005, cache_bytes=0, config=None,
+               max_concurrent_runs=0, profile_sample_rate=0.0,
+               variants_dir=None):
+    # type: (str, str, int, float, int, tf.ConfigProto, int, float, str) -> None
+    """
+    Load the model and create the session that serves every request.
+
+    Args:
+      saved_model_dir: Location of the SavedModel directory.
+      model_name: Name under which the model is served in TensorFlow Serving
+        URLs.
+      max_batch_size: If greater than 1, requests are coalesced into batches
+        of up to this many images by a `batching.BatchingScheduler`.
+      max_batch_wait_secs: Maximum time a request waits for others to join
+        its batch.
+      cache_bytes: If greater than 0, requests to `/model/predict` go
+        through a `response_cache.ResponseCache` of this size. The cache
+        ignores the detection threshold, so a repeated image is served
+        from the cache whatever threshold it comes with.
+      config: Optional session configuration, e.g. from
+        `inference_request.session_config()`
+      max_concurrent_runs: If greater than 0 and batching is off, requests
+        go through an `inference_request.ConcurrentRunner` with this many
+        threads. Otherwise each request runs on its HTTP request thread.
+      profile_sample_rate: If greater than 0, this fraction of session runs
+        is traced by a `profiling.OpProfiler`. Runs on batch size variants
+        aren't traced.
+      variants_dir: Optional directory of batch size variants of the model
+        from build_graph.py. Each variant gets its own session, and requests
+        with a matching batch size run on it; see
+        `inference_request.VariantRunner`.
+    """
+    self.model_name = model_name
+    sess, graph, self._meta_graph = inference_request.load_saved_model(
+      saved_model_dir, config)
+    self._profiler = None
+    if profile_sample_rate > 0:
+      self._profiler = profiling.OpProfiler(graph, profile_sample_rate)
+    variants = {}
+    if variants_dir:
+      variants = inference_request.load_batch_variants(variants_dir, config)
+    self._runners = {}
+    for name, signature in self._meta_graph.signature_def.items():
+      runner = inference_request.LocalTFRunner(sess, graph, signature,
+                                               self._profiler)
+      variant_runners = {
+        batch_size: inference_request.LocalTFRunner(
+          v_sess, v_graph, v_meta_graph.signature_def[name])
+        for batch_size, (v_sess, v_graph, v_meta_graph) in variants.items()
+        if name in v_meta_graph.signature_def
+      }
+      if len(variant_runners) > 0:
+        runner = inference_request.VariantRunner(runner, variant_runners)
+      self._runners[name] = runner
+    self._handlers = handlers.ObjectDetectorHandlers()
+    self._scheduler = None
+    self._concurrent_runner = None
+    if max_batch_size > 1:
+      self._scheduler = batching.BatchingScheduler(
+        lambda r: self._runners[r.signature_name].run(r),
+        max_batch_size=max_batch_size,
+        max_wait_secs=max_batch_wait_secs,
+        # Post-processing applies each image's own threshold again, so a
+        # batch can run at the lowest threshold of its requests.
+        merge_fns={"threshold": min})
+    elif max_concurrent_runs > 0:
+      self._concurrent_runner = inference_request.ConcurrentRunner(
+        lambda r: self._runners[r.signature_name].run(r),
+        max_concurrent_runs)
+    self._cache = None
+    if cache_bytes > 0:
+      # The two signatures compute the same outputs from the same image
+      # file, so base64 and binary uploads of an image share an entry.
+      self._cache = response_cache.ResponseCache(
+        self._run, cache_bytes, ignored_inputs=["threshold"],
+        key_fns={"image_tensor": base64.urlsafe_b64decode})
+    self._metrics = request_metrics.RequestMetrics()
+    self._metrics.attach()
+    print("Loaded model '{}' from {}".format(model_name, saved_model_dir))
+    if len(variants) > 0:
+      print("Loaded variants for batch sizes {} from {}".format(
+        sorted(variants.keys()), variants_dir))
+
+  def _signature(self, signature_name):
+    # type: (str) -> tf.SignatureDef
+    if signature_name not in self._meta_graph.signature_def:
+      raise ValueError("Signature '{}' not found. Available signatures: {}"
+                       "".format(signature_name,
+                                 list(self._meta_graph.signature_def.keys())))
+    return self._meta_graph.signature_def[signature_name]
+
+  def _run(self, request):
+    # type: (inference_request.InferenceRequest) -> None
+    self._signature(request.signature_name)  # Validate signature name
+    if self._scheduler is not None:
+      self._scheduler.submit(request)
+    elif self._concurrent_runner is not None:
+      self._concurrent_runner.submit(request)
+    else:
+      self._runners[request.signature_name].run(request)
+
+  def stats(self):
+    # type: () -> Dict[str, Any]
+    """
+    Response body for `GET /model/stats`.
+    """
+    result = {"requests": self._metrics.snapshot()}
+    if self._scheduler is not None:
+      result["batching"] = self._scheduler.stats()
+    if self._cache is not None:
+      result["cache"] = self._cache.stats()
+    return result
+
+  def profile(self):
+    # type: () -> Dict[str, Any]
+    """
+    Response body for `GET /model/profile`, or None if profiling is off.
+    """
+    return self._profiler.report() if self._profiler is not None else None
+
+  def chrome_trace(self):
+    # type: () -> str
+    """
+    Response body for `GET /model/profile/trace`, or None if profiling is
+    off or no run has been sampled yet.
+    """
+    return (self._profiler.chrome_trace() if self._profiler is not None
+            else None)
+
+  @staticmethod
+  def model_status():
+    # type: () -> Dict[str, Any]
+    """
+    Response body for `GET /v1/models/<model name>`.
+    """
+    return {
+      "model_version_status": [
+        {
+          "version": "1",
+          "state": "AVAILABLE",
+          "status": {"error_code": "OK", "error_message": ""}
+        }
+      ]
+    }
+
+  def model_metadata(self):
+    # type: () -> Dict[str, Any]
+    """
+    Response body for `GET /v1/models/<model name>/metadata`.
+    """
+    def tensor_info_to_json(info):
+      return {
+        "dtype": tf.as_dtype(info.dtype).name,
+        "tensor_shape": [d.size for d in info.tensor_shape.dim],
+        "name": info.name
+      }
+    signatures = {
+      name: {
+        "inputs": {k: tensor_info_to_json(v) for k, v in sig.inputs.items()},
+        "outputs": {k: tensor_info_to_json(v)
+                    for k, v in sig.outputs.items()},
+        "method_name": sig.method_name
+      }
+      for name, sig in self._meta_graph.signature_def.items()
+    }
+    return {
+      "model_spec": {"name": self.model_name, "version": "1"},
+      "metadata": {"signature_def": {"signature_def": signatures}}
+    }
+
+  def tf_serving_predict(self, body):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """
+    Implementation of TensorFlow Serving's REST predict API.
+
+    Args:
+      body: Parsed JSON request, in either the row ("instances") or the
+        columnar ("inputs") format.
+
+    Returns the parsed JSON response, in the same format as the request.
+    """
+    signature_name = body.get("signature_name", _DEFAULT_SIGNATURE_NAME)
+    signature = self._signature(signature_name)
+    input_names = list(signature.inputs.keys())
+    request = inference_request.InferenceRequest()
+    request.signature_name = signature_name
+    if "instances" in body:
+      instances = body["instances"]
+      for name in input_names:
+        if all(isinstance(i, dict) and name in i for i in instances):
+          values = [i[name] for i in instances]
+        elif len(input_names) == 1:
+          # Single-input signatures allow bare values as instances.
+          values = instances
+        else:
+          raise ValueError("Instances must be JSON objects keyed by input "
+                           "name when the signature has more than one "
+                           "input.")
+        request.processed_inputs[name] = _decode_tf_serving_value(values)
+    elif "inputs" in body:
+      inputs = body["inputs"]
+      if not isinstance(inputs, dict):
+        if len(input_names) != 1:
+          raise ValueError("Inputs must be a JSON object keyed by input "
+                           "name when the signature has more than one "
+                           "input.")
+        inputs = {input_names[0]: inputs}
+      for name in input_names:
+        request.processed_inputs[name] = _decode_tf_serving_value(
+          inputs[name])
+    else:
+      raise ValueError("Request must contain either an 'instances' or an "
+                       "'inputs' field.")
+
+    self._run(request)
+
+    outputs = {k: _encode_tf_serving_value(v)
+               for k, v in request.raw_outputs.items()}
+    if "inputs" in body:
+      if len(outputs) == 1:
+        return {"outputs": next(iter(outputs.values()))}
+      return {"outputs": outputs}
+    num_instances = len(body["instances"])
+    if len(outputs) == 1:
+      return {"predictions": next(iter(outputs.values()))}
+    return {
+      "predictions": [
+        {k: v[i] for k, v in outputs.items()} for i in range(num_instances)
+      ]
+    }
+
+  def tf_serving_predict_http(self, body):
+    # type: (bytes) -> Tuple[int, str, bytes]
+    """
+    Handle a `POST /v1/models/<model name>:predict` request.
+
+    Args:
+      body: Request body
+
+    Returns HTTP status, content type, and body of the response.
+    """
+    try:
+      return _json_response(200, self.tf_serving_predict(
+        json.loads(body.decode("utf-8"))))
+    except (KeyError, TypeError, ValueError) as e:
+      return _json_response(400, {"error": str(e)})
+    except tf.errors.OpError as e:
+      return _json_response(400, {"error": e.message})
+
+  def max_predict_http(self, body, content_type, query_string, accept):
+    # type: (bytes, str, str, str) -> Tuple[int, str, bytes]
+    """
+    Handle a `POST /model/predict` request.
+
+    Args:
+      body: Request body
+      content_type: Value of the request's `Content-Type` header
+      query_string: Query string of the request URL
+      accept: Value of the request's `Accept` header, or None
+
+    Returns HTTP status, content type, and body of the response.
+    """
+    media_type = content_type.split(";")[0].strip().lower()
+    query = urllib.parse.parse_qs(query_string)
+    try:
+      encoding = _negotiate_encoding(query, accept)
+      if media_type == "application/json":
+        status, request = self.max_predict(json.loads(body.decode("utf-8")),
+                                           encoding)
+      elif media_type in ("application/octet-stream", "multipart/form-data"):
+        threshold = float(query.get("threshold", [_DEFAULT_THRESHOLD])[0])
+        if media_type == "application/octet-stream":
+          images = [body]
+        else:
+          images = []
+          for name, value in _parse_multipart(body, content_type):
+            if name == "image":
+              images.append(value)
+            elif name == "threshold":
+              threshold = float(value.decode("utf-8"))
+        status, request = self.max_predict_images(images, threshold,
+                                                  encoding)
+      else:
+        return _json_response(415, {"status": "Unsupported content type "
+                                              "'{}'".format(content_type)})
+    except ValueError as e:
+      return _json_response(400, {"status": "Invalid request: {}".format(e)})
+    request.record_size("request", len(body))
+    try:
+      payload, response_type = request.encode_result()
+    except ValueError as e:
+      # E.g. the msgpack package is missing
+      return _json_response(406, {"status": str(e)})
+    return status, response_type, payload
+
+  def max_predict(self, body, encoding="json"):
+    # type: (Dict[str, Any], str) -> Tuple[int, inference_request.InferenceRequest]
+    """
+    Run a Watson V3 JSON payload through the model's pre- and
+    post-processing handlers.
+
+    Args:
+      body: Parsed JSON request
+      encoding: Response encoding to set on the request
+
+    Returns HTTP status code and the request, whose processed outputs are
+    ready to encode with `InferenceRequest.encode_result()`.
+    """
+    request = inference_request.InferenceRequest()
+    request.response_encoding = encoding
+    try:
+      request.set_raw_inputs_from_watson_v3(body)
+    except (KeyError, TypeError, ValueError) as e:
+      self._handlers.error_post_process(
+        request, "Invalid request: {}".format(e))
+      return 400, request
+    return self._score(request)
+
+  def max_predict_images(self, images, threshold, encoding="json"):
+    # type: (List[bytes], float, str) -> Tuple[int, inference_request.InferenceRequest]
+    """
+    Run one or more image files, passed as raw bytes, through the model's
+    pre- and post-processing handlers.
+
+    Returns HTTP status code and the request, as in `max_predict()`.
+    """
+    request = inference_request.InferenceRequest()
+    request.response_encoding = encoding
+    if len(images) == 0:
+      self._handlers.error_post_process(request,
+                                        "Invalid request: No image provided")
+      return 400, request
+    request.raw_input_batch = [
+      {"image": image, "threshold": threshold} for image in images
+    ]
+    return self._score(request)
+
+  def _score(self, request):
+    # type: (inference_request.InferenceRequest) -> Tuple[int, inference_request.InferenceRequest]
+    try:
+      with request.timed("pre_process"):
+        self._handlers.pre_process(request)
+    except (KeyError, TypeError, ValueError) as e:
+      self._handlers.error_post_process(
+        request, "Invalid request: {}".format(e))
+      return 400, request
+    try:
+      with request.timed("inference"):
+        if self._cache is not None:
+          self._cache.run(request)
+        else:
+          self._run(request)
+      with request.timed("post_process"):
+        self._handlers.post_process(request)
+    except binascii.Error as e:
+      # The response cache decodes base64 images to compute their keys
+      self._handlers.error_post_process(
+        request, "Invalid request: Image is not valid base64: {}".format(e))
+      return 400, request
+    except Exception as e:
+      self._handlers.error_post_process(request, "Inference failed: {}"
+                                                 "".format(e))
+      return 500, request
+    return 200, request
+
+
+class _Replica(object):
+  """
+  Worker-process end of a `ReplicatedModelServer`. Wraps a `ModelServer` in
+  the calling convention of `replica_pool.ReplicaPool`.
+  """
+
+  def __init__(self, **server_kwargs):
+    self._server = ModelServer(**server_kwargs)
+
+  def max_predict_http(self, body, **kwargs):
+    # type: (bytes, **Any) -> Tuple[bytes, Tuple[int, str]]
+    status, content_type, payload = self._server.max_predict_http(body,
+                                                                  **kwargs)
+    return payload, (status, content_type)
+
+  def tf_serving_predict_http(self, body):
+    # type: (bytes) -> Tuple[bytes, Tuple[int, str]]
+    status, content_type, payload = self._server.tf_serving_predict_http(body)
+    return payload, (status, content_type)
+
+  def model_metadata(self, _):
+    # type: (bytes) -> Tuple[bytes, None]
+    return json.dumps(self._server.model_metadata()).encode("utf-8"), None
+
+  def stats(self, _):
+    # type: (bytes) -> Tuple[bytes, None]
+    return json.dumps(self._server.stats()).encode("utf-8"), None
+
+  def profile(self, _):
+    # type: (bytes) -> Tuple[bytes, None]
+    return json.dumps(self._server.profile()).encode("utf-8"), None
+
+  def chrome_trace(self, _):
+    # type: (bytes) -> Tuple[bytes, bool]
+    trace = self._server.chrome_trace()
+    return (trace or "").encode("utf-8"), trace is not None
+
+
+def _merge_replica_stats(snapshots):
+  # type: (List[Dict[str, Any]]) -> Dict[str, Any]
+  """
+  Combines the `ModelServer.stats()` of several replicas into the stats of
+  one server that had handled all of their requests. Cache sizes and
+  capacities add up, since each replica has its own cache.
+  """
+  metrics = request_metrics.RequestMetrics()
+  for snapshot in snapshots:
+    metrics.merge(snapshot["requests"])
+  result = {"requests": metrics.snapshot()}
+  if "batching" in snapshots[0]:
+    batching_stats = batching.BatchingStats()
+    for snapshot in snapshots:
+      batching_stats.merge(snapshot["batching"])
+    result["batching"] = batching_stats.snapshot()
+    result["batching"]["queue_depth"] = sum(
+      snapshot["batching"]["queue_depth"] for snapshot in snapshots)
+  if "cache" in snapshots[0]:
+    result["cache"] = {
+      key: sum(snapshot["cache"][key] for snapshot in snapshots)
+      for key in snapshots[0]["cache"]
+    }
+  return result
+
+
+class ReplicatedModelServer(object):
+  """
+  Drop-in replacement for `ModelServer` that forwards each request to one of
+  several worker processes, each with its own `ModelServer`.
+  """
+
+  def __init__(self, num_replicas, cpu_sets=None, **server_kwargs):
+    # type: (int, List[List[int]], **Any) -> None
+    """
+    Start the worker processes.
+
+    Args:
+      num_replicas: Number of worker processes
+      cpu_sets: Optional list of the CPUs to pin each worker process to,
+        e.g. from `replica_pool.core_groups()`
+      server_kwargs: Arguments for the `ModelServer` constructor
+    """
+    self.model_name = server_kwargs["model_name"]
+    # Each replica needs enough requests in hand at once to fill a batch or
+    # use all of its concurrent runs, and twice that to keep pre- and
+    # post-processing of some requests going while others are in the
+    # session.
+    threads_per_replica = 2 * max(server_kwargs.get("max_batch_size", 1),
+                                  server_kwargs.get("max_concurrent_runs", 0),
+                                  1)
+    self._pool = replica_pool.ReplicaPool(_Replica, server_kwargs,
+                                          num_replicas, cpu_sets,
+                                          threads_per_replica)
+    print("Started {} replicas of model '{}'".format(num_replicas,
+                                                     self.model_name))
+
+  def close(self):
+    """
+    Shut down the worker processes.
+    """
+    self._pool.close()
+
+  def stats(self):
+    # type: () -> Dict[str, Any]
+    """
+    Response body for `GET /model/stats`, with the counters and histograms
+    of every live replica added together, plus the state of the pool.
+    """
+    snapshots = [json.loads(payload.decode("utf-8"))
+                 for payload, _ in self._pool.call_all("stats", b"")]
+    result = _merge_replica_stats(snapshots)
+    result["replicas"] = self._pool.stats()
+    return result
+
+  def profile(self):
+    # type: () -> Dict[str, Any]
+    """
+    Profile of whichever replica is least busy.
+    """
+    payload, _ = self._pool.call("profile", b"")
+    return json.loads(payload.decode("utf-8"))
+
+  def chrome_trace(self):
+    # type: () -> str
+    payload, found = self._pool.call("chrome_trace", b"")
+    return payload.decode("utf-8") if found else None
+
+  def model_status(self):
+    # type: () -> Dict[str, Any]
+    return ModelServer.model_status()
+
+  def model_metadata(self):
+    # type: () -> Dict[str, Any]
+    payload, _ = self._pool.call("model_metadata", b"")
+    return json.loads(payload.decode("utf-8"))
+
+  def tf_serving_predict_http(self, body):
+    # type: (bytes) -> Tuple[int, str, bytes]
+    payload, (status, content_type) = self._pool.call(
+      "tf_serving_predict_http", body)
+    return status, content_type, payload
+
+  def max_predict_http(self, body, content_type, query_string, accept):
+    # type: (bytes, str, str, str) -> Tuple[int, str, bytes]
+    payload, (status, response_type) = self._pool.call(
+      "max_predict_http", body, content_type=content_type,
+      query_string=query_string, accept=accept)
+    return status, response_type, payload
+
+
+def _json_response(status, body):
+  # type: (int, Any) -> Tuple[int, str, bytes]
+  return (status, "application/json",
+          inference_request.InferenceRequest.to_json_text(body).encode("utf-8"))
+
+
+def _decode_tf_serving_value(value):
+  # type: (Any) -> Any
+  """
+  Convert a JSON input value in TensorFlow Serving format to a value that
+  can be fed to a session. Binary values arrive as `{"b64": "<base64>"}`.
+  """
+  if isinstance(value, dict):
+    if "b64" not in value:
+      raise ValueError("Unexpected JSON object in input: {}".format(value))
+    return base64.b64decode(value["b64"])
+  elif isinstance(value, list):
+    return [_decode_tf_serving_value(v) for v in value]
+  return value
+
+
+def _encode_tf_serving_value(value):
+  # type: (Any) -> Any
+  """
+  Convert an output value from a session to JSON in TensorFlow Serving
+  format. Strings that aren't valid UTF-8 go out as `{"b64": "<base64>"}`.
+  Numeric arrays are left as is for `InferenceRequest.to_json_text()` to
+  write out.
+  """
+  if isinstance(value, np.ndarray):
+    if value.dtype == np.object_:
+      return _encode_tf_serving_value(value.tolist())
+    return value
+  elif isinstance(value, list):
+    return [_encode_tf_serving_value(v) for v in value]
+  elif isinstance(value, bytes):
+    try:
+      return value.decode("utf-8")
+    except UnicodeDecodeError:
+      return {"b64": base64.b64encode(value).decode("utf-8")}
+  elif isinstance(value, np.generic):
+    return value.item()
+  return value
+
+
+def _negotiate_encoding(query, accept):
+  # type: (Dict[str, List[str]], str) -> str
+  """
+  Choose the response encoding for a request to `/model/predict`.
+
+  Args:
+    query: Parsed query string of the request
+    accept: Value of the request's `Accept` header, or None
+
+  Returns a key of `InferenceRequest.RESPONSE_ENCODINGS`. An explicit
+  `encoding` query parameter wins over the `Accept` header, which wins over
+  the default of "json".
+
+  Raises ValueError if the query parameter names an unknown encoding.
+  """
+  encodings = inference_request.InferenceRequest.RESPONSE_ENCODINGS
+  if "encoding" in query:
+    encoding = query["encoding"][0]
+    if encoding not in encodings:
+      raise ValueError("Unknown encoding '{}'. Supported encodings are: {}"
+                       "".format(encoding, list(encodings.keys())))
+    return encoding
+  if accept is None:
+    return "json"
+  by_content_type = {v: k for k, v in encodings.items()}
+  by_content_type["application/x-msgpack"] = "msgpack"
+  # Pick the acceptable content type with the highest quality value,
+  # breaking ties in favor of the first one listed.
+  best_encoding, best_quality = "json", -1.0
+  for media_range in accept.split(","):
+    params = media_range.split(";")
+    media_type = params[0].strip().lower()
+    quality = 1.0
+    for p in params[1:]:
+      name, _, value = p.partition("=")
+      if name.strip() == "q":
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    # q=0 means "not acceptable"
+    if quality <= 0.0:
+      continue
+    if media_type in by_content_type and quality > best_quality:
+      best_encoding, best_quality = by_content_type[media_type], quality
+  return best_encoding
+
+
+def _parse_multipart(body, content_type):
+  # type: (bytes, str) -> List[Tuple[str, bytes]]
+  """
+  Split a `multipart/form-data` request body into its parts.
+
+  Returns a list of (field name, field value) pairs, in the order they
+  appear in the body.
+  """
+  boundary = None
+  for param in content_type.split(";")[1:]:
+    key, _, value = param.strip().partition("=")
+    if key.lower() == "boundary":
+      boundary = value.strip('"')
+  if not boundary:
+    raise ValueError("Multipart request has no boundary")
+  delimiter = b"--" + boundary.encode("utf-8")
+  result = []
+  # Everything before the first delimiter and after the last one is
+  # preamble/epilogue.
+  for part in body.split(delimiter)[1:-1]:
+    # Each part is CRLF, headers, blank line, content, CRLF.
+    headers, sep, content = part[2:].partition(b"\r\n\r\n")
+    if not sep:
+      raise ValueError("Malformed multipart request")
+    match = _MULTIPART_NAME_REGEX.search(headers)
+    if match is None:
+      raise ValueError("Multipart field has no name")
+    result.append((match.group(1).decode("utf-8"), content[:-2]))
+  return result
+
+
+def _make_request_handler(server):
+  # type: (ModelServer) -> type
+  """
+  Create a `BaseHTTPRequestHandler` subclass that dispatches to `server`,
+  which is either a `ModelServer` or a `ReplicatedModelServer`.
+  """
+  class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, content_type, payload):
+      # type: (int, str, bytes) -> None
+      self.send_response(status)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def _send_json(self, status, body):
+      self._send(*_json_response(status, body))
+
+    def _read_body(self):
+      length = int(self.headers.get("Content-Length", 0))
+      return self.rfile.read(length)
+
+    def _match_model_path(self):
+      match = _TF_SERVING_PATH_REGEX.match(
+        urllib.parse.urlsplit(self.path).path)
+      if match is None or match.group("name") != server.model_name:
+        return None
+      return match.group("suffix") or ""
+
+    def do_GET(self):
+      path = urllib.parse.urlsplit(self.path).path
+      if path == _MAX_STATS_PATH:
+        self._send_json(200, server.stats())
+        return
+      if path == _MAX_PROFILE_PATH:
+        profile = server.profile()
+        if profile is None:
+          self._send_json(404, {"error": "Profiling is off. Start the "
+                                         "server with --profile_sample_rate "
+                                         "to turn it on."})
+        else:
+          self._send_json(200, profile)
+        return
+      if path == _MAX_PROFILE_TRACE_PATH:
+        trace = server.chrome_trace()
+        if trace is None:
+          self._send_json(404, {"error": "No sampled runs to show"})
+        else:
+          self._send(200, "application/json", trace.encode("utf-8"))
+        return
+      suffix = self._match_model_path()
+      if suffix == "":
+        self._send_json(200, server.model_status())
+      elif suffix == "/metadata":
+        self._send_json(200, server.model_metadata())
+      else:
+        self._send_json(404, {"error": "Not found: {}".format(self.path)})
+
+    def do_POST(self):
+      body = self._read_body()
+      if urllib.parse.urlsplit(self.path).path == _MAX_PREDICT_PATH:
+        self._send(*server.max_predict_http(
+          body, self.headers.get("Content-Type", "application/json"),
+          urllib.parse.urlsplit(self.path).query,
+          self.headers.get("Accept")))
+        return
+      if self._match_model_path() != ":predict":
+        self._send_json(404, {"error": "Not found: {}".format(self.path)})
+        return
+      self._send(*server.tf_serving_predict_http(body))
+
+  return _RequestHandler
+
+
+def main(_):
+  intra_op_threads = FLAGS.intra_op_threads
+  cpu_sets = None
+  if FLAGS.num_replicas > 1 and FLAGS.pin_replicas:
+    # TensorFlow sizes the default thread pools by the CPUs that the
+    # process may use, i.e. by the replica's group.
+    cpu_sets = replica_pool.core_groups(FLAGS.num_replicas)
+  elif FLAGS.num_replicas > 1 and intra_op_threads == 0:
+    # Don't let every replica try to use every core.
+    intra_op_threads = max(1, os.cpu_count() // FLAGS.num_replicas)
+  server_kwargs = {
+    "saved_model_dir": FLAGS.saved_model_dir,
+    "model_name": FLAGS.model_name,
+    "max_batch_size": FLAGS.max_batch_size,
+    "max_batch_wait_secs": FLAGS.max_batch_wait_secs,
+    "cache_bytes": FLAGS.cache_bytes,
+    "config": inference_request.session_config(intra_op_threads,
+                                                FLAGS.inter_op_threads),
+    "max_concurrent_runs": FLAGS.max_concurrent_runs,
+    "profile_sample_rate": FLAGS.profile_sample_rate,
+    "variants_dir": FLAGS.variants_dir,
+  }
+  if FLAGS.num_replicas > 1:
+    server = ReplicatedModelServer(FLAGS.num_replicas, cpu_sets,
+                                   **server_kwargs)
+  else:
+    server = ModelServer(**server_kwargs)
+  httpd = _ThreadingHTTPServer((FLAGS.host, FLAGS.port),
+                               _make_request_handler(server))
+  print("Serving on http://{}:{}".format(FLAGS.host, FLAGS.port))
+  httpd.serve_forever()
+
+
+if __name__ == "__main__":
+  tf.app.run()
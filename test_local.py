@@ -61,24 +61,25 @@ def main():
   request.raw_inputs["threshold"] = thresh
 
   # Fire up TensorFlow and perform end-to-end inference
-  with tf.Session() as sess:
-    graph = tf.Graph()
-    with graph.as_default():
-      meta_graph = tf.saved_model.loader.load(
-        sess,
-        [tf.saved_model.tag_constants.SERVING],
-        _SAVED_MODEL_DIR)  # type: tf.MetaGraphDef
+  sess, graph, meta_graph = inference_request.load_saved_model(
+    _SAVED_MODEL_DIR)
+  with sess:
+    # Extract serving "method" signature
+    signature = meta_graph.signature_def["serving_default"]
 
-      # Extract serving "method" signature
-      signature = meta_graph.signature_def["serving_default"]
+    print("Signature:\n{}".format(signature))
 
-      print("Signature:\n{}".format(signature))
-
-      odh = handlers.ObjectDetectorHandlers()
+    runner = inference_request.LocalTFRunner(sess, graph, signature)
+    odh = handlers.ObjectDetectorHandlers()
+    with request.timed("pre_process"):
       odh.pre_process(request)
-      inference_request.pass_to_local_tf(request, sess, graph, signature)
+    with request.timed("inference"):
+      runner.run(request)
+    with request.timed("post_process"):
       odh.post_process(request)
-      print("Result:\n{}".format(request.json_result()))
+    print("Result:\n{}".format(request.json_result()))
+    print("Time per phase (ms): {}".format(
+      {k: round(v * 1000.0, 2) for k, v in request.phase_durations.items()}))
 
 
 if __name__ == "__main__":